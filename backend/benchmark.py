@@ -0,0 +1,585 @@
+"""
+Load test and micro-benchmark of the trivia API.
+
+Seeds a synthetic question bank into a SQLite or PostgreSQL database, drives
+every route through the Flask test client and/or a real HTTP server at a
+given concurrency, and reports the latency percentiles, the throughput and
+the SQL statements per request of each route. Results are saved as JSON so
+that runs on different commits can be compared (see --baseline):
+
+    python benchmark.py --questions 100000 --concurrency 8 \\
+        --output results.json
+    python benchmark.py --questions 100000 --concurrency 8 \\
+        --baseline results.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from sqlalchemy import event, func
+
+from flaskr import create_app, encode_cursor
+from models import db, Question, Category, table_versions, category_cache
+from models import notify_question_change, create_schema
+from bulk import insert_batch
+
+SEED_BATCH_SIZE = 10000
+
+# words the synthetic questions and answers are made of, also used as
+# search terms
+WORDS = ['river', 'planet', 'painter', 'empire', 'ocean', 'mountain',
+         'novel', 'symphony', 'element', 'desert', 'island', 'bridge',
+         'comet', 'language', 'festival', 'volcano', 'glacier', 'temple',
+         'engine', 'poem', 'forest', 'kingdom', 'harbor', 'tower', 'theorem',
+         'fossil', 'canyon', 'opera', 'satellite', 'crystal', 'treaty',
+         'marathon', 'galaxy', 'dynasty', 'reef', 'sculpture', 'prairie',
+         'lighthouse', 'mineral', 'cathedral']
+
+
+class Benchmark:
+    """
+    Benchmark
+        runs the scenarios against one app, through the test client or
+        through an HTTP server, and counts the SQL statements executed.
+    """
+
+    def __init__(self, app, rng, base_url=None, count_sql=True,
+                 accept_encoding=None):
+        self.app = app
+        self.rng = rng
+        self.base_url = base_url
+        self.count_sql = count_sql
+        self.headers = ({} if accept_encoding is None
+                        else {'Accept-Encoding': accept_encoding})
+        self.statements = 0
+        self.created_ids = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        with app.app_context():
+            self.category_ids = [category.id for category in
+                                 Category.query.order_by(Category.id)]
+            self.min_id, self.max_id = db.session.query(
+                func.min(Question.id), func.max(Question.id)).one()
+            self.count = Question.query.count()
+            self.engine = db.engine
+        # the categories version a compact client got on its first page
+        # (unknown to a server running in another process)
+        self.categories_version = table_versions.tag('categories')
+        event.listen(self.engine, 'after_cursor_execute',
+                     self._count_statement)
+
+    def close(self):
+        event.remove(self.engine, 'after_cursor_execute',
+                     self._count_statement)
+
+    def _count_statement(self, *args):
+        with self._lock:
+            self.statements += 1
+
+    def request(self, method, path, body=None):
+        """
+        Send one request, return its status code and the size of the
+        response body as sent (compressed or not)
+        """
+        status, data = self._send(method, path, body, self.headers)
+        return status, len(data)
+
+    def request_json(self, method, path, body=None):
+        """
+        Send one request, uncompressed, return its status code and its
+        JSON response (None if there is none)
+        """
+        status, data = self._send(method, path, body, {})
+        return status, json.loads(data) if data else None
+
+    def _send(self, method, path, body, headers):
+        if self.base_url is None:
+            client = getattr(self._local, 'client', None)
+            if client is None:
+                client = self._local.client = self.app.test_client()
+            if isinstance(body, bytes):
+                response = client.open(path, method=method, data=body,
+                                       headers=headers)
+            else:
+                response = client.open(path, method=method, json=body,
+                                       headers=headers)
+            return response.status_code, response.get_data()
+        url = urlsplit(self.base_url)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                url.hostname, url.port, timeout=60)
+        headers = dict(headers)
+        payload = None
+        if isinstance(body, bytes):
+            payload = body
+        elif body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, url.path.rstrip('/') + path,
+                               body=payload, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        return response.status, data
+
+    def run(self, scenario, requests, concurrency):
+        """
+        Send 'requests' requests of 'scenario' from 'concurrency' threads,
+        return the statistics of the run
+        """
+        # the requests are built upfront so that building them (which may
+        # send requests, see build_job_poll) is neither timed nor counted
+        calls = [scenario.build(self) for _ in range(requests)]
+        with self._lock:
+            self.statements = 0
+        latencies = []
+        sizes = []
+        errors = []
+
+        def send(call):
+            start = time.perf_counter()
+            try:
+                status, size = self.request(*call)
+            except (OSError, http.client.HTTPException):
+                status, size = None, 0
+            latencies.append(time.perf_counter() - start)
+            sizes.append(size)
+            if status is None or status >= 500 or (
+                    status >= 400 and status not in scenario.expected):
+                errors.append(status)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, calls))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return {
+            'scenario': scenario.name,
+            'method': scenario.method,
+            'route': scenario.route,
+            'requests': requests,
+            'errors': len(errors),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'throughput_rps': requests / elapsed,
+            'bytes_per_request': sum(sizes) / requests,
+            # unknown when the server runs in another process
+            'sql_per_request': (self.statements / requests
+                                if self.count_sql else None)
+        }
+
+
+class Scenario:
+    """
+    Scenario
+        one route; 'build(benchmark)' returns the (method, path, body) of a
+        request to it, the body being sent as JSON unless it is bytes.
+        'expected' lists the 4xx status codes which are not errors, 'writes'
+        tells whether the scenario changes the data and 'creates' whether
+        it adds questions (which 'delete_question' removes afterwards).
+    """
+
+    def __init__(self, name, method, route, build, expected=(),
+                 writes=False, creates=False, max_requests=None):
+        self.name = name
+        self.method = method
+        self.route = route
+        self.build = build
+        self.expected = expected
+        self.writes = writes
+        self.creates = creates
+        self.max_requests = max_requests
+
+
+def random_page(benchmark, count):
+    return benchmark.rng.randint(1, max(1, (count + 9) // 10))
+
+
+def random_category(benchmark):
+    return benchmark.rng.choice(benchmark.category_ids)
+
+
+def random_question_id(benchmark):
+    return benchmark.rng.randint(benchmark.min_id or 1, benchmark.max_id or 1)
+
+
+def new_question(benchmark):
+    return {'question': synthetic_text(benchmark.rng, 8) + '?',
+            'answer': synthetic_text(benchmark.rng, 2),
+            'category': random_category(benchmark),
+            'difficulty': benchmark.rng.randint(1, 5)}
+
+
+def build_delete(benchmark):
+    # delete the questions created by the 'create_question' scenario
+    with benchmark._lock:
+        question_id = (benchmark.created_ids.pop() if benchmark.created_ids
+                       else random_question_id(benchmark))
+    return 'DELETE', f'/questions/{question_id}', None
+
+
+def build_create(benchmark):
+    return 'POST', '/questions', new_question(benchmark)
+
+
+def build_import(benchmark):
+    lines = [json.dumps(new_question(benchmark)) for _ in range(10)]
+    return 'POST', '/questions/import', '\n'.join(lines).encode()
+
+
+def build_results(benchmark):
+    return ('POST', '/quizzes/results', {
+        'player': f'player {benchmark.rng.randint(1, 1000)}',
+        'quiz_category': {'id': benchmark.rng.choice(
+            [0] + benchmark.category_ids)},
+        'results': [{'question_id': random_question_id(benchmark),
+                     'correct': benchmark.rng.random() < 0.6}
+                    for _ in range(10)]})
+
+
+def build_job_poll(benchmark):
+    # queue an insert (write-behind mode, else the question is inserted
+    # right away and there is no job), and poll its job
+    status, data = benchmark.request_json('POST', '/questions',
+                                          new_question(benchmark))
+    job_id = data['job_id'] if status == 202 else 'none'
+    return 'GET', f'/questions/jobs/{job_id}', None
+
+
+def build_category_questions(benchmark):
+    pages = benchmark.count // max(1, len(benchmark.category_ids))
+    return ('GET', f'/categories/{random_category(benchmark)}/questions'
+                   f'?page={random_page(benchmark, pages)}', None)
+
+
+SCENARIOS = [
+    Scenario('categories', 'GET', '/categories',
+             lambda b: ('GET', '/categories', None)),
+    Scenario('questions_page', 'GET', '/questions',
+             lambda b: ('GET', f'/questions?page={random_page(b, b.count)}',
+                        None)),
+    Scenario('questions_compact', 'GET', '/questions',
+             lambda b: ('GET', f'/questions?page={random_page(b, b.count)}'
+                               f'&compact=1&categories_version='
+                               f'{b.categories_version}',
+                        None)),
+    Scenario('questions_cursor', 'GET', '/questions',
+             lambda b: ('GET', '/questions?cursor=' +
+                        encode_cursor(random_question_id(b)), None),
+             expected=(404,)),
+    Scenario('category_questions', 'GET',
+             '/categories/<int:category_id>/questions',
+             build_category_questions,
+             expected=(404,)),
+    Scenario('search', 'POST', '/questions',
+             lambda b: ('POST', '/questions',
+                        {'searchTerm': b.rng.choice(WORDS)}),
+             expected=(404,)),
+    Scenario('quiz', 'POST', '/quizzes',
+             lambda b: ('POST', '/quizzes',
+                        {'previous_questions': [
+                            random_question_id(b) for _ in range(5)],
+                         'quiz_category': {'id': random_category(b)}})),
+    Scenario('quiz_batch', 'POST', '/quizzes',
+             lambda b: ('POST', '/quizzes',
+                        {'previous_questions': [
+                            random_question_id(b) for _ in range(5)],
+                         'quiz_category': {'id': random_category(b)},
+                         'n': 10})),
+    Scenario('quiz_adaptive', 'POST', '/quizzes',
+             lambda b: ('POST', '/quizzes',
+                        {'previous_questions': [
+                            random_question_id(b) for _ in range(5)],
+                         'quiz_category': {'id': random_category(b)},
+                         'answers': [b.rng.random() < 0.6
+                                     for _ in range(5)]})),
+    Scenario('quiz_session', 'POST', '/quizzes/sessions',
+             lambda b: ('POST', '/quizzes/sessions',
+                        {'quiz_category': {'id': random_category(b)}})),
+    Scenario('leaderboard', 'GET', '/leaderboard',
+             lambda b: ('GET', '/leaderboard?category='
+                               f'{b.rng.choice([0] + b.category_ids)}',
+                        None)),
+    Scenario('question_stats', 'GET', '/questions/<int:question_id>/stats',
+             lambda b: ('GET', f'/questions/{random_question_id(b)}/stats',
+                        None),
+             expected=(404,)),
+    Scenario('metrics', 'GET', '/metrics',
+             lambda b: ('GET', '/metrics', None)),
+    Scenario('pool_metrics', 'GET', '/metrics/pool',
+             lambda b: ('GET', '/metrics/pool', None)),
+    Scenario('export', 'GET', '/questions/export',
+             lambda b: ('GET', '/questions/export', None), max_requests=3),
+    Scenario('create_question', 'POST', '/questions', build_create,
+             writes=True, creates=True),
+    Scenario('import', 'POST', '/questions/import', build_import,
+             writes=True, creates=True),
+    Scenario('write_job', 'GET', '/questions/jobs/<job_id>', build_job_poll,
+             expected=(404,), writes=True, creates=True),
+    Scenario('quiz_results', 'POST', '/quizzes/results', build_results,
+             expected=(422,), writes=True),
+    Scenario('delete_question', 'DELETE', '/questions/<int:question_id>',
+             build_delete, expected=(404, 422), writes=True)
+]
+
+
+def percentile(values, percent):
+    """Return the 'percent' percentile of the sorted 'values' (nearest rank)"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+def synthetic_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(questions, categories, rng, log=print):
+    """
+    Replace the content of the database with 'categories' categories and
+    'questions' synthetic questions. Must run in an app context.
+    """
+    db.session.query(Question).delete()
+    db.session.query(Category).delete()
+    db.session.commit()
+    db.session.execute(Category.__table__.insert(), [
+        {'id': category_id, 'type': f'Category {category_id}'}
+        for category_id in range(1, categories + 1)])
+    db.session.commit()
+    inserted = 0
+    while inserted < questions:
+        size = min(SEED_BATCH_SIZE, questions - inserted)
+        insert_batch([{'question': synthetic_text(rng, 8) + '?',
+                       'answer': synthetic_text(rng, 2),
+                       'category': rng.randint(1, categories),
+                       'difficulty': rng.randint(1, 5)}
+                      for _ in range(size)])
+        inserted += size
+        log(f'seeded {inserted}/{questions} questions')
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    table_versions.bump('categories')
+    category_cache.invalidate()
+    notify_question_change('bulk', None)
+
+
+def is_seeded(questions, categories):
+    """Tell whether the database already holds a bank of this size"""
+    return (Question.query.count() == questions and
+            Category.query.count() == categories)
+
+
+def serve(app):
+    """Serve 'app' from a threaded HTTP server, return (server, base url)"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def run_benchmark(app, modes, requests, concurrency, rng,
+                  scenarios=SCENARIOS, url=None, log=print,
+                  accept_encoding=None):
+    """
+    Run 'scenarios' against 'app' in each of 'modes' ('client' for the test
+    client, 'http' for an HTTP server, started unless 'url' is given),
+    sending 'accept_encoding' as 'Accept-Encoding' if given, return the
+    list of results
+    """
+    results = []
+    for mode in modes:
+        server = None
+        base_url = None
+        if mode == 'http':
+            if url is None:
+                server, base_url = serve(app)
+            else:
+                base_url = url
+        benchmark = Benchmark(app, rng, base_url,
+                              count_sql=mode == 'client' or url is None,
+                              accept_encoding=accept_encoding)
+        try:
+            for scenario in scenarios:
+                count = min(requests, scenario.max_requests or requests)
+                if scenario.creates:
+                    # keep the ids so that 'delete_question' removes them
+                    with app.app_context():
+                        before = db.session.query(
+                            func.max(Question.id)).scalar() or 0
+                result = benchmark.run(scenario, count, concurrency)
+                if scenario.creates:
+                    with app.app_context():
+                        benchmark.created_ids.extend(
+                            question_id for question_id, in
+                            db.session.query(Question.id)
+                            .filter(Question.id > before))
+                result['mode'] = mode
+                results.append(result)
+                log(format_result(result))
+        finally:
+            benchmark.close()
+            if server is not None:
+                server.shutdown()
+    return results
+
+
+def format_result(result, baseline=None):
+    sql = result['sql_per_request']
+    line = (f"{result['mode']:6} {result['scenario']:18} "
+            f"p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms"
+            f"  p99 {result['p99_ms']:8.2f} ms  "
+            f"{result['throughput_rps']:8.1f} req/s  "
+            f"{'-' if sql is None else f'{sql:.1f}':>5} SQL/req  "
+            f"{result['bytes_per_request']:8.0f} B/req  "
+            f"{result['errors']} errors")
+    if baseline is not None:
+        p95 = change(baseline['p95_ms'], result['p95_ms'])
+        throughput = change(baseline['throughput_rps'],
+                            result['throughput_rps'])
+        # older results have no sizes
+        size = change(baseline.get('bytes_per_request'),
+                      result['bytes_per_request'])
+        line += f'  (p95 {p95}, throughput {throughput}, bytes {size})'
+    return line
+
+
+def change(before, after):
+    if not before:
+        return 'n/a'
+    return f'{(after - before) / before * 100:+.0f}%'
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_config(items):
+    """Return the app config given as 'NAME=VALUE' items"""
+    config = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        config[name] = value
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--database-url',
+        default='sqlite:///' + os.path.abspath('benchmark.db'),
+        help='database to seed and query (default: ./benchmark.db); '
+             'its content is replaced')
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--reseed', action='store_true',
+                        help='seed even if the bank already has the '
+                             'requested size')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--mode', choices=['client', 'http', 'both'],
+                        default='both')
+    parser.add_argument('--url', help='base URL of an already running '
+                                      'server to use in http mode')
+    parser.add_argument('--scenario', action='append',
+                        choices=[scenario.name for scenario in SCENARIOS],
+                        help='run only these routes (repeatable)')
+    parser.add_argument('--read-only', action='store_true',
+                        help='skip the routes changing the data')
+    parser.add_argument('--accept-encoding', metavar='ENCODINGS',
+                        help="'Accept-Encoding' header of the requests, "
+                             "e.g. gzip (default: none)")
+    parser.add_argument('--config', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='app setting, e.g. SEARCH_BACKEND=memory')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the data and the requests')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    config = parse_config(args.config)
+    config['DATABASE_URL'] = args.database_url
+    # every request of some routes may be slow on a large bank
+    config.setdefault('SLOW_REQUEST_MS', '')
+    app = create_app(config)
+    with app.app_context():
+        create_schema()
+        if args.reseed or not is_seeded(args.questions, args.categories):
+            seed(args.questions, args.categories, rng)
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if (args.scenario is None or scenario.name in args.scenario)
+                 and not (args.read_only and scenario.writes)]
+    modes = ['client', 'http'] if args.mode == 'both' else [args.mode]
+    results = run_benchmark(app, modes, args.requests, args.concurrency,
+                            rng, scenarios, url=args.url,
+                            accept_encoding=args.accept_encoding)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {(result['mode'], result['scenario']): result
+                        for result in json.load(baseline_file)['results']}
+        print(f'\ncompared with {args.baseline}:')
+        for result in results:
+            key = (result['mode'], result['scenario'])
+            print(format_result(result, baseline.get(key)))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'questions': args.questions,
+            'categories': args.categories,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'accept_encoding': args.accept_encoding,
+            'config': parse_config(args.config)
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,219 @@
+import csv
+import io
+import json
+from itertools import islice
+
+from models import db, Question, category_get_type, notify_question_change
+from models import question_fingerprint
+
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+# fields of an imported question, in the order of the CSV columns
+FIELDS = ['question', 'answer', 'category', 'difficulty']
+# columns of an inserted question
+COLUMNS = FIELDS + ['fingerprint']
+# at most that many errors are reported in the import report
+MAX_REPORTED_ERRORS = 100
+
+
+def parse_ndjson(lines):
+    """
+    Yield (line number, record) for each non blank line of 'lines',
+    record being a dict, or the ValueError (e.g. UnicodeDecodeError)
+    raised while decoding it.
+    """
+    for number, line in enumerate(lines, 1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('a JSON object is expected')
+            yield number, record
+        except ValueError as error:
+            yield number, error
+
+
+def parse_csv(lines):
+    """
+    Yield (line number, record) for each row of 'lines', a CSV file with a
+    header row naming the columns, record being a dict, or the
+    UnicodeDecodeError of a row which is not valid UTF-8.
+    """
+    # the invalid bytes are kept as surrogates until the row is checked
+    lines = (line.decode('utf-8', 'surrogateescape')
+             if isinstance(line, bytes) else line
+             for line in lines)
+    reader = csv.DictReader(lines)
+    for record in reader:
+        try:
+            for value in record.values():
+                if isinstance(value, str):
+                    value.encode('utf-8', 'surrogateescape').decode('utf-8')
+            yield reader.line_num, record
+        except UnicodeDecodeError as error:
+            yield reader.line_num, error
+
+
+PARSERS = {
+    'ndjson': parse_ndjson,
+    'csv': parse_csv
+}
+
+
+def validate(record):
+    """
+    Return the column values of the question described by 'record', or
+    raise ValueError if it is not a valid question.
+    """
+    if isinstance(record, ValueError):
+        raise record
+    missing = [field for field in FIELDS if record.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f'missing fields: {", ".join(missing)}')
+    try:
+        category = int(record['category'])
+        difficulty = int(record['difficulty'])
+    except (TypeError, ValueError):
+        raise ValueError('category and difficulty must be integers')
+    if category_get_type(category) is None:
+        raise ValueError(f'unknown category: {category}')
+    return {
+        'question': str(record['question']),
+        'answer': str(record['answer']),
+        'category': category,
+        'difficulty': difficulty,
+        'fingerprint': question_fingerprint(str(record['question']))
+    }
+
+
+def find_duplicates(rows):
+    """
+    Return, for each of 'rows' (validated questions), the index in 'rows'
+    or the id (as 'question <id>') of the question it duplicates, or None:
+    one 'IN' query on the fingerprint index for all of them
+    """
+    fingerprints = [row['fingerprint'] for row in rows]
+    existing = dict(db.session.query(Question.fingerprint, Question.id)
+                    .filter(Question.fingerprint.in_(set(fingerprints))))
+    seen = {}
+    duplicates = []
+    for index, fingerprint in enumerate(fingerprints):
+        if fingerprint in existing:
+            duplicates.append(f'question {existing[fingerprint]}')
+        elif fingerprint in seen:
+            duplicates.append(seen[fingerprint])
+        else:
+            seen[fingerprint] = index
+            duplicates.append(None)
+    return duplicates
+
+
+def insert_batch(rows):
+    """
+    Insert 'rows' in one transaction: with 'COPY' on PostgreSQL, with a
+    multi-row 'INSERT' otherwise. The rows without a fingerprint (e.g.
+    synthetic ones) get the fingerprint of their question.
+    """
+    rows = [row if row.get('fingerprint') else
+            dict(row, fingerprint=question_fingerprint(row['question']))
+            for row in rows]
+    if db.engine.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column] for column in COLUMNS])
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f'COPY questions ({", ".join(COLUMNS)}) FROM STDIN WITH CSV',
+            buffer)
+    else:
+        db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+
+
+def import_questions(records, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import the questions of 'records', an iterable of (line number, record)
+    as yielded by the parsers, committing every 'batch_size' valid rows.
+    Questions already in the bank, or earlier in 'records', are rejected
+    as duplicates (see models.question_fingerprint).
+    Return a report of the number of inserted and rejected rows (of which
+    duplicates), with the first errors.
+    """
+    report = {'inserted': 0, 'failed': 0, 'duplicates': 0, 'errors': []}
+
+    def error(lines, message):
+        report['failed'] += len(lines)
+        for line in lines:
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': line, 'error': message})
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        rows = []
+        lines = []
+        for line, record in batch:
+            try:
+                rows.append(validate(record))
+                lines.append(line)
+            except ValueError as exception:
+                error([line], str(exception))
+        if not rows:
+            continue
+        duplicates = find_duplicates(rows)
+        if any(duplicate is not None for duplicate in duplicates):
+            for line, duplicate in zip(lines, duplicates):
+                if duplicate is not None:
+                    report['duplicates'] += 1
+                    error([line], 'duplicate of ' + (
+                        duplicate if isinstance(duplicate, str)
+                        else f'line {lines[duplicate]}'))
+            rows = [row for row, duplicate in zip(rows, duplicates)
+                    if duplicate is None]
+            lines = [line for line, duplicate in zip(lines, duplicates)
+                     if duplicate is None]
+            if not rows:
+                continue
+        try:
+            insert_batch(rows)
+            report['inserted'] += len(rows)
+        except Exception as exception:
+            db.session.rollback()
+            error(lines, f'batch rejected by the database: {exception}')
+        notify_question_change('bulk', None)
+    return report
+
+
+def export_questions(fmt='ndjson', batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield all the questions, ordered by id, as NDJSON lines or CSV rows
+    (after a header row). Rows are streamed from a server-side cursor, so
+    the table is never loaded in memory.
+    """
+    columns = ['id'] + FIELDS
+    rows = (db.session.query(*(getattr(Question, column)
+                               for column in columns))
+            .order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size))
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row))) + '\n'
@@ -0,0 +1,318 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import secrets
+import struct
+import tempfile
+import threading
+import time
+
+
+class VersionedCache:
+    """
+    VersionedCache
+        keeps the value returned by 'loader()' in memory until it is
+        invalidated, and counts hits (served from memory) and misses
+        (the loader had to run).
+
+        When 'snapshot_path' is set, every load is also written to that
+        file together with its version, so that the other worker processes
+        pick up the new value from the file instead of running the loader.
+        'encode' and 'decode' convert the value to and from something JSON
+        can store.
+    """
+
+    def __init__(self, loader, snapshot_path=None,
+                 encode=None, decode=None):
+        self.loader = loader
+        self.snapshot_path = snapshot_path
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the cached value and the counters"""
+        with self._lock:
+            self._value = None
+            self._loaded = False
+            self._snapshot_mtime = None
+            self.version = 0
+            self.hits = 0
+            self.misses = 0
+            self.snapshot_reads = 0
+
+    def get(self):
+        """Return the cached value, loading it if needed"""
+        with self._lock:
+            if self.snapshot_path is not None:
+                self._read_snapshot()
+            if self._loaded:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._load()
+            return self._value
+
+    def invalidate(self):
+        """Reload the value right away (write-through refresh)"""
+        with self._lock:
+            self.misses += 1
+            self._load()
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'snapshot_reads': self.snapshot_reads
+        }
+
+    def _load(self):
+        self._value = self.loader()
+        self._loaded = True
+        self.version += 1
+        if self.snapshot_path is not None:
+            self._write_snapshot()
+
+    def _read_snapshot(self):
+        try:
+            mtime = os.stat(self.snapshot_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._snapshot_mtime:
+            return
+        try:
+            with open(self.snapshot_path) as snapshot:
+                content = json.load(snapshot)
+        except (OSError, ValueError):
+            return
+        self._snapshot_mtime = mtime
+        if not self._loaded or content['version'] > self.version:
+            self._value = self.decode(content['value'])
+            self._loaded = True
+            self.version = content['version']
+            self.snapshot_reads += 1
+
+    def _write_snapshot(self):
+        self._read_version_from_snapshot()
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as snapshot:
+            json.dump({'version': self.version,
+                       'value': self.encode(self._value)}, snapshot)
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+
+    def _read_version_from_snapshot(self):
+        # never publish a version older than the one other workers wrote
+        try:
+            with open(self.snapshot_path) as snapshot:
+                version = json.load(snapshot)['version']
+        except (OSError, ValueError, KeyError):
+            return
+        if version >= self.version:
+            self.version = version + 1
+
+
+class VersionCounters:
+    """
+    VersionCounters
+        one version number per name (e.g. per table), bumped whenever the
+        named data changes.
+
+        When 'path' is set, the counters live in that memory-mapped file, so
+        that a bump made by one worker process is seen by all the others;
+        reading a counter then costs no system call. Otherwise they are
+        local to this process and restart from 0 with it: 'epoch', which
+        changes on each (re)open, tells these runs apart.
+    """
+    SLOT = struct.Struct('<Q')
+
+    def __init__(self, names, path=None):
+        self.names = list(names)
+        self._lock = threading.Lock()
+        self._map = None
+        self.open(path)
+
+    def open(self, path=None):
+        """(Re)open the counters, in the file 'path' if given"""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+            self.path = path
+            self.epoch = '' if path else secrets.token_hex(4)
+            self._local = {name: 0 for name in self.names}
+            self._file = None
+            self._map = None
+            if path is None:
+                return
+            size = self.SLOT.size * len(self.names)
+            self._file = open(path, 'a+b')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._file.fileno()).st_size < size:
+                    self._file.truncate(size)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._file.fileno(), size)
+
+    def get(self, name):
+        """Return the current version of 'name'"""
+        if self._map is None:
+            return self._local[name]
+        offset = self.SLOT.size * self.names.index(name)
+        return self.SLOT.unpack_from(self._map, offset)[0]
+
+    def tag(self, name):
+        """
+        Return a string naming the current version of 'name', which other
+        runs (see 'epoch') can't return for another content
+        """
+        return f'{self.epoch}.{self.get(name)}'
+
+    def bump(self, name):
+        """Increment the version of 'name' and return it"""
+        with self._lock:
+            if self._map is None:
+                self._local[name] += 1
+                return self._local[name]
+            offset = self.SLOT.size * self.names.index(name)
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                version = self.SLOT.unpack_from(self._map, offset)[0] + 1
+                self.SLOT.pack_into(self._map, offset, version)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            return version
+
+
+class SharedLRUCache:
+    """
+    SharedLRUCache
+        a cache of byte strings (e.g. serialized responses) kept in the
+        memory-mapped file 'path', so that all the worker processes of a
+        host share one copy of each entry and see each other's stores.
+
+        The file holds 'size' bytes of fixed 'slot_size' slots, grouped in
+        sets of WAYS slots: a key can only go in the set its hash points
+        to, and a store evicts the least recently used entry of that set.
+        Values larger than a slot are not cached.
+
+        Readers take a shared lock on the file, writers an exclusive one.
+        Entries are never invalidated in place: keys are expected to carry
+        the version of the data they depend on (see VersionCounters), so
+        that a stale entry is no longer read and is evicted in time.
+    """
+    MAGIC = b'TRVCACHE'
+    HEADER = struct.Struct('<8sII')
+    # key digest, last use (monotonic ns), value length
+    SLOT_HEADER = struct.Struct('<20sQI')
+    WAYS = 8
+
+    def __init__(self, path, size=16 * 1024 * 1024, slot_size=16384):
+        self.path = path
+        self.slot_size = slot_size
+        self.capacity = slot_size - self.SLOT_HEADER.size
+        self.slots = max(self.WAYS, size // slot_size // self.WAYS *
+                         self.WAYS)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.too_large = 0
+        length = self.HEADER.size + self.slots * slot_size
+        self._file = open(path, 'a+b')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.seek(0)
+            header = self._file.read(self.HEADER.size)
+            expected = self.HEADER.pack(self.MAGIC, self.slots, slot_size)
+            if header != expected:
+                # new file, or laid out for other settings: start empty
+                self._file.truncate(0)
+                self._file.truncate(length)
+            self._map = mmap.mmap(self._file.fileno(), length)
+            self._map[:self.HEADER.size] = expected
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+    def _set(self, key):
+        """Return the digest of 'key' and the offsets of its set's slots"""
+        digest = hashlib.sha1(key.encode()).digest()
+        first = (int.from_bytes(digest[:8], 'little') %
+                 (self.slots // self.WAYS) * self.WAYS)
+        return digest, [self.HEADER.size + (first + way) * self.slot_size
+                        for way in range(self.WAYS)]
+
+    def get(self, key):
+        """Return the value of 'key', or None if it is not cached"""
+        digest, offsets = self._set(key)
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_SH)
+            try:
+                for offset in offsets:
+                    slot_digest, _, length = self.SLOT_HEADER.unpack_from(
+                        self._map, offset)
+                    if slot_digest == digest and length:
+                        start = offset + self.SLOT_HEADER.size
+                        value = self._map[start:start + length]
+                        # only this slot's use time: a racing update of
+                        # another process just makes it less exact
+                        self.SLOT_HEADER.pack_into(
+                            self._map, offset, digest, time.monotonic_ns(),
+                            length)
+                        self.hits += 1
+                        return value
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """Store 'value' as the value of 'key', return False if too large"""
+        if len(value) > self.capacity:
+            with self._lock:
+                self.too_large += 1
+            return False
+        digest, offsets = self._set(key)
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                victim = None
+                for offset in offsets:
+                    slot_digest, used, length = self.SLOT_HEADER.unpack_from(
+                        self._map, offset)
+                    if slot_digest == digest:
+                        victim, victim_used = offset, 0
+                        break
+                    if victim is None or used < victim_used:
+                        victim, victim_used = offset, used
+                if victim_used:
+                    self.evictions += 1
+                start = victim + self.SLOT_HEADER.size
+                self._map[start:start + len(value)] = value
+                self.SLOT_HEADER.pack_into(self._map, victim, digest,
+                                           time.monotonic_ns(), len(value))
+                self.stores += 1
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+        return True
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'too_large': self.too_large
+        }
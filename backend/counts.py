@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func, text
+
+from models import db, Question, on_question_change, primary_reads
+
+
+class QuestionCounter:
+    """
+    QuestionCounter
+        keeps the number of questions per category in memory so that the
+        listing endpoints don't run a 'COUNT(*)' for every page.
+
+        The counters are loaded with one 'GROUP BY' query, then updated
+        incrementally by the question change listeners. They are recounted
+        when they may be stale: after a question update (its category may
+        have changed) and, since other worker processes may write too, once
+        they are older than 'max_age' seconds.
+
+        In 'estimate' mode the total number of questions is read from the
+        PostgreSQL planner statistics instead, for very large tables.
+
+        When 'id_index' is set (see id_index.py), the question counts are
+        the sizes of its arrays instead.
+
+        Search counts are remembered per normalized term for 'search_ttl'
+        seconds, and forgotten as soon as a question changes.
+    """
+
+    def __init__(self, max_age=60, mode='exact', search_ttl=30,
+                 search_size=1024):
+        self.max_age = max_age
+        self.mode = mode
+        self.search_ttl = search_ttl
+        self.search_size = search_size
+        self.id_index = None
+        self._lock = threading.Lock()
+        self.reset()
+        on_question_change(self.on_question_change)
+
+    def reset(self):
+        """Forget all the counters"""
+        with self._lock:
+            self._categories = None
+            self._others = 0
+            self._loaded_at = 0
+            self._searches = OrderedDict()
+            self.recounts = 0
+            self.hits = 0
+
+    def _load(self):
+        with primary_reads():
+            rows = (db.session.query(Question.category,
+                                     func.count(Question.id))
+                    .group_by(Question.category)
+                    .all())
+        self._categories = {int(category): count
+                            for category, count in rows
+                            if category is not None}
+        self._others = sum(count for category, count in rows
+                           if category is None)
+        self._loaded_at = time.monotonic()
+        self.recounts += 1
+
+    def _counters(self):
+        if (self._categories is None or
+                time.monotonic() - self._loaded_at > self.max_age):
+            self._load()
+        else:
+            self.hits += 1
+        return self._categories
+
+    def total(self):
+        """Return the number of questions"""
+        if self.mode == 'estimate':
+            estimate = self.estimate()
+            if estimate is not None:
+                return estimate
+        if self.id_index is not None:
+            return self.id_index.count()
+        with self._lock:
+            return sum(self._counters().values()) + self._others
+
+    def by_category(self, category):
+        """Return the number of questions of 'category'"""
+        if self.id_index is not None:
+            return self.id_index.count(int(category))
+        with self._lock:
+            return self._counters().get(int(category), 0)
+
+    @staticmethod
+    def estimate():
+        """
+        Return the planner estimate of the number of questions, or None if
+        it is not available (not PostgreSQL, or table never analyzed).
+        """
+        if db.engine.dialect.name != 'postgresql':
+            return None
+        estimate = db.session.execute(text(
+            "SELECT reltuples::bigint FROM pg_class "
+            "WHERE oid = 'questions'::regclass")).scalar()
+        if estimate is None or estimate < 0:
+            return None
+        return estimate
+
+    def search_count(self, key):
+        """Return the remembered count of the search 'key', or None"""
+        with self._lock:
+            entry = self._searches.get(key)
+            if entry is None:
+                return None
+            count, expires = entry
+            if expires < time.monotonic():
+                del self._searches[key]
+                return None
+            self._searches.move_to_end(key)
+            return count
+
+    def remember_search(self, key, count):
+        """Remember the count of the search 'key'"""
+        with self._lock:
+            self._searches[key] = (count, time.monotonic() + self.search_ttl)
+            self._searches.move_to_end(key)
+            while len(self._searches) > self.search_size:
+                self._searches.popitem(last=False)
+
+    def on_question_change(self, action, question):
+        with self._lock:
+            self._searches.clear()
+            if self._categories is None:
+                return
+            if action in ('update', 'bulk') or question.category is None:
+                # the category may have changed: recount on next use
+                self._categories = None
+                return
+            category = int(question.category)
+            delta = 1 if action == 'insert' else -1
+            self._categories[category] = (
+                self._categories.get(category, 0) + delta)
+
+
+question_counter = QuestionCounter()
+
+
+def setup_counts(app, id_index=None):
+    """
+    Configure the question counter from the settings 'COUNT_MODE' ('exact'
+    or 'estimate'), 'COUNT_MAX_AGE' and 'SEARCH_COUNT_TTL' (seconds), or
+    the matching 'TRIVIA_*' environment variables, and return it. The
+    counts are read from 'id_index' if it is given and enabled.
+    """
+    question_counter.id_index = (id_index if id_index is not None and
+                                 id_index.enabled else None)
+    question_counter.mode = app.config.get(
+        'COUNT_MODE', os.environ.get('TRIVIA_COUNT_MODE', 'exact'))
+    question_counter.max_age = float(app.config.get(
+        'COUNT_MAX_AGE', os.environ.get('TRIVIA_COUNT_MAX_AGE', 60)))
+    question_counter.search_ttl = float(app.config.get(
+        'SEARCH_COUNT_TTL', os.environ.get('TRIVIA_SEARCH_COUNT_TTL', 30)))
+    question_counter.reset()
+    return question_counter
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+# settings read by engine_options(), with their type
+POOL_SETTINGS = {
+    'DB_POOL_SIZE': int,
+    'DB_MAX_OVERFLOW': int,
+    'DB_POOL_TIMEOUT': float,
+    'DB_POOL_RECYCLE': int,
+    'DB_POOL_PRE_PING': lambda value: (
+        str(value).lower() in ('1', 'true', 'yes', 'on')),
+    'DB_STATEMENT_TIMEOUT': int,
+    'DB_POOLING': str
+}
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    MeteredQueuePool
+        a QueuePool that measures how long checkouts wait for a connection,
+        and how many of them time out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _timed(self, checkout):
+        start = time.perf_counter()
+        try:
+            return checkout()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += wait
+                self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def connect(self):
+        return self._timed(super().connect)
+
+    def unique_connection(self):
+        return self._timed(super().unique_connection)
+
+
+def get_setting(app, name):
+    """
+    Return the setting 'name' from the app config or from the environment
+    variable 'TRIVIA_<name>', converted to its type, or None if not set
+    """
+    value = app.config.get(name, os.environ.get(f'TRIVIA_{name}'))
+    if value is None or value == '':
+        return None
+    return POOL_SETTINGS[name](value)
+
+
+def engine_options(app, database_path):
+    """
+    Return the SQLAlchemy engine options built from the pool settings:
+    - DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds),
+      DB_POOL_RECYCLE (seconds), DB_POOL_PRE_PING (true/false)
+    - DB_STATEMENT_TIMEOUT (milliseconds, PostgreSQL only)
+    - DB_POOLING: 'queue' (default) keeps a pool of connections in each
+      process; 'null' opens a connection per checkout, for a PgBouncer in
+      transaction pooling mode, which does the pooling itself. The
+      statement timeout is not set then: PgBouncer rejects the startup
+      parameter carrying it, it is set on the PgBouncer/PostgreSQL side.
+    An in-memory SQLite database ('sqlite://') only lives as long as its
+    connection: all the threads share a single one.
+    """
+    options = {}
+    url = make_url(database_path)
+    pre_ping = get_setting(app, 'DB_POOL_PRE_PING')
+    if pre_ping is not None:
+        options['pool_pre_ping'] = pre_ping
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            options['poolclass'] = StaticPool
+            options['connect_args'] = {'check_same_thread': False}
+        # otherwise the pool is chosen by Flask-SQLAlchemy
+        return options
+    statement_timeout = get_setting(app, 'DB_STATEMENT_TIMEOUT')
+    if get_setting(app, 'DB_POOLING') == 'null':
+        options['poolclass'] = NullPool
+        if statement_timeout is not None:
+            app.logger.warning(
+                'DB_STATEMENT_TIMEOUT is ignored with DB_POOLING=null: set '
+                'statement_timeout on the PgBouncer/PostgreSQL side')
+        return options
+    options['poolclass'] = MeteredQueuePool
+    for setting, option in (('DB_POOL_SIZE', 'pool_size'),
+                            ('DB_MAX_OVERFLOW', 'max_overflow'),
+                            ('DB_POOL_TIMEOUT', 'pool_timeout'),
+                            ('DB_POOL_RECYCLE', 'pool_recycle')):
+        value = get_setting(app, setting)
+        if value is not None:
+            options[option] = value
+    if (statement_timeout is not None and
+            url.get_backend_name() == 'postgresql'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={statement_timeout}'
+        }
+    return options
+
+
+def pool_status(engine):
+    """Return the state and checkout statistics of the engine's pool"""
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    if isinstance(pool, MeteredQueuePool):
+        with pool._stats_lock:
+            status.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_seconds_total': pool.wait_seconds_total,
+                'wait_seconds_max': pool.wait_seconds_max
+            })
+    return status
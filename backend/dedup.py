@@ -0,0 +1,184 @@
+import random
+import zlib
+
+from sqlalchemy import Table, Column, Index, Integer, BigInteger, MetaData
+from sqlalchemy import select, and_
+
+from models import db, Question, normalize_question_text, question_fingerprint
+from models import notify_question_change
+
+# questions read, or pairs verified, per query
+DEDUP_CHUNK_SIZE = 1000
+# length of the character shingles compared
+SHINGLE_SIZE = 4
+# modulus of the MinHash permutations (a Mersenne prime)
+PRIME = (1 << 61) - 1
+
+
+def fill_fingerprints(batch_size=DEDUP_CHUNK_SIZE):
+    """
+    Set the fingerprint of the questions which have none (inserted before
+    the column existed), 'batch_size' per transaction. Return their number.
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        rows = (db.session.query(Question.id, Question.question)
+                .filter(Question.fingerprint.is_(None),
+                        Question.id > last_id)
+                .order_by(Question.id)
+                .limit(batch_size)
+                .all())
+        if not rows:
+            return filled
+        db.session.bulk_update_mappings(Question, [
+            {'id': question_id, 'fingerprint': question_fingerprint(text)}
+            for question_id, text in rows])
+        db.session.commit()
+        filled += len(rows)
+        last_id = rows[-1][0]
+
+
+def shingles(text):
+    """Return the set of the SHINGLE_SIZE characters of normalized 'text'"""
+    text = normalize_question_text(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[start:start + SHINGLE_SIZE]
+            for start in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(first, second):
+    """Return the Jaccard similarity of the sets 'first' and 'second'"""
+    return len(first & second) / len(first | second)
+
+
+class MinHasher:
+    """
+    MinHasher
+        computes the MinHash signature of a set of shingles with 'num_perm'
+        random permutations (a * h + b) mod PRIME of their CRC32, and cuts
+        it in 'bands' bands: two sets of Jaccard similarity s share at
+        least one band with probability 1 - (1 - s ** rows) ** bands.
+    """
+
+    def __init__(self, num_perm=48, bands=8, seed=1):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        generator = random.Random(seed)
+        self.permutations = [(generator.randrange(1, PRIME),
+                              generator.randrange(0, PRIME))
+                             for _ in range(num_perm)]
+        self.bands = bands
+        self.rows = num_perm // bands
+
+    def signature(self, shingle_set):
+        hashes = [zlib.crc32(shingle.encode()) for shingle in shingle_set]
+        return [min((a * h + b) % PRIME for h in hashes)
+                for a, b in self.permutations]
+
+    def band_hashes(self, shingle_set):
+        """Yield (band, bucket) for each band of the set's signature"""
+        signature = self.signature(shingle_set)
+        for band in range(self.bands):
+            start = band * self.rows
+            yield band, hash(tuple(signature[start:start + self.rows]))
+
+
+def verify(connection, pairs, threshold):
+    """
+    Yield (id, duplicate id, similarity) for the 'pairs' of question ids
+    whose similarity is at least 'threshold'
+    """
+    questions = Question.__table__
+    ids = {question_id for pair in pairs for question_id in pair}
+    shingle_sets = {
+        question_id: shingles(text)
+        for question_id, text in connection.execute(
+            select([questions.c.id, questions.c.question])
+            .where(questions.c.id.in_(ids)))}
+    for question_id, duplicate_id in pairs:
+        similarity = jaccard(shingle_sets[question_id],
+                             shingle_sets[duplicate_id])
+        if similarity >= threshold:
+            yield question_id, duplicate_id, round(similarity, 3)
+
+
+def find_near_duplicates(threshold=0.8, num_perm=48, bands=8,
+                         chunk_size=DEDUP_CHUNK_SIZE):
+    """
+    Yield (id, duplicate id, similarity) for the pairs of questions whose
+    shingles (see shingles) have a Jaccard similarity of at least
+    'threshold', the duplicate being the most recent one.
+
+    The questions are read 'chunk_size' at a time and only the MinHash band
+    buckets of each (see MinHasher) are kept, in a temporary table: the
+    candidate pairs are the questions sharing a bucket, streamed from the
+    database, and their exact similarity is checked a chunk of pairs at a
+    time, so the memory used does not grow with the bank.
+    """
+    hasher = MinHasher(num_perm=num_perm, bands=bands)
+    buckets = Table('dedup_buckets', MetaData(),
+                    Column('band', Integer, nullable=False),
+                    Column('bucket', BigInteger, nullable=False),
+                    Column('question_id', Integer, nullable=False),
+                    prefixes=['TEMPORARY'])
+    questions = Question.__table__
+    with db.engine.connect() as connection:
+        buckets.create(connection)
+        try:
+            last_id = 0
+            while True:
+                rows = connection.execute(
+                    select([questions.c.id, questions.c.question])
+                    .where(questions.c.id > last_id)
+                    .order_by(questions.c.id)
+                    .limit(chunk_size)).fetchall()
+                if not rows:
+                    break
+                connection.execute(buckets.insert(), [
+                    {'band': band, 'bucket': bucket, 'question_id': row.id}
+                    for row in rows
+                    for band, bucket in hasher.band_hashes(
+                        shingles(row.question))])
+                last_id = rows[-1].id
+            Index('ix_dedup_buckets', buckets.c.band, buckets.c.bucket,
+                  buckets.c.question_id).create(connection)
+            first = buckets.alias('first')
+            second = buckets.alias('second')
+            candidates = (
+                select([first.c.question_id, second.c.question_id])
+                .select_from(first.join(second, and_(
+                    first.c.band == second.c.band,
+                    first.c.bucket == second.c.bucket,
+                    first.c.question_id < second.c.question_id)))
+                .distinct()
+                .order_by(first.c.question_id, second.c.question_id))
+            # a server-side cursor: the pairs are never all in memory; the
+            # texts are read on another connection meanwhile
+            pairs = (connection.execution_options(stream_results=True)
+                     .execute(candidates))
+            try:
+                with db.engine.connect() as texts_connection:
+                    while True:
+                        chunk = pairs.fetchmany(chunk_size)
+                        if not chunk:
+                            break
+                        yield from verify(texts_connection, chunk, threshold)
+            finally:
+                pairs.close()
+        finally:
+            buckets.drop(connection)
+
+
+def delete_questions(question_ids, batch_size=DEDUP_CHUNK_SIZE):
+    """Delete the questions of 'question_ids', 'batch_size' per transaction"""
+    question_ids = sorted(question_ids)
+    for start in range(0, len(question_ids), batch_size):
+        (Question.query
+         .filter(Question.id.in_(question_ids[start:start + batch_size]))
+         .delete(synchronize_session=False))
+        db.session.commit()
+    if question_ids:
+        notify_question_change('bulk', None)
+    return len(question_ids)
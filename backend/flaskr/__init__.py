@@ -1,24 +1,276 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import binascii
+import queue
+import random
+from functools import wraps
+from flask import Flask, request, abort, jsonify, url_for, g
+from flask import Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
-from models import category_fetch_all, format_list_items, question_fetch_page
-from models import question_count, questions_list_categories
-from models import question_fetch_page_by_category, question_count_by_category
-
-import random
+from models import setup_db, db, Question, QuestionStats
+from models import category_fetch_all, category_get_type
+from models import questions_list_categories, QUESTION_FIELDS
+from models import table_versions, category_cache, use_replicas
+from models import question_fetch_duplicate
+from replicas import replica_router
+from search import setup_search
+from counts import setup_counts
+from id_index import setup_id_index
+from quiz_sessions import setup_quiz_sessions
+from write_queue import setup_write_queue
+from quiz_engine import setup_quiz_engine
+from results import RESULTS_MAX, LEADERBOARD_MAX
+from results import record_results, leaderboard
+from db_pool import pool_status
+from bulk import PARSERS, IMPORT_BATCH_SIZE
+from bulk import import_questions, export_questions
+from .cli import trivia_cli
+from .http_cache import setup_http_cache
+from .metrics import setup_metrics
+from .jsonio import setup_json
+from .compression import setup_compression
+from .admission import setup_rate_limits, setup_concurrency_limit
 
 QUESTIONS_PER_PAGE = 10
+# most questions a single 'POST /quizzes' may return
+QUIZ_BATCH_MAX = 50
+
+
+def count_pages(q_count):
+    """Return the number of pages needed to list 'q_count' questions"""
+    return (
+        q_count // QUESTIONS_PER_PAGE +
+        (1 if q_count % QUESTIONS_PER_PAGE > 0 else 0)
+    )
+
+
+def encode_cursor(question_id):
+    """Return an opaque cursor pointing right after 'question_id'"""
+    return base64.urlsafe_b64encode(f'id:{question_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the question id encoded in 'cursor', or None if invalid"""
+    try:
+        kind, question_id = (base64.urlsafe_b64decode(cursor.encode())
+                             .decode().split(':'))
+        if kind != 'id':
+            return None
+        return int(question_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+
+
+def get_after_id():
+    """
+    Return the id after which the requested page starts if the client asked
+    for cursor pagination ('cursor' or 'after_id' argument), None otherwise.
+    """
+    if 'cursor' in request.args:
+        after_id = decode_cursor(request.args['cursor'])
+    elif 'after_id' in request.args:
+        after_id = request.args.get('after_id', type=int)
+    else:
+        return None
+    if after_id is None:
+        abort(400)
+    return after_id
+
+
+def fetch_questions(fetch, page, after_id, total, **kwargs):
+    """
+    Return one page of questions using 'fetch', and the cursor of the
+    following page (None if there is nothing after it). In page mode,
+    'total' (the number of questions listed) tells whether it is the last.
+    """
+    if after_id is None:
+        questions = fetch(page=page, **kwargs)
+        has_more = (len(questions) == QUESTIONS_PER_PAGE and
+                    page * QUESTIONS_PER_PAGE < total)
+    else:
+        questions = fetch(pagesize=QUESTIONS_PER_PAGE + 1,
+                          after_id=after_id, **kwargs)
+        has_more = len(questions) > QUESTIONS_PER_PAGE
+        questions = questions[:QUESTIONS_PER_PAGE]
+    next_cursor = encode_cursor(questions[-1]['id']) if has_more else None
+    return questions, next_cursor
+
+
+def replica_reads(view):
+    """
+    Decorate a view whose reads may go to the read replicas (see
+    models.use_replicas)
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replicas()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def is_compact():
+    """Return True if the client asked for compact listings ('compact')"""
+    return request.args.get('compact', 'false').lower() in (
+        '1', 'true', 'yes', 'on')
+
+
+def to_columns(questions):
+    """
+    Return 'questions' as one list per field, as sent in compact mode:
+    the field names are not repeated for every question
+    """
+    return {field: [question[field] for question in questions]
+            for field in QUESTION_FIELDS}
+
+
+def get_quiz_results(data):
+    """
+    Return the (question id, correct) pairs of the 'results' of the quiz
+    results request 'data', a list of {'question_id', 'correct'}
+    """
+    results = data.get('results')
+    if not isinstance(results, list) or not 0 < len(results) <= RESULTS_MAX:
+        abort(400)
+    pairs = []
+    for result in results:
+        if (not isinstance(result, dict) or
+                not isinstance(result.get('question_id'), int) or
+                not isinstance(result.get('correct'), bool)):
+            abort(400)
+        pairs.append((result['question_id'], result['correct']))
+    return pairs
+
+
+def get_quiz_category(data):
+    """
+    Return the id of the category of the quiz request 'data'
+    ('quiz_category', id 0 for all categories)
+    """
+    category = data.get('quiz_category')
+    if not isinstance(category, dict) or 'id' not in category:
+        abort(400)
+    try:
+        return int(category['id'])
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def get_batch_size(data):
+    """
+    Return the number of questions asked by the quiz request 'data' ('n'),
+    None if it asks for a single question
+    """
+    if 'n' not in data:
+        return None
+    try:
+        n = int(data['n'])
+    except (TypeError, ValueError):
+        abort(400)
+    if not 1 <= n <= QUIZ_BATCH_MAX:
+        abort(400)
+    return n
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    search = setup_search(app)
+    id_index = setup_id_index(app)
+    counts = setup_counts(app, id_index)
+    quiz_sessions = setup_quiz_sessions(app)
+    write_queue = setup_write_queue(app)
+    quiz_engine = setup_quiz_engine(app, id_index)
+    http_cache = setup_http_cache(app, table_versions)
+    metrics = setup_metrics(app, db.Model)
+    json_response = setup_json(app)
+    compressor = setup_compression(app)
+    rate_limiter = setup_rate_limits(app)
+    concurrency_limiter = setup_concurrency_limit(app)
+
+    @metrics.register_collector
+    def collect_cache_metrics():
+        pool = pool_status(db.engine)
+        shared = (None if http_cache.shared is None
+                  else http_cache.shared.stats())
+        return [
+            ('trivia_category_cache_total', 'counter',
+             'Category cache lookups',
+             [({'result': 'hit'}, category_cache.hits),
+              ({'result': 'miss'}, category_cache.misses)]),
+            ('trivia_http_cache_total', 'counter',
+             'Response cache lookups',
+             [({'result': 'hit'}, http_cache.hits),
+              ({'result': 'miss'}, http_cache.misses),
+              ({'result': 'not_modified'}, http_cache.not_modified)]),
+            ('trivia_shared_cache_total', 'counter',
+             'Shared response cache operations of this worker',
+             [({'result': 'hit'}, shared['hits']),
+              ({'result': 'miss'}, shared['misses']),
+              ({'result': 'store'}, shared['stores']),
+              ({'result': 'eviction'}, shared['evictions']),
+              ({'result': 'too_large'}, shared['too_large'])]
+             if shared is not None else []),
+            ('trivia_id_index_total', 'counter',
+             'Question id index lookups',
+             [({'result': 'hit'}, id_index.hits),
+              ({'result': 'rebuild'}, id_index.rebuilds)]),
+            ('trivia_response_bytes_total', 'counter',
+             'Bytes of the compressed response bodies',
+             [({'stage': 'uncompressed'}, compressor.bytes_in),
+              ({'stage': 'compressed'}, compressor.bytes_out)]),
+            ('trivia_question_counts_total', 'counter',
+             'Question count lookups',
+             [({'result': 'hit'}, counts.hits),
+              ({'result': 'recount'}, counts.recounts)]),
+            ('trivia_replica_reads_total', 'counter',
+             'Reads routed to each read replica',
+             [({'replica': str(number)}, replica.reads)
+              for number, replica in enumerate(replica_router.replicas)]),
+            ('trivia_replica_healthy', 'gauge',
+             'Whether each read replica is healthy',
+             [({'replica': str(number)}, int(replica.healthy))
+              for number, replica in enumerate(replica_router.replicas)]),
+            ('trivia_replica_failovers_total', 'counter',
+             'Reads sent to the primary because no replica was healthy',
+             [({}, replica_router.failovers)]
+             if replica_router.replicas else []),
+            ('trivia_db_pool_connections', 'gauge',
+             'Database connections of this worker',
+             [({'state': state}, pool[state])
+              for state in ('checked_out', 'checked_in', 'overflow')
+              if state in pool]),
+            ('trivia_db_pool_wait_seconds_total', 'counter',
+             'Time spent waiting for a database connection',
+             [({}, pool['wait_seconds_total'])]
+             if 'wait_seconds_total' in pool else [])
+        ] + ([] if rate_limiter is None else [
+            ('trivia_rate_limited_total', 'counter',
+             'Requests refused with a 429 by the rate limits',
+             [({'endpoint': endpoint}, limited)
+              for endpoint, limited in rate_limiter.limited.items()])
+        ]) + ([] if concurrency_limiter is None else [
+            ('trivia_requests_in_flight', 'gauge',
+             'Requests of this worker being handled',
+             [({}, concurrency_limiter.in_flight)]),
+            ('trivia_requests_shed_total', 'counter',
+             'Requests refused with a 503 by the concurrency limit',
+             [({}, concurrency_limiter.shed)])
+        ]) + ([] if write_queue is None else [
+            ('trivia_write_queue_pending', 'gauge',
+             'Question writes waiting to be committed',
+             [({}, write_queue.pending())]),
+            ('trivia_write_jobs_total', 'counter',
+             'Queued question writes processed',
+             [({'status': 'done'}, write_queue.committed),
+              ({'status': 'failed'}, write_queue.failed)])
+        ])
     CORS(app)
+    app.cli.add_command(trivia_cli)
 
     @app.after_request
     def after_request(response):
@@ -33,49 +285,107 @@ def create_app(test_config=None):
                              'GET,PATCH,POST,DELETE,OPTIONS')
         return response
 
+    def list_response(payload, with_categories=True):
+        """
+        Return the response of a question listing: 'payload' with the
+        categories if 'with_categories'. In compact mode, the questions are
+        sent as columns (see to_columns), and the categories only when the
+        client's 'categories_version' is not the current one.
+        """
+        if not is_compact():
+            if with_categories:
+                payload['categories'] = category_fetch_all()
+            return json_response(payload)
+        if with_categories:
+            version = table_versions.tag('categories')
+            if request.args.get('categories_version') != version:
+                payload['categories'] = category_fetch_all()
+            payload['categories_version'] = version
+        payload['questions'] = to_columns(payload['questions'])
+        return json_response(payload)
+
     @app.route('/categories')
+    @http_cache.cached('categories')
+    @replica_reads
     def get_all_categories():
         """
         Return all available categories.
         """
         categories = category_fetch_all()
-        return jsonify({
+        return json_response({
             'success': True,
             'categories': categories
         })
 
     @app.route('/questions')
+    @http_cache.cached('questions', 'categories')
+    @replica_reads
     def get_questions():
         """
         Return a list of questions (max 10 questions per page),
         number of total questions, current category, categories.
         """
         page = request.args.get('page', 1, type=int)
-        q_count = question_count()
-        num_pages = (
-            q_count // QUESTIONS_PER_PAGE +
-            (1 if q_count % QUESTIONS_PER_PAGE > 0 else 0)
-        )
-        if 1 > page or page > num_pages:
+        after_id = get_after_id()
+        q_count = counts.total()
+        num_pages = count_pages(q_count)
+        if after_id is None and (1 > page or page > num_pages):
             abort(404)
-        questions = format_list_items(question_fetch_page(page=page))
+        questions, next_cursor = fetch_questions(id_index.fetch_page,
+                                                 page, after_id, q_count)
         categories = questions_list_categories(questions)
-        return jsonify({
+        return list_response({
             'success': True,
             'questions': questions,
             'total_questions': q_count,
             'current_category': categories,
-            'categories': category_fetch_all()
+            'next_cursor': next_cursor
+        })
+
+    def accept_write(submit, argument):
+        """
+        Queue a write (write-behind mode), and answer 202 with the job id
+        to poll, or 503 when the queue is full
+        """
+        try:
+            job_id = submit(argument)
+        except queue.Full:
+            abort(503)
+        response = jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'pending'
+        })
+        response.status_code = 202
+        response.headers['Location'] = url_for('get_write_job',
+                                               job_id=job_id)
+        return response
+
+    @app.route('/questions/jobs/<job_id>')
+    def get_write_job(job_id):
+        """
+        Return the status of a queued write: 'pending', 'done' (with the
+        id of the question inserted or deleted) or 'failed' (with the error)
+        """
+        job = None if write_queue is None else write_queue.status(job_id)
+        if job is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'job': job
         })
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
         """
         DELETE question using a question ID.
+        In write-behind mode the delete is queued (202 with a job id).
         """
         question = Question.query.get(question_id)
         if question is None:
             abort(404)
+        if write_queue is not None:
+            return accept_write(write_queue.submit_delete, question_id)
         try:
             question.delete()
             return jsonify({
@@ -92,34 +402,70 @@ def create_app(test_config=None):
         - Add a new question: requires the question and answer text, category,
           and difficulty score.
         - Search for questions (max 10 per page) for whom the search term is a
-          substring of the question.
+          substring of the question, or, depending on the search backend,
+          questions whose text or answer contain the words of the term.
+        In write-behind mode the insert is queued (202 with a job id).
+        A question already in the bank (same text once normalized, see
+        models.question_fingerprint) is rejected with a 409.
         """
         data = request.get_json()
         if 'searchTerm' in data:
             # This is a search request
+            use_replicas()
             page = request.args.get('page', 1, type=int)
+            after_id = get_after_id()
             search_term = data.get('searchTerm', '')
-            q_count = question_count(search_term)
-            num_pages = q_count // QUESTIONS_PER_PAGE + (
-                1 if q_count % QUESTIONS_PER_PAGE > 0 else 0)
-            if 1 > page or page > num_pages:
+            if after_id is None and page < 1:
                 abort(404)
-            questions = format_list_items(
-                question_fetch_page(search_term=search_term, page=page))
-            return jsonify({
+            count_key = search.normalize(search_term)
+            q_count = counts.search_count(count_key)
+            questions, total = search.search(
+                search_term, page=page,
+                pagesize=QUESTIONS_PER_PAGE + (0 if after_id is None else 1),
+                after_id=after_id, with_total=q_count is None)
+            if q_count is None:
+                q_count = total
+                counts.remember_search(count_key, q_count)
+            num_pages = count_pages(q_count)
+            if after_id is None and page > num_pages:
+                abort(404)
+            if after_id is None:
+                has_more = not search.ranked and page < num_pages
+            else:
+                has_more = len(questions) > QUESTIONS_PER_PAGE
+                questions = questions[:QUESTIONS_PER_PAGE]
+            next_cursor = (encode_cursor(questions[-1]['id']) if has_more
+                           else None)
+            return list_response({
                 'success': True,
                 'questions': questions,
                 'total_questions': q_count,
-                'categories': category_fetch_all()
+                'next_cursor': next_cursor
             })
         else:
             fields_names = ['question', 'answer', 'difficulty', 'category']
             if all((field in data) for field in fields_names):
                 # We want to insert a new question
-                question = Question(question=data.get('question', ''),
-                                    answer=data.get('answer', ''),
-                                    difficulty=int(data.get('difficulty', 1)),
-                                    category=int(data.get('category', 1)))
+                try:
+                    fields = {
+                        'question': data.get('question', ''),
+                        'answer': data.get('answer', ''),
+                        'difficulty': int(data.get('difficulty', 1)),
+                        'category': int(data.get('category', 1))
+                    }
+                except (TypeError, ValueError):
+                    abort(422)
+                duplicate_id = question_fetch_duplicate(fields['question'])
+                if duplicate_id is not None:
+                    return jsonify({
+                        'success': False,
+                        'error': 409,
+                        'message': 'Duplicate question',
+                        'duplicate_of': duplicate_id
+                    }), 409
+                if write_queue is not None:
+                    return accept_write(write_queue.submit_insert, fields)
+                question = Question(**fields)
                 try:
                     question.insert()
                     return jsonify({
@@ -130,50 +476,189 @@ def create_app(test_config=None):
                     abort(422)
             abort(400)
 
+    @app.route('/questions/import', methods=['POST'])
+    def bulk_import_questions():
+        """
+        Import questions in bulk from the request body, streamed as NDJSON
+        (default) or CSV ('format' argument), in batches of
+        'IMPORT_BATCH_SIZE' questions. Invalid rows and duplicates are
+        reported and skipped.
+        """
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in PARSERS:
+            abort(400)
+        report = import_questions(
+            PARSERS[fmt](request.stream),
+            batch_size=app.config.get('IMPORT_BATCH_SIZE', IMPORT_BATCH_SIZE))
+        return jsonify({
+            'success': True,
+            'inserted': report['inserted'],
+            'failed': report['failed'],
+            'duplicates': report['duplicates'],
+            'errors': report['errors']
+        })
+
+    @app.route('/questions/export')
+    def bulk_export_questions():
+        """
+        Stream all the questions as NDJSON (default) or CSV ('format'
+        argument)
+        """
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in PARSERS:
+            abort(400)
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(export_questions(fmt)),
+                        mimetype=mimetype)
+
     @app.route('/categories/<int:category_id>/questions')
+    @http_cache.cached('questions', 'categories')
+    @replica_reads
     def get_questions_by_category(category_id):
         """
         Get questions (max 10 per page) based on category.
         """
-        category = Category.query.get(category_id)
-        if category is None:
+        if category_get_type(category_id) is None:
             abort(404)
-        questions = question_fetch_page_by_category(category_id)
-        q_count = question_count_by_category(category_id)
-        return jsonify({
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404)
+        after_id = get_after_id()
+        q_count = counts.by_category(category_id)
+        questions, next_cursor = fetch_questions(
+            id_index.fetch_page, page, after_id, q_count,
+            category=category_id)
+        return list_response({
             'success': True,
-            'questions': format_list_items(questions),
+            'questions': questions,
             'total_questions': q_count,
-            'current_category': category_id
+            'current_category': category_id,
+            'next_cursor': next_cursor
+        }, with_categories=False)
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        """
+        Start a quiz session: the questions of the given category (all
+        categories if its id is 0) are shuffled once and kept on the server,
+        so the client only sends the session id to get each next question.
+        """
+        data = request.get_json()
+        category_id = get_quiz_category(data)
+        if category_id != 0:
+            if category_get_type(category_id) is None:
+                abort(404)
+            question_ids = id_index.ids(category=category_id)
+        else:
+            question_ids = id_index.ids()
+        random.shuffle(question_ids)
+        return jsonify({
+            'success': True,
+            'session_id': quiz_sessions.create(question_ids),
+            'total_questions': len(question_ids)
+        })
+
+    def play_quiz_session(session_id, n=None):
+        """
+        Return the next question of the quiz session 'session_id', or its
+        next 'n' questions if given
+        """
+        if n is not None:
+            questions = []
+            while len(questions) < n:
+                try:
+                    question_ids = quiz_sessions.pop_many(
+                        session_id, n - len(questions))
+                except KeyError:
+                    abort(404)
+                if not question_ids:
+                    break
+                found = {question.id: question for question in
+                         Question.query.filter(Question.id.in_(question_ids))}
+                # skip the questions deleted since the session started
+                questions.extend(found[question_id]
+                                 for question_id in question_ids
+                                 if question_id in found)
+            return jsonify({
+                'success': True,
+                'session_id': session_id,
+                'questions': [question.format() for question in questions]
+            })
+        while True:
+            try:
+                question_id = quiz_sessions.pop(session_id)
+            except KeyError:
+                abort(404)
+            if question_id is None:
+                question = None
+                break
+            question = Question.query.get(question_id)
+            if question is not None:
+                break
+            # the question was deleted since the session started
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'question': None if question is None else question.format()
         })
 
     @app.route('/quizzes', methods=['POST'])
+    @replica_reads
     def play_quiz():
         """
         Get questions to play the quiz.
         This endpoint should take category and previous question parameters
         and return a random questions within the given category,
         if provided, and that is not one of the previous questions.
+        Alternatively, it takes the id of a quiz session.
+        With 'n', it returns 'n' distinct questions at once ('questions').
+        With 'answers', the results (true if correct) of the previous
+        answers, the question is chosen by difficulty (see quiz_engine.py).
         """
         data = request.get_json()
+        n = get_batch_size(data)
+        if 'session_id' in data:
+            if not isinstance(data['session_id'], str):
+                abort(400)
+            return play_quiz_session(data['session_id'], n)
         fields_names = ['previous_questions', 'quiz_category']
         if not all(field in data for field in fields_names):
             abort(400)
         if 'id' not in data['quiz_category']:
             abort(400)
         category_id = int(data['quiz_category']['id'])
+        if category_id != 0 and category_get_type(category_id) is None:
+            abort(404)
+        if 'answers' in data:
+            answers = data['answers']
+            if (n is not None or not isinstance(answers, list) or
+                    not all(isinstance(answer, bool) for answer in answers)):
+                abort(400)
+            question, difficulty = quiz_engine.pick(
+                answers, category=category_id or None,
+                exclude=data['previous_questions'])
+            return jsonify({
+                'success': True,
+                'question': None if question is None else question.format(),
+                'difficulty': difficulty
+            })
+        if n is not None:
+            questions = id_index.fetch_sample(
+                n, category=category_id or None,
+                exclude=data['previous_questions'],
+                total=(counts.by_category(category_id) if category_id
+                       else counts.total()))
+            return jsonify({
+                'success': True,
+                'questions': [question.format() for question in questions]
+            })
         if category_id != 0:
-            category = Category.query.get(category_id)
-            if category is None:
-                abort(404)
-            questions = Question.query.filter(
-                Question.category == category_id).all()
+            question = id_index.fetch_random(
+                category=category_id, exclude=data['previous_questions'])
         else:
-            questions = Question.query.all()
-        candidates = [question for question in questions if
-                      question.id not in data['previous_questions']]
-        if len(candidates) > 0:
-            question = random.choice(candidates)
+            question = id_index.fetch_random(
+                exclude=data['previous_questions'])
+        if question is not None:
             return jsonify({
                 'success': True,
                 'question': question.format()
@@ -184,9 +669,89 @@ def create_app(test_config=None):
                 'question': None
             })
 
+    @app.route('/quizzes/results', methods=['POST'])
+    def record_quiz_results():
+        """
+        Record the results of a quiz: the name of the player ('player'),
+        the category played ('quiz_category', id 0 for all) and whether
+        each question was answered correctly ('results'). Return the
+        player's score in that category.
+        """
+        data = request.get_json()
+        player = data.get('player')
+        if not isinstance(player, str) or not 0 < len(player.strip()) <= 80:
+            abort(400)
+        category_id = get_quiz_category(data)
+        results = get_quiz_results(data)
+        if category_id != 0 and category_get_type(category_id) is None:
+            abort(404)
+        question_ids = {question_id for question_id, _ in results}
+        if Question.query.filter(
+                Question.id.in_(question_ids)).count() < len(question_ids):
+            abort(422)
+        score = record_results(player.strip(), category_id, results)
+        response = jsonify({
+            'success': True,
+            'category': category_id,
+            **score.format()
+        })
+        response.status_code = 201
+        return response
+
+    @app.route('/leaderboard')
+    @http_cache.cached('results', 'categories')
+    @replica_reads
+    def get_leaderboard():
+        """
+        Return the best players of a category ('category', 0 for all, the
+        default), 'limit' (default 10) of them, best first
+        """
+        category_id = request.args.get('category', 0, type=int)
+        limit = request.args.get('limit', 10, type=int)
+        if not 1 <= limit <= LEADERBOARD_MAX:
+            abort(400)
+        if category_id != 0 and category_get_type(category_id) is None:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'category': category_id,
+            'leaderboard': leaderboard(category_id, limit)
+        })
+
+    @app.route('/questions/<int:question_id>/stats')
+    @http_cache.cached('questions', 'results')
+    @replica_reads
+    def get_question_stats(question_id):
+        """
+        Return how many times a question was answered, and correctly, and
+        its current difficulty
+        """
+        question = Question.query.get(question_id)
+        if question is None:
+            abort(404)
+        stats = (QuestionStats.query.get(question_id) or
+                 QuestionStats(question_id=question_id, answers=0,
+                               correct=0))
+        return jsonify({
+            'success': True,
+            'stats': dict(stats.format(), difficulty=question.difficulty)
+        })
+
+    @app.route('/metrics/pool')
+    def get_pool_metrics():
+        """
+        Return the state of the database connection pool of this worker:
+        connections in use, idle and in overflow, and how long checkouts
+        waited for a connection.
+        """
+        return jsonify({
+            'success': True,
+            'pool': pool_status(db.engine)
+        })
+
     # '''
     # Errors handlers for all expected errors
-    # including 400, 404, 405 and 422.
+    # including 400, 404, 405, 422, 429 and 503.
     # '''
     @app.errorhandler(400)
     def error_bad_request(error):
@@ -220,4 +785,20 @@ def create_app(test_config=None):
             'message': 'Unprocessable entity'
         }), 422
 
+    @app.errorhandler(429)
+    def error_too_many_requests(error):
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too many requests'
+        }), 429, {'Retry-After': str(g.get('retry_after', 1))}
+
+    @app.errorhandler(503)
+    def error_unavailable(error):
+        return jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'Service unavailable'
+        }), 503, {'Retry-After': '1'}
+
     return app
@@ -0,0 +1,266 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import abort, g, request
+
+# endpoints never limited: monitoring must keep working under load
+EXEMPT_ENDPOINTS = ('get_metrics', 'get_pool_metrics', 'static')
+# where Linux tells the boots of the host apart
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+
+def boot_id():
+    """Return the id of the current boot of the host, b'' if unknown"""
+    try:
+        with open(BOOT_ID_PATH) as file:
+            return uuid.UUID(file.read().strip()).bytes
+    except (OSError, ValueError):
+        return b''
+
+
+class TokenBuckets:
+    """
+    TokenBuckets
+        one token bucket per key (e.g. per client and endpoint), in a table
+        of 'slots' fixed slots: in memory, or in the memory-mapped file
+        'path' when set, so that all the worker processes of a host draw
+        from the same buckets.
+
+        A key can only go in the WAYS slots of the set its hash points to;
+        a new key takes the slot of the set updated least recently. That
+        bucket has had the most time to refill, so forgetting it at worst
+        gives a full bucket back to a client that was already idle.
+
+        The update times come from the monotonic clock, which restarts
+        with the host: the file records the boot it was written during
+        (see boot_id), and starts empty after a reboot.
+    """
+    MAGIC = b'TRVLIMIT'
+    # magic, slots, boot id
+    HEADER = struct.Struct('<8sI16s')
+    # key digest, tokens, last update (monotonic ns)
+    SLOT = struct.Struct('<8sdQ')
+    WAYS = 4
+
+    def __init__(self, path=None, slots=4096):
+        self.path = path
+        self.slots = max(self.WAYS, slots // self.WAYS * self.WAYS)
+        self._lock = threading.Lock()
+        length = self.HEADER.size + self.slots * self.SLOT.size
+        expected = self.HEADER.pack(self.MAGIC, self.slots, boot_id())
+        self._file = None
+        if path is None:
+            self._map = bytearray(length)
+            self._map[:self.HEADER.size] = expected
+            return
+        self._file = open(path, 'a+b')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.seek(0)
+            if self._file.read(self.HEADER.size) != expected:
+                # new file, laid out for other settings, or written
+                # before a reboot: start empty
+                self._file.truncate(0)
+                self._file.truncate(length)
+            self._map = mmap.mmap(self._file.fileno(), length)
+            self._map[:self.HEADER.size] = expected
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._map.close()
+                self._file.close()
+
+    def _set(self, key):
+        """Return the digest of 'key' and the offsets of its set's slots"""
+        digest = hashlib.sha1(key.encode()).digest()[:8]
+        first = (int.from_bytes(digest, 'little') %
+                 (self.slots // self.WAYS) * self.WAYS)
+        return digest, [self.HEADER.size + (first + way) * self.SLOT.size
+                        for way in range(self.WAYS)]
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Take 'cost' tokens from the bucket of 'key', which holds 'burst'
+        tokens at most and refills at 'rate' tokens per second. Return 0
+        if they were taken, else the seconds until they are available.
+        """
+        digest, offsets = self._set(key)
+        with self._lock:
+            if self._file is not None:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                now = time.monotonic_ns()
+                slots = [(offset, *self.SLOT.unpack_from(self._map, offset))
+                         for offset in offsets]
+                matches = [slot for slot in slots if slot[1] == digest]
+                if matches:
+                    victim, _, tokens, updated = matches[0]
+                    # never a negative refill, whatever the clock did
+                    elapsed = max(0, now - updated)
+                    tokens = min(burst, tokens + elapsed / 1e9 * rate)
+                else:
+                    victim = min(slots, key=lambda slot: slot[3])[0]
+                    tokens = burst
+                if tokens < cost:
+                    wait = (cost - tokens) / rate
+                else:
+                    tokens -= cost
+                    wait = 0
+                self.SLOT.pack_into(self._map, victim, digest, tokens, now)
+                return wait
+            finally:
+                if self._file is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+def parse_rate_limits(text):
+    """
+    Return the limits described by 'text', comma separated
+    'endpoint=requests/seconds[:burst]' (e.g. 'play_quiz=10/1:20'), as a
+    dict of endpoint: (tokens per second, burst). The burst defaults to
+    the number of requests.
+    """
+    limits = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        try:
+            endpoint, limit = item.split('=')
+            limit, _, burst = limit.partition(':')
+            requests, seconds = limit.split('/')
+            rate = int(requests) / float(seconds)
+            burst = float(burst) if burst else float(requests)
+        except ValueError:
+            raise ValueError(f'invalid rate limit {item.strip()!r}')
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'invalid rate limit {item.strip()!r}')
+        limits[endpoint.strip()] = (rate, burst)
+    return limits
+
+
+class RateLimiter:
+    """
+    RateLimiter
+        answers 429 (with 'Retry-After') to the requests of a client beyond
+        the rate allowed for the endpoint (see parse_rate_limits). Clients
+        are told apart by their 'X-API-Key' header when it is one of
+        'api_keys', by their address otherwise: keys nobody handed out would
+        give a bot as many buckets as it makes up.
+    """
+
+    def __init__(self, buckets, limits, api_keys=()):
+        self.buckets = buckets
+        self.limits = limits
+        self.api_keys = frozenset(api_keys)
+        self.limited = Counter()
+
+    def client(self):
+        api_key = request.headers.get('X-API-Key')
+        if api_key in self.api_keys:
+            return f'key:{api_key}'
+        return f'addr:{request.remote_addr}'
+
+    def before_request(self):
+        limit = self.limits.get(request.endpoint)
+        if limit is None:
+            return
+        wait = self.buckets.take(f'{request.endpoint}|{self.client()}', *limit)
+        if wait:
+            self.limited[request.endpoint] += 1
+            g.retry_after = math.ceil(wait)
+            abort(429)
+
+
+class ConcurrencyLimiter:
+    """
+    ConcurrencyLimiter
+        lets at most 'max_requests' requests of this worker run at once,
+        so that a burst can't take more database connections than the pool
+        holds. A request waits up to 'timeout' seconds for its turn, then
+        gets a 503: the load beyond capacity is shed, not queued.
+    """
+
+    def __init__(self, max_requests, timeout=0.0):
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_requests)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.shed = 0
+
+    def before_request(self):
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.shed += 1
+            abort(503)
+        g.admitted = True
+        with self._lock:
+            self.in_flight += 1
+
+    def teardown_request(self, exception):
+        if g.pop('admitted', False):
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+
+def setup_rate_limits(app):
+    """
+    Limit the request rate of each client on the endpoints listed in
+    'RATE_LIMITS' (see parse_rate_limits), the clients with one of the
+    'RATE_LIMIT_API_KEYS' (comma separated) being limited per key. The
+    buckets are shared by the worker processes through the file
+    'RATE_LIMIT_FILE' when set ('RATE_LIMIT_SLOTS' buckets). Each setting
+    can also come from the matching 'TRIVIA_*' environment variable.
+    Return the limiter, None if no endpoint is limited.
+    """
+    limits = parse_rate_limits(app.config.get(
+        'RATE_LIMITS', os.environ.get('TRIVIA_RATE_LIMITS', '')))
+    if not limits:
+        return None
+    buckets = TokenBuckets(
+        path=app.config.get('RATE_LIMIT_FILE',
+                            os.environ.get('TRIVIA_RATE_LIMIT_FILE')) or None,
+        slots=int(app.config.get(
+            'RATE_LIMIT_SLOTS',
+            os.environ.get('TRIVIA_RATE_LIMIT_SLOTS', 4096))))
+    api_keys = app.config.get(
+        'RATE_LIMIT_API_KEYS',
+        os.environ.get('TRIVIA_RATE_LIMIT_API_KEYS', ''))
+    limiter = RateLimiter(buckets, limits, api_keys=[
+        key.strip() for key in api_keys.split(',') if key.strip()])
+    app.before_request(limiter.before_request)
+    return limiter
+
+
+def setup_concurrency_limit(app):
+    """
+    Let at most 'MAX_CONCURRENT_REQUESTS' requests (env
+    'TRIVIA_MAX_CONCURRENT_REQUESTS', default 0: no limit) run at once in
+    this worker, the others waiting up to 'ADMISSION_TIMEOUT_MS' (default
+    100) before getting a 503. Return the limiter, None if unlimited.
+    """
+    max_requests = int(app.config.get(
+        'MAX_CONCURRENT_REQUESTS',
+        os.environ.get('TRIVIA_MAX_CONCURRENT_REQUESTS', 0)))
+    if max_requests <= 0:
+        return None
+    limiter = ConcurrencyLimiter(max_requests, timeout=float(app.config.get(
+        'ADMISSION_TIMEOUT_MS',
+        os.environ.get('TRIVIA_ADMISSION_TIMEOUT_MS', 100))) / 1000)
+    app.before_request(limiter.before_request)
+    app.teardown_request(limiter.teardown_request)
+    return limiter
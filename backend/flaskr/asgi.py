@@ -0,0 +1,171 @@
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import create_app
+
+# request bodies larger than this are spooled to a temporary file
+MAX_BODY_IN_MEMORY = 1024 * 1024
+# response chunks waiting to be sent, per request
+RESPONSE_QUEUE_SIZE = 8
+
+
+class WSGIBridge:
+    """
+    WSGIBridge
+        ASGI application serving a WSGI application (the Flask app) from a
+        bounded thread pool.
+
+        The event loop holds every client connection (keep-alive, slow
+        clients, uploads being received) without using a thread; a thread,
+        and so a database connection, is only taken while a request is
+        being handled. At most 'max_workers' requests are handled at once,
+        the others wait in the event loop rather than in the database.
+    """
+
+    def __init__(self, wsgi_app, max_workers=32):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='trivia')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body', False):
+                    break
+            body.seek(0)
+            environ = self.environ(scope, body)
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue(maxsize=RESPONSE_QUEUE_SIZE)
+            worker = loop.run_in_executor(self.executor, self.run_wsgi,
+                                          environ, loop, queue)
+            try:
+                while True:
+                    message = await queue.get()
+                    if message is None:
+                        break
+                    await send(message)
+            except Exception:
+                # the client went away: let the worker thread finish
+                while (await queue.get()) is not None:
+                    pass
+                raise
+            finally:
+                await worker
+        finally:
+            # also when the client left while sending the body, which may
+            # have been spooled to a temporary file
+            body.close()
+
+    def run_wsgi(self, environ, loop, queue):
+        """
+        Run the WSGI application in a worker thread, passing the ASGI
+        messages of the response to the event loop through 'queue'
+        """
+        def put(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message),
+                                             loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'),
+                                    value.encode('latin-1'))
+                                   for name, value in headers]
+            return lambda data: send_body(data)
+
+        def send_body(data):
+            if not response.get('started'):
+                response['started'] = True
+                put({'type': 'http.response.start',
+                     'status': response['status'],
+                     'headers': response['headers']})
+            if data:
+                put({'type': 'http.response.body', 'body': data,
+                     'more_body': True})
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                for data in iterable:
+                    send_body(data)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            send_body(b'')
+            put({'type': 'http.response.body', 'body': b'',
+                 'more_body': False})
+        finally:
+            put(None)
+
+    @staticmethod
+    def environ(scope, body):
+        """Return the WSGI environ of the ASGI request 'scope'"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            if name in environ:
+                # cookies have their own separator (RFC 6265)
+                separator = '; ' if name == 'HTTP_COOKIE' else ','
+                value = f'{environ[name]}{separator}{value}'
+            environ[name] = value
+        return environ
+
+
+def create_asgi_app(test_config=None):
+    """
+    Return the trivia API as an ASGI application, handling at most
+    'ASGI_THREADS' (env 'TRIVIA_ASGI_THREADS', default 32) requests at once.
+    Serve it with e.g.:
+        uvicorn --factory flaskr.asgi:create_asgi_app
+    """
+    app = create_app(test_config)
+    max_workers = int(app.config.get(
+        'ASGI_THREADS', os.environ.get('TRIVIA_ASGI_THREADS', 32)))
+    return WSGIBridge(app, max_workers=max_workers)
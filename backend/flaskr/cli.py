@@ -0,0 +1,92 @@
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import create_schema, QUESTIONS_PER_PAGE
+from search import setup_search
+from bulk import PARSERS, IMPORT_BATCH_SIZE
+from bulk import import_questions, export_questions
+from results import calibrate
+from dedup import fill_fingerprints, find_near_duplicates, delete_questions
+from publish import publish
+
+trivia_cli = AppGroup('trivia', help='Manage the trivia questions bank.')
+
+
+@trivia_cli.command('init-db')
+def init_db_command():
+    """Create the missing tables and indexes."""
+    create_schema()
+    filled = fill_fingerprints()
+    if filled:
+        click.echo(f'Fingerprinted {filled} questions.')
+    backend = setup_search(current_app)
+    if hasattr(backend, 'setup'):
+        backend.setup()
+    click.echo('Database schema is up to date.')
+
+
+@trivia_cli.command('import')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(sorted(PARSERS)),
+              default='ndjson', help='Format of FILE.')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE,
+              help='Number of questions inserted per transaction.')
+def import_command(file, fmt, batch_size):
+    """Import the questions of FILE ('-' for the standard input)."""
+    report = import_questions(PARSERS[fmt](file), batch_size=batch_size)
+    click.echo(json.dumps(report, indent=2))
+
+
+@trivia_cli.command('export')
+@click.argument('file', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(sorted(PARSERS)),
+              default='ndjson', help='Format of FILE.')
+def export_command(file, fmt):
+    """Export all the questions to FILE (default: the standard output)."""
+    for chunk in export_questions(fmt):
+        file.write(chunk)
+
+
+@trivia_cli.command('calibrate')
+@click.option('--min-answers', default=20,
+              help='Answers a question needs to be calibrated.')
+@click.option('--dry-run', is_flag=True,
+              help='Report the changes without making them.')
+def calibrate_command(min_answers, dry_run):
+    """Set the questions difficulty from their rate of correct answers."""
+    report = calibrate(min_answers=min_answers, dry_run=dry_run)
+    click.echo(json.dumps(report, indent=2))
+
+
+@trivia_cli.command('dedup')
+@click.option('--threshold', default=0.8,
+              help='Similarity from which two questions are duplicates.')
+@click.option('--delete', is_flag=True,
+              help='Delete the most recent question of each pair.')
+def dedup_command(threshold, delete):
+    """Find the near-duplicate questions, as NDJSON pairs."""
+    duplicate_ids = set()
+    pairs = 0
+    for question_id, duplicate_id, similarity in find_near_duplicates(
+            threshold=threshold):
+        click.echo(json.dumps({'id': question_id,
+                               'duplicate': duplicate_id,
+                               'similarity': similarity}))
+        duplicate_ids.add(duplicate_id)
+        pairs += 1
+    report = {'pairs': pairs, 'duplicates': len(duplicate_ids),
+              'deleted': delete_questions(duplicate_ids) if delete else 0}
+    click.echo(json.dumps(report), err=True)
+
+
+@trivia_cli.command('publish')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--page-size', default=QUESTIONS_PER_PAGE,
+              help='Questions per page.')
+def publish_command(directory, page_size):
+    """Render the questions into DIRECTORY as static JSON shards."""
+    report = publish(directory, page_size=page_size)
+    click.echo(json.dumps(report, indent=2))
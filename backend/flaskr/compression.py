@@ -0,0 +1,84 @@
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# mimetypes worth compressing ('text/*' too)
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson')
+
+
+class ResponseCompressor:
+    """
+    ResponseCompressor
+        compresses the response bodies of at least 'min_size' bytes with
+        the best encoding the client accepts ('Accept-Encoding'): brotli
+        (when the brotli package is installed) or gzip.
+
+        A compressed response gets a weak ETag, since its bytes differ from
+        the uncompressed ones; 'If-None-Match' is compared weakly, so the
+        client still gets its 304. Streamed responses (exports) are sent as
+        they are.
+    """
+
+    def __init__(self, min_size=512, gzip_level=6, brotli_quality=5):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = (['br'] if brotli is not None else []) + ['gzip']
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compressible(self, response):
+        mimetype = response.mimetype or ''
+        return (response.status_code == 200 and
+                not response.direct_passthrough and
+                not response.is_streamed and
+                'Content-Encoding' not in response.headers and
+                (mimetype in COMPRESSIBLE_TYPES or
+                 mimetype.startswith('text/')))
+
+    def compress(self, data, encoding):
+        """Return 'data' compressed with 'encoding' ('br' or 'gzip')"""
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level)
+
+    def after_request(self, response):
+        if self.min_size < 0 or not self.compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        body = self.compress(data, encoding)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(body)
+        return response
+
+
+def setup_compression(app):
+    """
+    Compress the responses of 'app' whose body has at least
+    'COMPRESS_MIN_SIZE' bytes (env 'TRIVIA_COMPRESS_MIN_SIZE', default 512,
+    -1 disables compression), and return the compressor.
+    """
+    compressor = ResponseCompressor(min_size=int(app.config.get(
+        'COMPRESS_MIN_SIZE',
+        os.environ.get('TRIVIA_COMPRESS_MIN_SIZE', 512))))
+    app.after_request(compressor.after_request)
+    return compressor
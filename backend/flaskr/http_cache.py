@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+from cache import SharedLRUCache
+
+
+class ResponseCache:
+    """
+    ResponseCache
+        HTTP caching of read endpoints. The ETag of a response is derived
+        from the request (path and arguments) and from the versions of the
+        tables it is built from, so it is known before running the view:
+        a request whose 'If-None-Match' matches gets a 304 without touching
+        the database. The serialized bodies of the last 'max_entries'
+        responses are also kept in memory (0 disables this), or, when
+        'shared' is set, in that SharedLRUCache, one copy for all the
+        worker processes.
+
+        Without a shared versions file (see VersionCounters), the versions
+        only count the writes of this process, and no version sees the
+        writes made outside the API: ETags and bodies then also change
+        every 'ttl' seconds, which bounds how stale a response gets, like
+        COUNT_MAX_AGE does for the counters. A 'ttl' of 0 turns the ETags
+        and the bodies cache off in that case.
+    """
+
+    def __init__(self, versions, max_entries=256, max_age=0, shared=None,
+                 ttl=60):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.shared = shared
+        self.ttl = ttl
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @property
+    def enabled(self):
+        """Whether the versions tell when a response changed"""
+        return self.versions.path is not None or self.ttl > 0
+
+    def etag(self, tables):
+        """Return the ETag of the current request's response"""
+        args = sorted(request.args.items(multi=True))
+        versions = [self.versions.get(table) for table in tables]
+        # wall clock: the same periods in all the processes
+        period = ('' if self.versions.path is not None
+                  else int(time.time() // self.ttl))
+        key = (f'{request.path}|{args}|{self.versions.epoch}|{versions}|'
+               f'{period}')
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def cache_control(self, response):
+        if self.max_age > 0:
+            response.headers['Cache-Control'] = \
+                f'public, max-age={self.max_age}'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def get_body(self, etag):
+        if self.shared is not None:
+            body = self.shared.get(etag)
+            with self._lock:
+                if body is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return body
+        with self._lock:
+            body = self._bodies.get(etag)
+            if body is None:
+                self.misses += 1
+                return None
+            self._bodies.move_to_end(etag)
+            self.hits += 1
+            return body
+
+    def store_body(self, etag, body):
+        if self.shared is not None:
+            self.shared.set(etag, body)
+            return
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._bodies[etag] = body
+            self._bodies.move_to_end(etag)
+            while len(self._bodies) > self.max_entries:
+                self._bodies.popitem(last=False)
+
+    def cached(self, *tables):
+        """
+        Decorate a view whose response only depends on the request and on
+        the content of 'tables'
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    response = view(*args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    return self.cache_control(response)
+                etag = self.etag(tables)
+                # weak comparison: compressed responses have weak ETags
+                if request.if_none_match.contains_weak(etag):
+                    self.not_modified += 1
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return self.cache_control(response)
+                body = self.get_body(etag)
+                if body is not None:
+                    response = Response(body, mimetype='application/json')
+                else:
+                    response = view(*args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    self.store_body(etag, response.get_data())
+                response.set_etag(etag)
+                return self.cache_control(response)
+            return wrapper
+        return decorator
+
+
+def setup_http_cache(app, versions):
+    """
+    Return the response cache configured by the settings 'HTTP_CACHE_SIZE'
+    (number of bodies kept in memory), 'HTTP_CACHE_MAX_AGE' (seconds
+    clients may reuse a response without revalidating it) and
+    'SHARED_CACHE_FILE' (file of the bodies cache shared by the worker
+    processes instead, of 'SHARED_CACHE_SIZE' bytes split in slots of
+    'SHARED_CACHE_SLOT_SIZE' bytes) and 'HTTP_CACHE_TTL' (seconds a
+    response is reused at most without 'TABLE_VERSIONS_FILE'), or the
+    matching 'TRIVIA_*' environment variables.
+    """
+    shared = None
+    path = app.config.get('SHARED_CACHE_FILE',
+                          os.environ.get('TRIVIA_SHARED_CACHE_FILE'))
+    if path:
+        if versions.path is None:
+            app.logger.warning(
+                'SHARED_CACHE_FILE without TABLE_VERSIONS_FILE: the worker '
+                'processes will not share the cached responses')
+        shared = SharedLRUCache(
+            path,
+            size=int(app.config.get(
+                'SHARED_CACHE_SIZE',
+                os.environ.get('TRIVIA_SHARED_CACHE_SIZE', 16 * 1024 * 1024))),
+            slot_size=int(app.config.get(
+                'SHARED_CACHE_SLOT_SIZE',
+                os.environ.get('TRIVIA_SHARED_CACHE_SLOT_SIZE', 16384))))
+    return ResponseCache(
+        versions,
+        max_entries=int(app.config.get(
+            'HTTP_CACHE_SIZE', os.environ.get('TRIVIA_HTTP_CACHE_SIZE', 256))),
+        max_age=int(app.config.get(
+            'HTTP_CACHE_MAX_AGE',
+            os.environ.get('TRIVIA_HTTP_CACHE_MAX_AGE', 0))),
+        shared=shared,
+        ttl=float(app.config.get(
+            'HTTP_CACHE_TTL', os.environ.get('TRIVIA_HTTP_CACHE_TTL', 60))))
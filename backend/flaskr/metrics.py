@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# statistics of the request handled by the current thread
+_current = threading.local()
+
+
+class Histogram:
+    """
+    Histogram
+        counts observations per bucket ('buckets' being the upper bounds),
+        and keeps their sum, as Prometheus histograms do
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, labels):
+        """Yield the (suffix, labels, value) of the Prometheus samples"""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '_bucket', dict(labels, le=str(bound)), cumulative
+        cumulative += self.counts[-1]
+        yield '_bucket', dict(labels, le='+Inf'), cumulative
+        yield '_sum', labels, self.sum
+        yield '_count', labels, cumulative
+
+
+class RequestStats:
+    """SQL activity of one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows_hydrated = 0
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context.trivia_query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None:
+        stats.statements += 1
+        stats.sql_seconds += (time.perf_counter() -
+                              context.trivia_query_start)
+
+
+def on_load(target, context):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None:
+        stats.rows_hydrated += 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Metrics
+        per-route request latency, SQL statements count and duration, and
+        ORM objects hydrated per request, exported in the Prometheus text
+        format. Requests slower than 'slow_request_seconds' are logged.
+
+        Other components add their own metrics with register_collector():
+        a collector returns a list of (name, type, help, samples), samples
+        being a list of (labels dict, value).
+    """
+
+    def __init__(self, logger, slow_request_seconds=None):
+        self.logger = logger
+        self.slow_request_seconds = slow_request_seconds
+        self.latency = {}
+        self.statements = {}
+        self.totals = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def start_request(self):
+        _current.stats = RequestStats()
+
+    def end_request(self, response):
+        stats = getattr(_current, 'stats', None)
+        if stats is None:
+            return response
+        _current.stats = None
+        duration = time.perf_counter() - stats.start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        key = (route, request.method)
+        with self._lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.statements[key] = Histogram(STATEMENTS_BUCKETS)
+            self.latency[key].observe(duration)
+            self.statements[key].observe(stats.statements)
+            totals = self.totals.setdefault(
+                (route, request.method, response.status_code),
+                [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += stats.sql_seconds
+            totals[2] += stats.rows_hydrated
+        if (self.slow_request_seconds is not None and
+                duration >= self.slow_request_seconds):
+            self.logger.warning(
+                'Slow request: %s %s took %.1f ms (%d SQL statements in '
+                '%.1f ms, %d rows hydrated)',
+                request.method, request.full_path.rstrip('?'),
+                duration * 1000, stats.statements,
+                stats.sql_seconds * 1000, stats.rows_hydrated)
+        return response
+
+    def families(self):
+        """Return all the metrics as (name, type, help, samples)"""
+        with self._lock:
+            latency = [
+                ({'route': route, 'method': method}, histogram)
+                for (route, method), histogram in self.latency.items()]
+            statements = [
+                ({'route': route, 'method': method}, histogram)
+                for (route, method), histogram in self.statements.items()]
+            totals = [({'route': route, 'method': method,
+                        'status': str(status)}, list(values))
+                      for (route, method, status), values
+                      in self.totals.items()]
+        families = [
+            ('trivia_request_duration_seconds', 'histogram',
+             'Request latency', latency),
+            ('trivia_request_sql_statements', 'histogram',
+             'SQL statements executed per request', statements),
+            ('trivia_requests_total', 'counter', 'Requests handled',
+             [(labels, values[0]) for labels, values in totals]),
+            ('trivia_sql_seconds_total', 'counter',
+             'Time spent executing SQL statements',
+             [(labels, values[1]) for labels, values in totals]),
+            ('trivia_rows_hydrated_total', 'counter',
+             'ORM objects loaded from query results',
+             [(labels, values[2]) for labels, values in totals])
+        ]
+        for collector in self.collectors:
+            families.extend(collector())
+        return families
+
+    def render(self):
+        """Return the metrics in the Prometheus text format"""
+        lines = []
+        for name, kind, help, samples in self.families():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    for suffix, sample_labels, count in value.samples(labels):
+                        lines.append(
+                            f'{name}{suffix}{format_labels(sample_labels)} '
+                            f'{count}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+_listening = False
+
+
+def listen_to_sqlalchemy(model_class):
+    """Install the SQLAlchemy event listeners (once per process)"""
+    global _listening
+    if _listening:
+        return
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(model_class, 'load', on_load, propagate=True)
+    _listening = True
+
+
+def setup_metrics(app, model_class):
+    """
+    Instrument 'app' and add the '/metrics' endpoint. Requests slower than
+    the setting 'SLOW_REQUEST_MS' (env 'TRIVIA_SLOW_REQUEST_MS', default
+    500, empty to disable) are logged.
+    """
+    threshold = app.config.get('SLOW_REQUEST_MS',
+                               os.environ.get('TRIVIA_SLOW_REQUEST_MS', 500))
+    metrics = Metrics(app.logger,
+                      None if threshold in (None, '') else
+                      float(threshold) / 1000)
+    listen_to_sqlalchemy(model_class)
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.end_request)
+
+    @app.route('/metrics')
+    def get_metrics():
+        """
+        Return the metrics of this worker in the Prometheus text format
+        """
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return metrics
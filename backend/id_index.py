@@ -0,0 +1,392 @@
+import os
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from models import db, Question, QUESTIONS_PER_PAGE, on_question_change
+from models import table_versions, question_rows_query, format_rows
+from models import question_fetch_page, question_fetch_page_by_category
+from models import question_fetch_random, question_fetch_sample
+from models import question_fetch_ids, primary_reads
+
+# random picks tried before filtering out the excluded ids
+RANDOM_PICK_TRIES = 8
+# rows read per round trip while building the index
+ID_INDEX_BATCH_SIZE = 10000
+
+
+def insert_sorted(ids, question_id):
+    if not ids or ids[-1] < question_id:
+        # new questions have the highest ids
+        ids.append(question_id)
+    else:
+        position = bisect_left(ids, question_id)
+        if position == len(ids) or ids[position] != question_id:
+            ids.insert(position, question_id)
+
+
+def remove_sorted(ids, question_id):
+    position = bisect_left(ids, question_id)
+    if position < len(ids) and ids[position] == question_id:
+        del ids[position]
+        return True
+    return False
+
+
+class QuestionIdIndex:
+    """
+    QuestionIdIndex
+        the sorted ids of all the questions, of the questions of each
+        category, and of each difficulty level (of each category), in
+        compact arrays (4 bytes per id), so that random picks, counts and
+        page boundaries are found without a query; only the selected
+        questions are then loaded, by primary key.
+
+        The arrays are loaded from the primary database (never a lagging
+        replica) with one query ordered by id, streamed, then updated
+        incrementally by the question change listeners. They are rebuilt
+        when they may be stale: right away after a bulk change, and at most
+        every 'rebuild_interval' seconds when the 'questions' table version
+        moved by more than this process's own changes (another worker
+        process wrote, see TABLE_VERSIONS_FILE), or once they are older
+        than 'max_age' seconds. A rebuild runs without the lock: meanwhile
+        the other threads keep using the previous arrays, and the changes
+        made during the rebuild are applied to the new ones.
+
+        When disabled, the same methods run the queries of models.py.
+    """
+
+    def __init__(self, versions, max_age=300, enabled=True,
+                 rebuild_interval=1):
+        self.versions = versions
+        self.max_age = max_age
+        self.enabled = enabled
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        # held by the thread rebuilding the arrays
+        self._build_lock = threading.Lock()
+        self.reset()
+        on_question_change(self.on_question_change)
+
+    def reset(self):
+        """Forget the arrays and the counters"""
+        with self._lock:
+            self._ids = None
+            self._levels = None
+            self._version = None
+            self._loaded_at = 0
+            # changes made during a rebuild: (version, change)
+            self._pending = None
+            self.rebuilds = 0
+            self.hits = 0
+
+    def _build(self):
+        """Return new arrays (ids, levels) and the version they hold"""
+        # read first: a change committed during the load makes it stale
+        version = self.versions.get('questions')
+        ids = {None: array('i')}
+        levels = {}
+        with primary_reads():
+            rows = (db.session.query(Question.category, Question.difficulty,
+                                     Question.id)
+                    .order_by(Question.id)
+                    .execution_options(stream_results=True)
+                    .yield_per(ID_INDEX_BATCH_SIZE))
+            for category, difficulty, question_id in rows:
+                # the rows come ordered by id, so every array stays sorted
+                ids[None].append(question_id)
+                if category is not None:
+                    ids.setdefault(category, array('i')).append(question_id)
+                if difficulty is not None:
+                    for key in {(None, difficulty), (category, difficulty)}:
+                        levels.setdefault(key, array('i')).append(
+                            question_id)
+        return ids, levels, version
+
+    def _fresh(self):
+        """Whether the current arrays can be used as they are"""
+        if self._ids is None:
+            return False
+        age = time.monotonic() - self._loaded_at
+        if self._version != self.versions.get('questions'):
+            return age < self.rebuild_interval
+        return age <= self.max_age
+
+    def _arrays(self):
+        """
+        Return the current arrays (ids, levels), rebuilding them first if
+        they are stale: the other threads wait for the rebuild only when
+        there are no arrays to use meanwhile
+        """
+        while True:
+            with self._lock:
+                if self._fresh():
+                    self.hits += 1
+                    return self._ids, self._levels
+                usable = self._ids is not None
+            if self._build_lock.acquire(blocking=not usable):
+                try:
+                    with self._lock:
+                        # rebuilt while this thread was waiting?
+                        if self._fresh():
+                            self.hits += 1
+                            return self._ids, self._levels
+                        self._pending = []
+                    try:
+                        ids, levels, version = self._build()
+                    except Exception:
+                        with self._lock:
+                            self._pending = None
+                        raise
+                    with self._lock:
+                        self._swap(ids, levels, version)
+                        return self._ids, self._levels
+                finally:
+                    self._build_lock.release()
+            with self._lock:
+                # another thread is rebuilding them
+                if self._ids is not None:
+                    self.hits += 1
+                    return self._ids, self._levels
+
+    def _swap(self, ids, levels, version):
+        """Use the rebuilt arrays, with the changes made meanwhile"""
+        self._ids = ids
+        self._levels = levels
+        self._version = version
+        self._loaded_at = time.monotonic()
+        self.rebuilds += 1
+        pending, self._pending = self._pending, None
+        for version, change in pending:
+            if change is None:
+                # a bulk change: rebuild on next use
+                self._version = None
+                self._loaded_at = 0
+                return
+            # harmless if the change made it into the query's results
+            self._apply(*change)
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+    def _apply(self, action, question_id, category, difficulty):
+        if action in ('update', 'delete'):
+            # the previous category and difficulty are not known
+            for ids in self._ids.values():
+                remove_sorted(ids, question_id)
+            for ids in self._levels.values():
+                remove_sorted(ids, question_id)
+        if action in ('insert', 'update'):
+            insert_sorted(self._ids[None], question_id)
+            if category is not None:
+                insert_sorted(self._ids.setdefault(category, array('i')),
+                              question_id)
+            if difficulty is not None:
+                for key in {(None, difficulty), (category, difficulty)}:
+                    insert_sorted(self._levels.setdefault(key, array('i')),
+                                  question_id)
+
+    def on_question_change(self, action, question):
+        with self._lock:
+            version = self.versions.get('questions')
+            change = (None if action == 'bulk' else
+                      (action, question.id, question.category,
+                       question.difficulty))
+            if self._pending is not None:
+                self._pending.append((version, change))
+            if self._ids is None:
+                return
+            if change is None:
+                # rebuild on next use
+                self._ids = None
+                return
+            self._apply(*change)
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+            # else another process wrote too: the arrays stay stale until
+            # the next rebuild
+
+    def count(self, category=None):
+        """Return the number of questions (of 'category' if given)"""
+        ids = self._arrays()[0]
+        with self._lock:
+            ids = ids.get(category)
+            return 0 if ids is None else len(ids)
+
+    def counts(self):
+        """Return the number of questions of each category"""
+        ids = self._arrays()[0]
+        with self._lock:
+            return {category: len(category_ids)
+                    for category, category_ids in ids.items()
+                    if category is not None}
+
+    def ids(self, category=None):
+        """Return the ids of the questions (of 'category' if given)"""
+        if not self.enabled:
+            return question_fetch_ids(category=category)
+        ids = self._arrays()[0]
+        with self._lock:
+            return ids.get(category, array('i')).tolist()
+
+    def pick(self, category=None, exclude=(), difficulty=None):
+        """
+        Return the id of a random question (of 'category' and 'difficulty'
+        if given) not in 'exclude', or None when no such question is left
+        """
+        exclude = set(exclude)
+        ids, levels = self._arrays()
+        with self._lock:
+            if difficulty is None:
+                ids = ids.get(category)
+            else:
+                ids = levels.get((category, difficulty))
+            if not ids:
+                return None
+            for _ in range(RANDOM_PICK_TRIES):
+                question_id = ids[random.randrange(len(ids))]
+                if question_id not in exclude:
+                    return question_id
+            # most of the questions were excluded
+            left = [question_id for question_id in ids
+                    if question_id not in exclude]
+        return random.choice(left) if left else None
+
+    def sample(self, n, category=None, exclude=()):
+        """
+        Return the ids of up to 'n' distinct random questions (of 'category'
+        if given) not in 'exclude', in random order
+        """
+        exclude = set(exclude)
+        ids = self._arrays()[0]
+        with self._lock:
+            ids = ids.get(category)
+            if not ids:
+                return []
+            # at most len(exclude) of the picks are excluded
+            positions = random.sample(range(len(ids)),
+                                      min(len(ids), n + len(exclude)))
+            picks = [ids[position] for position in positions]
+        return [question_id for question_id in picks
+                if question_id not in exclude][:n]
+
+    def page_ids(self, page=1, pagesize=QUESTIONS_PER_PAGE, after_id=None,
+                 category=None):
+        """
+        Return the ids of one 'page' of 'pagesize' questions (of 'category'
+        if given) ordered by id, or of the page starting right after
+        'after_id' if given
+        """
+        ids = self._arrays()[0]
+        with self._lock:
+            ids = ids.get(category)
+            if ids is None:
+                return []
+            if after_id is None:
+                start = pagesize * (page - 1)
+            else:
+                start = bisect_right(ids, after_id)
+            return ids[start:start + pagesize].tolist()
+
+    def fetch_random(self, category=None, exclude=(), difficulty=None):
+        """Return a random question, like models.question_fetch_random"""
+        if not self.enabled:
+            return question_fetch_random(category=category, exclude=exclude,
+                                         difficulty=difficulty)
+        question_id = self.pick(category, exclude, difficulty)
+        if question_id is None:
+            return None
+        question = Question.query.get(question_id)
+        if question is None:
+            # not on a lagging replica yet?
+            with primary_reads():
+                question = Question.query.get(question_id)
+        if question is None:
+            # deleted by another process: the index is stale
+            self._mark_stale()
+            return question_fetch_random(category=category, exclude=exclude,
+                                         difficulty=difficulty)
+        return question
+
+    def fetch_sample(self, n, category=None, exclude=(), total=None):
+        """
+        Return up to 'n' random questions, like
+        models.question_fetch_sample ('total' is only used when disabled),
+        loaded with a single 'IN' query
+        """
+        if not self.enabled:
+            return question_fetch_sample(n, category=category,
+                                         exclude=exclude, total=total)
+        question_ids = self.sample(n, category, exclude)
+        if not question_ids:
+            return []
+        query = Question.query.filter(Question.id.in_(question_ids))
+        found = {question.id: question for question in query}
+        if len(found) < len(question_ids):
+            with primary_reads():
+                found = {question.id: question for question in query}
+        if len(found) < len(question_ids):
+            self._mark_stale()
+            return question_fetch_sample(n, category=category,
+                                         exclude=exclude)
+        return [found[question_id] for question_id in question_ids]
+
+    def fetch_page(self, page=1, pagesize=QUESTIONS_PER_PAGE, after_id=None,
+                   category=None):
+        """
+        Return one page of formatted questions, like
+        models.question_fetch_page(_by_category): the ids of the page come
+        from the index, so no 'OFFSET' rows are skipped by the database
+        """
+        if not self.enabled:
+            return self._fetch_page_query(page, pagesize, after_id, category)
+        question_ids = self.page_ids(page, pagesize, after_id, category)
+        if not question_ids:
+            return []
+        query = (question_rows_query()
+                 .filter(Question.id.in_(question_ids))
+                 .order_by(Question.id))
+        rows = query.all()
+        if len(rows) < len(question_ids):
+            with primary_reads():
+                rows = query.all()
+        if len(rows) < len(question_ids):
+            self._mark_stale()
+            return self._fetch_page_query(page, pagesize, after_id, category)
+        return format_rows(rows)
+
+    @staticmethod
+    def _fetch_page_query(page, pagesize, after_id, category):
+        if category is None:
+            return question_fetch_page(page=page, pagesize=pagesize,
+                                       after_id=after_id)
+        return question_fetch_page_by_category(
+            category, page=page, pagesize=pagesize, after_id=after_id)
+
+    def _mark_stale(self):
+        # rebuilt like after another process's write
+        with self._lock:
+            self._version = None
+
+
+question_id_index = QuestionIdIndex(table_versions)
+
+
+def setup_id_index(app):
+    """
+    Configure the question id index from the settings 'ID_INDEX' (false to
+    disable it), 'ID_INDEX_MAX_AGE' and 'ID_INDEX_REBUILD_INTERVAL'
+    (seconds), or the matching 'TRIVIA_*' environment variables, and return
+    it. It is built on first use.
+    """
+    question_id_index.enabled = str(app.config.get(
+        'ID_INDEX', os.environ.get('TRIVIA_ID_INDEX', 'true'))).lower() in (
+            '1', 'true', 'yes', 'on')
+    question_id_index.max_age = float(app.config.get(
+        'ID_INDEX_MAX_AGE', os.environ.get('TRIVIA_ID_INDEX_MAX_AGE', 300)))
+    question_id_index.rebuild_interval = float(app.config.get(
+        'ID_INDEX_REBUILD_INTERVAL',
+        os.environ.get('TRIVIA_ID_INDEX_REBUILD_INTERVAL', 1)))
+    question_id_index.reset()
+    return question_id_index
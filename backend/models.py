@@ -1,9 +1,25 @@
+import hashlib
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import random
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, create_engine, func
+from sqlalchemy import Boolean, DateTime, event, inspect
+from sqlalchemy import DDL, Index
 import json
 
+from cache import VersionedCache, VersionCounters
+from db_pool import engine_options
+from replicas import RoutingSQLAlchemy, replica_router
+
 QUESTIONS_PER_PAGE = 10
+# random keys drawn by question_fetch_sample: at most, and in addition to
+# the expected number of keys needed
+MAX_SAMPLE_KEYS = 1000
+SAMPLE_KEYS_MARGIN = 8
+# random ids tried by question_fetch_random before it samples
+RANDOM_PROBES = 4
 
 username = 'postgres'
 password = 'abdou'
@@ -11,20 +27,115 @@ host = 'localhost'
 port = 5432
 db_name = "trivia"
 database_path = f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
+default_database_path = database_path
+
+db = RoutingSQLAlchemy()
+
+# bumped on every committed change of the matching table
+table_versions = VersionCounters(['questions', 'categories', 'results'])
+
+# functions called as listener(action, question) once a question change has
+# been committed, 'action' being one of 'insert', 'update' or 'delete', or
+# 'bulk' (with question None) after many questions were changed at once
+question_listeners = []
+
+
+def on_question_change(listener):
+    """Register 'listener' to be called after each question change"""
+    question_listeners.append(listener)
+    return listener
+
 
-db = SQLAlchemy()
+def notify_question_change(action, question):
+    table_versions.bump('questions')
+    for listener in question_listeners:
+        listener(action, question)
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
     """
     setup_db(app)
-        binds a flask application and a SQLAlchemy service
+        binds a flask application and a SQLAlchemy service, without
+        connecting to the database (see create_schema)
+        the database URL is 'database_path' if given, else the setting
+        'DATABASE_URL' (env 'TRIVIA_DATABASE_URL'), else the local
+        PostgreSQL database; 'sqlite:///<file>' and 'sqlite://' (in memory)
+        are supported too
+        the connection pool is configured by the 'DB_*' settings
+        (see db_pool.engine_options)
+        the reads allowed by use_replicas() go to the read replicas
+        'REPLICA_URLS' (a list, or env 'TRIVIA_REPLICA_URLS', comma
+        separated), checked every 'REPLICA_CHECK_INTERVAL' seconds (default
+        5), except for 'REPLICA_PIN_SECONDS' seconds (default 1) after a
+        write (see replicas.ReplicaRouter)
     """
+    if database_path is None:
+        database_path = app.config.get(
+            'DATABASE_URL',
+            os.environ.get('TRIVIA_DATABASE_URL', default_database_path))
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app,
+                                                             database_path)
     db.app = app
     db.init_app(app)
+    replica_urls = app.config.get(
+        'REPLICA_URLS', os.environ.get('TRIVIA_REPLICA_URLS', ''))
+    if isinstance(replica_urls, str):
+        replica_urls = [url.strip() for url in replica_urls.split(',')
+                        if url.strip()]
+    replica_router.configure(
+        [create_engine(url, **engine_options(app, url))
+         for url in replica_urls],
+        pin_seconds=float(app.config.get(
+            'REPLICA_PIN_SECONDS',
+            os.environ.get('TRIVIA_REPLICA_PIN_SECONDS', 1))),
+        check_interval=float(app.config.get(
+            'REPLICA_CHECK_INTERVAL',
+            os.environ.get('TRIVIA_REPLICA_CHECK_INTERVAL', 5))))
+    category_cache.snapshot_path = app.config.get(
+        'CATEGORY_CACHE_FILE', os.environ.get('TRIVIA_CATEGORY_CACHE_FILE'))
+    category_cache.reset()
+    table_versions.open(app.config.get(
+        'TABLE_VERSIONS_FILE', os.environ.get('TRIVIA_TABLE_VERSIONS_FILE')))
+
+
+def use_replicas():
+    """
+    Let the reads of the current session go to the read replicas, until
+    it writes (for the rest of the request in a view)
+    """
+    db.session.info['replica_reads'] = True
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads of the current session to the primary in this block,
+    e.g. to load data kept in memory, which must not miss recent writes
+    """
+    replica_reads = db.session.info.get('replica_reads')
+    db.session.info['replica_reads'] = False
+    try:
+        yield
+    finally:
+        db.session.info['replica_reads'] = replica_reads
+
+
+def create_schema():
+    """
+    Create the missing tables and indexes (see 'flask trivia init-db');
+    needs an app context
+    """
     db.create_all()
+    # create_all() does not add columns and indexes to existing tables
+    columns = {column['name']
+               for column in inspect(db.engine).get_columns('questions')}
+    if 'fingerprint' not in columns:
+        db.engine.execute(
+            'ALTER TABLE questions ADD COLUMN fingerprint VARCHAR(40)')
+    for index in question_indexes:
+        index.execute(bind=db.engine, target=None)
 
 
 class Question(db.Model):
@@ -33,12 +144,24 @@ class Question(db.Model):
 
     """
     __tablename__ = 'questions'
+    __table_args__ = (
+        # listing a category by id, and counting its questions
+        Index('ix_questions_category_id', 'category', 'id'),
+        # picking a question of a given difficulty (see quiz_engine.py)
+        Index('ix_questions_category_difficulty_id',
+              'category', 'difficulty', 'id'),
+        Index('ix_questions_difficulty_id', 'difficulty', 'id'),
+        # finding a duplicate (see question_fetch_duplicate)
+        Index('ix_questions_fingerprint', 'fingerprint'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer)
     difficulty = Column(Integer)
+    # set from 'question' on insert and update (see question_fingerprint)
+    fingerprint = Column(String(40))
 
     # def __init__(self, question, answer, category, difficulty):
     #     self.question = question
@@ -49,13 +172,16 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_question_change('insert', self)
 
     def update(self):
         db.session.commit()
+        notify_question_change('update', self)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', self)
 
     def format(self):
         return {
@@ -72,6 +198,58 @@ class Question(db.Model):
                + '\ndifficulty: {self.difficulty}\n>'
 
 
+question_indexes = [
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_category_id "
+        "ON questions (category, id)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty_id "
+        "ON questions (category, difficulty, id)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_difficulty_id "
+        "ON questions (difficulty, id)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_fingerprint "
+        "ON questions (fingerprint)")
+]
+
+
+def normalize_question_text(text):
+    """
+    Return 'text' folded to lowercase words without accents or
+    punctuation, separated by single spaces
+    """
+    text = unicodedata.normalize('NFKD', (text or '').casefold())
+    return ' '.join(''.join(
+        character if character.isalnum() else ' '
+        for character in text
+        if not unicodedata.combining(character)).split())
+
+
+def question_fingerprint(text):
+    """
+    Return the fingerprint of a question text: the SHA-1 of its normalized
+    text, so that questions differing only by case, accents, punctuation
+    or spacing get the same fingerprint
+    """
+    return hashlib.sha1(
+        normalize_question_text(text).encode()).hexdigest()
+
+
+@event.listens_for(Question, 'before_insert')
+@event.listens_for(Question, 'before_update')
+def set_fingerprint(mapper, connection, question):
+    question.fingerprint = question_fingerprint(question.question)
+
+
+def question_fetch_duplicate(text):
+    """
+    Return the id of a question whose text is the same as 'text' once
+    normalized, None if there is none: one lookup of ix_questions_fingerprint
+    """
+    return (db.session.query(Question.id)
+            .filter(Question.fingerprint == question_fingerprint(text))
+            .order_by(Question.id)
+            .limit(1)
+            .scalar())
+
+
 class Category(db.Model):
     """
     Category
@@ -88,13 +266,19 @@ class Category(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        table_versions.bump('categories')
+        category_cache.invalidate()
 
     def update(self):
         db.session.commit()
+        table_versions.bump('categories')
+        category_cache.invalidate()
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        table_versions.bump('categories')
+        category_cache.invalidate()
 
     def format(self):
         return {
@@ -106,6 +290,70 @@ class Category(db.Model):
         return f'<Category id: {self.id} - type: {self.type}>'
 
 
+class QuizResult(db.Model):
+    """
+    QuizResult
+        one answer of a player, in the append-only results log: never
+        read by the API, which reads the aggregates below (see results.py)
+    """
+    __tablename__ = 'quiz_results'
+
+    id = Column(Integer, primary_key=True)
+    player = Column(String(80), nullable=False)
+    # 0 for a quiz of all the categories
+    category = Column(Integer, nullable=False)
+    question_id = Column(Integer, nullable=False)
+    correct = Column(Boolean, nullable=False)
+    answered_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class QuestionStats(db.Model):
+    """
+    QuestionStats
+        the number of answers and correct answers of a question
+    """
+    __tablename__ = 'question_stats'
+
+    question_id = Column(Integer, primary_key=True)
+    answers = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'question_id': self.question_id,
+            'answers': self.answers,
+            'correct': self.correct,
+            'correct_rate': (self.correct / self.answers if self.answers
+                             else None)
+        }
+
+
+class PlayerScore(db.Model):
+    """
+    PlayerScore
+        the score (correct answers) and answers of a player in a category,
+        and in all the categories (category 0)
+    """
+    __tablename__ = 'player_scores'
+
+    category = Column(Integer, primary_key=True)
+    player = Column(String(80), primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+    answers = Column(Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'player': self.player,
+            'score': self.score,
+            'answers': self.answers
+        }
+
+
+# the leaderboard of a category is the start of its range of this index
+Index('ix_player_scores_leaderboard', PlayerScore.category,
+      PlayerScore.score.desc(), PlayerScore.answers, PlayerScore.player)
+
+
 def format_list_items(items):
     """
     format all of the records in the list
@@ -113,31 +361,79 @@ def format_list_items(items):
     return [item.format() for item in items]
 
 
-def category_fetch_all():
-    """Return all categories"""
+# the columns of Question.format(), in order
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def question_rows_query():
+    """
+    Return a query selecting only the columns of the formatted questions,
+    as plain rows: no ORM object is built for them
+    """
+    return db.session.query(*(getattr(Question, field)
+                              for field in QUESTION_FIELDS))
+
+
+def format_rows(rows):
+    """
+    format rows of question_rows_query() like Question.format() does
+    """
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def category_load_all():
+    """Load all categories from the database, ordered by type"""
     categories = Category.query.order_by(Category.type).all()
     categories_dict = {category.id: category.type for category in categories}
     return categories_dict
 
 
+# categories almost never change: keep them in memory and reload them only
+# when Category.insert/update/delete runs
+category_cache = VersionedCache(
+    category_load_all,
+    encode=lambda categories: list(categories.items()),
+    decode=lambda items: {category_id: type for category_id, type in items})
+
+
+def category_fetch_all():
+    """Return all categories"""
+    return dict(category_cache.get())
+
+
+def category_get_type(category_id):
+    """Return the type of the category 'category_id', or None"""
+    return category_cache.get().get(category_id)
+
+
 def questions_list_categories(questions):
     return list({question['category'] for question in questions})
 
 
-def question_fetch_page(search_term=None, page=1, pagesize=QUESTIONS_PER_PAGE):
+def fetch_page(query, page=1, pagesize=QUESTIONS_PER_PAGE, after_id=None):
     """
-    Return one 'page' of 'pagesize' elements
+    Return one 'page' of 'pagesize' elements of 'query', ordered by id.
+    If 'after_id' is given, the page starts right after that id
+    (keyset pagination: an index seek instead of skipping 'OFFSET' rows),
+    and 'page' is ignored.
     """
+    query = query.order_by(Question.id)
+    if after_id is not None:
+        return query.filter(Question.id > after_id).limit(pagesize).all()
     start = pagesize * (page - 1)
     end = start + pagesize
-    if search_term is None:
-        return Question.query.order_by(Question.id).slice(start, end).all()
-    else:
-        return (Question.query
-                .filter(Question.question.ilike(f'%{search_term}%'))
-                .order_by(Question.id)
-                .slice(start, end)
-                .all())
+    return query.slice(start, end).all()
+
+
+def question_fetch_page(search_term=None, page=1, pagesize=QUESTIONS_PER_PAGE,
+                        after_id=None):
+    """
+    Return one 'page' of 'pagesize' elements, formatted
+    """
+    query = question_rows_query()
+    if search_term is not None:
+        query = query.filter(Question.question.ilike(f'%{search_term}%'))
+    return format_rows(fetch_page(query, page, pagesize, after_id))
 
 
 def question_count(search_term=None):
@@ -154,17 +450,13 @@ def question_count(search_term=None):
 
 def question_fetch_page_by_category(category,
                                     page=1,
-                                    pagesize=QUESTIONS_PER_PAGE):
+                                    pagesize=QUESTIONS_PER_PAGE,
+                                    after_id=None):
     """
-    Fetch questions by category
+    Fetch questions by category, formatted
     """
-    start = pagesize * (page - 1)
-    end = start + pagesize
-    return (Question.query
-            .filter(Question.category == category)
-            .order_by(Question.id)
-            .slice(start, end)
-            .all())
+    query = question_rows_query().filter(Question.category == category)
+    return format_rows(fetch_page(query, page, pagesize, after_id))
 
 
 def question_count_by_category(category):
@@ -174,3 +466,96 @@ def question_count_by_category(category):
     return (Question.query
             .filter(Question.category == category)
             .count())
+
+
+def question_fetch_random(category=None, exclude=(), difficulty=None):
+    """
+    Return a random question (of 'category' and 'difficulty' if given) whose
+    id is not in 'exclude', or None when no such question is left.
+    Up to RANDOM_PROBES random keys are drawn between the lowest and
+    highest id, and the question having exactly that id is fetched, so each
+    lookup is a primary key seek and every eligible question is equally
+    likely (taking the first question after the key would favour the ones
+    after a gap in the ids). When no key hits an eligible question, one is
+    drawn by question_fetch_sample.
+    """
+    query = Question.query
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    low, high = query.with_entities(func.min(Question.id),
+                                    func.max(Question.id)).one()
+    if low is None:
+        return None
+    exclude = set(exclude)
+    for _ in range(RANDOM_PROBES):
+        key = random.randint(low, high)
+        if key in exclude:
+            continue
+        question = query.filter(Question.id == key).first()
+        if question is not None:
+            return question
+    questions = question_fetch_sample(1, category=category, exclude=exclude,
+                                      difficulty=difficulty)
+    return questions[0] if questions else None
+
+
+def question_fetch_sample(n, category=None, exclude=(), total=None,
+                          difficulty=None):
+    """
+    Return up to 'n' distinct random questions (of 'category' and
+    'difficulty' if given) whose ids are not in 'exclude', in random order.
+    Random keys are drawn between the lowest and highest id, about twice as
+    many as needed given the density of the ids ('total' questions in that
+    range, counted if not given), and the questions having these ids are
+    loaded by a single 'IN' query; the sample is drawn from them. Only when
+    too few keys hit an eligible question are the missing ones drawn with
+    'ORDER BY random()'.
+    """
+    query = Question.query
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    columns = [func.min(Question.id), func.max(Question.id)]
+    if total is None:
+        columns.append(func.count(Question.id))
+    row = query.with_entities(*columns).one()
+    low, high = row[0], row[1]
+    if low is None:
+        return []
+    if total is None:
+        total = row[2]
+    exclude = set(exclude)
+    span = high - low + 1
+    eligible = max(1, total - len(exclude))
+    size = min(span, MAX_SAMPLE_KEYS,
+               -(-2 * n * span // eligible) + SAMPLE_KEYS_MARGIN)
+    if size == span:
+        candidates = query
+    else:
+        keys = random.sample(range(low, high + 1), size)
+        candidates = query.filter(Question.id.in_(keys))
+    questions = [question for question in candidates
+                 if question.id not in exclude]
+    questions = random.sample(questions, min(n, len(questions)))
+    if len(questions) < n and size < span:
+        exclude.update(question.id for question in questions)
+        if exclude:
+            query = query.filter(~Question.id.in_(exclude))
+        questions.extend(query.order_by(func.random())
+                         .limit(n - len(questions)))
+        random.shuffle(questions)
+    return questions
+
+
+def question_fetch_ids(category=None):
+    """
+    Return the ids of all the questions (of 'category' if given), without
+    loading the questions themselves
+    """
+    query = db.session.query(Question.id)
+    if category is not None:
+        query = query.filter(Question.category == category)
+    return [question_id for question_id, in query]
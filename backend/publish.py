@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from array import array
+from collections import Counter
+
+from models import db, Question, QUESTIONS_PER_PAGE
+from models import question_rows_query, format_rows, category_load_all
+
+# rows fetched per round trip while rendering
+PUBLISH_BATCH_SIZE = 1000
+# the only file of a snapshot which is not content-hashed: its entry point
+INDEX_FILE = 'index.json'
+# names of the shards (see ShardWriter.write), relative to the directory
+SHARD_NAME = re.compile(r'\.[0-9a-f]{16}\.json$')
+# category of the uncategorised questions in the manifest's array
+NO_CATEGORY = -1
+
+
+def write_file(path, data):
+    """Write 'data' to 'path' atomically: readers see all of it or none"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    # served by another user (e.g. nginx)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter:
+    """
+    ShardWriter
+        writes JSON shards under 'directory', each named after the hash of
+        its content: a shard that did not change keeps its name and is not
+        written again, and a name never points to other content, so the
+        shards can be cached forever.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = set()
+        self.written = 0
+        self.unchanged = 0
+
+    def write(self, name, payload):
+        """Write 'payload' as the shard 'name', return its file name"""
+        data = json.dumps(payload, sort_keys=True,
+                          separators=(',', ':')).encode()
+        file_name = f'{name}.{hashlib.sha1(data).hexdigest()[:16]}.json'
+        self.names.add(file_name)
+        path = os.path.join(self.directory, file_name)
+        if os.path.exists(path):
+            self.unchanged += 1
+        else:
+            write_file(path, data)
+            self.written += 1
+        return file_name
+
+
+def pages(rows, page_size):
+    """Yield the formatted questions of 'rows', 'page_size' at a time"""
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) == page_size:
+            yield format_rows(page)
+            page = []
+    if page:
+        yield format_rows(page)
+
+
+def write_listing(writer, prefix, query, page_size, category=None):
+    """
+    Write the pages of the questions of 'query', ordered by id, as the
+    shards '<prefix>/page-<number>', like the listing of 'category' (all
+    the questions if None) returns them, and the list of their file names
+    as the shard '<prefix>/pages'. Return the file name of the latter.
+    """
+    rows = (query.order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(PUBLISH_BATCH_SIZE))
+    names = []
+    for number, questions in enumerate(pages(rows, page_size), 1):
+        if category is None:
+            # uncategorised questions last
+            current_category = sorted(
+                {question['category'] for question in questions},
+                key=lambda category: (category is None, category or 0))
+        else:
+            current_category = category
+        names.append(writer.write(f'{prefix}/page-{number}', {
+            'success': True,
+            'page': number,
+            'questions': questions,
+            'current_category': current_category
+        }))
+    return writer.write(f'{prefix}/pages', {'pages': names})
+
+
+def index_shards(directory, index):
+    """Return the file names of the shards of the snapshot 'index'"""
+    names = {index['categories'], index['manifest']}
+    for listing in [index['questions'], *index['by_category'].values()]:
+        names.add(listing['pages'])
+        try:
+            with open(os.path.join(directory, listing['pages'])) as file:
+                names.update(json.load(file)['pages'])
+        except (OSError, ValueError):
+            pass
+    return names
+
+
+def read_index(directory):
+    """Return the index of the snapshot in 'directory', None if none"""
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def publish(directory, page_size=QUESTIONS_PER_PAGE):
+    """
+    Render the question bank into 'directory' as static JSON shards: the
+    categories, every page of 'GET /questions' and of
+    'GET /categories/<id>/questions', and a manifest of the ids and
+    categories of all the questions (columns), for the clients sampling
+    quizzes locally. The snapshot's 'index.json', the only file clients
+    must revalidate, holds the totals and names the other shards, the
+    pages of each listing being named in its 'pages' shard.
+
+    Pages only hold their own questions, so that republishing writes just
+    the shards whose questions changed (and the index), shards being
+    content-hashed (see ShardWriter). The shards of the previous snapshot
+    are kept for the clients still reading it, older ones are deleted.
+    Return a report of the shards written, unchanged and deleted.
+    """
+    previous = read_index(directory)
+    writer = ShardWriter(directory)
+    categories = category_load_all()
+    ids = array('i')
+    question_categories = array('i')
+    rows = (db.session.query(Question.id, Question.category)
+            .order_by(Question.id)
+            .execution_options(stream_results=True)
+            .yield_per(PUBLISH_BATCH_SIZE))
+    for question_id, category in rows:
+        ids.append(question_id)
+        # only in the listing of all the questions, like in the id index
+        question_categories.append(
+            NO_CATEGORY if category is None else category)
+    totals = Counter(question_categories)
+    by_category = {}
+    for category_id in sorted(categories):
+        query = question_rows_query().filter(
+            Question.category == category_id)
+        by_category[str(category_id)] = {
+            'total_questions': totals[category_id],
+            'pages': write_listing(writer, f'categories/{category_id}',
+                                   query, page_size, category=category_id)
+        }
+    index = {
+        'page_size': page_size,
+        'categories': writer.write('categories', {
+            'success': True,
+            'categories': {str(category_id): category_type
+                           for category_id, category_type
+                           in categories.items()}}),
+        'manifest': writer.write('manifest', {
+            'ids': ids.tolist(),
+            'categories': [
+                None if category == NO_CATEGORY else category
+                for category in question_categories]}),
+        'questions': {
+            'total_questions': len(ids),
+            'pages': write_listing(writer, 'questions', question_rows_query(),
+                                   page_size)
+        },
+        'by_category': by_category
+    }
+    version = 0 if previous is None else previous.get('version', 0)
+    changed = (previous is None or
+               {key: value for key, value in previous.items()
+                if key != 'version'} != index)
+    deleted = 0
+    if changed:
+        version += 1
+        write_file(os.path.join(directory, INDEX_FILE),
+                   json.dumps(dict(index, version=version)).encode())
+        keep = writer.names | (set() if previous is None
+                               else index_shards(directory, previous))
+        for root, _, files in os.walk(directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                if SHARD_NAME.search(name) and name not in keep:
+                    os.remove(path)
+                    deleted += 1
+    return {
+        'version': version,
+        'shards': len(writer.names),
+        'written': writer.written,
+        'unchanged': writer.unchanged,
+        'deleted': deleted
+    }
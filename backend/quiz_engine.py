@@ -0,0 +1,95 @@
+import os
+
+from models import question_fetch_random
+
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+
+
+class AdaptiveQuiz:
+    """
+    AdaptiveQuiz
+        picks quiz questions of a target difficulty which follows the
+        player's answers like a staircase: it starts at 'start', goes up one
+        level after 'step_up' correct answers in a row and down one level
+        after 'step_down' incorrect answers in a row.
+
+        The server keeps no state: the client sends the results of all its
+        previous answers, which are replayed to find the current target.
+        The question is picked by 'fetch_random' (the id index's, which
+        keeps the ids of each difficulty level in memory, or the query of
+        models.py, a few seeks on the (category, difficulty, id) index);
+        when no question of the target difficulty is left, the nearest level
+        having one is used (the easier one first).
+    """
+
+    def __init__(self, start=2, step_up=2, step_down=1,
+                 min_difficulty=MIN_DIFFICULTY, max_difficulty=MAX_DIFFICULTY,
+                 fetch_random=question_fetch_random):
+        self.start = start
+        self.step_up = step_up
+        self.step_down = step_down
+        self.min_difficulty = min_difficulty
+        self.max_difficulty = max_difficulty
+        self.fetch_random = fetch_random
+
+    def target(self, answers):
+        """
+        Return the target difficulty after 'answers', the results (True if
+        correct) of the previous answers, oldest first
+        """
+        difficulty = self.start
+        streak = 0
+        for correct in answers:
+            if correct:
+                streak = max(streak, 0) + 1
+                if streak >= self.step_up:
+                    difficulty += 1
+                    streak = 0
+            else:
+                streak = min(streak, 0) - 1
+                if -streak >= self.step_down:
+                    difficulty -= 1
+                    streak = 0
+            difficulty = min(max(difficulty, self.min_difficulty),
+                             self.max_difficulty)
+        return difficulty
+
+    def levels(self, target):
+        """Return the difficulty levels to try, nearest to 'target' first"""
+        levels = range(self.min_difficulty, self.max_difficulty + 1)
+        return sorted(levels, key=lambda level: (abs(level - target), level))
+
+    def pick(self, answers, category=None, exclude=()):
+        """
+        Return a question (of 'category' if given, not in 'exclude') as
+        close as possible to the target difficulty after 'answers', or None
+        when no question is left, and the target difficulty
+        """
+        target = self.target(answers)
+        for difficulty in self.levels(target):
+            question = self.fetch_random(category=category, exclude=exclude,
+                                         difficulty=difficulty)
+            if question is not None:
+                return question, target
+        return None, target
+
+
+def setup_quiz_engine(app, id_index=None):
+    """
+    Return the adaptive quiz engine configured by the settings
+    'QUIZ_START_DIFFICULTY' (default 2), 'QUIZ_STEP_UP' (correct answers in
+    a row to go up a level, default 2) and 'QUIZ_STEP_DOWN' (incorrect
+    answers in a row to go down a level, default 1), or the matching
+    'TRIVIA_*' environment variables. The questions are picked through
+    'id_index' if it is given.
+    """
+    def setting(name, default):
+        return int(app.config.get(name,
+                                  os.environ.get(f'TRIVIA_{name}', default)))
+
+    return AdaptiveQuiz(start=setting('QUIZ_START_DIFFICULTY', 2),
+                        step_up=setting('QUIZ_STEP_UP', 2),
+                        step_down=setting('QUIZ_STEP_DOWN', 1),
+                        fetch_random=(question_fetch_random if id_index is None
+                                      else id_index.fetch_random))
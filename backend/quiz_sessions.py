@@ -0,0 +1,181 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+class MemorySessionStore:
+    """
+    MemorySessionStore
+        keeps the quiz sessions of this process in memory: at most
+        'max_sessions' of them (least recently used sessions are dropped
+        first), each one for 'ttl' seconds after its last use.
+    """
+
+    def __init__(self, ttl=3600, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, question_ids):
+        """Store a new session playing 'question_ids' in order, return id"""
+        session_id = secrets.token_urlsafe(16)
+        # reversed, so that the next question is popped from the end
+        remaining = array('i', reversed(question_ids))
+        with self._lock:
+            self._sessions[session_id] = [remaining,
+                                          time.monotonic() + self.ttl]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_id
+
+    def pop(self, session_id):
+        """
+        Return the next question id of the session, or None if all its
+        questions were played. Raise KeyError if the session is unknown
+        or has expired.
+        """
+        question_ids = self.pop_many(session_id, 1)
+        return question_ids[0] if question_ids else None
+
+    def pop_many(self, session_id, n):
+        """
+        Return the next 'n' question ids of the session (fewer, or none, at
+        its end). Raise KeyError if the session is unknown or has expired.
+        """
+        with self._lock:
+            session = self._sessions[session_id]
+            remaining, expires = session
+            if expires < time.monotonic():
+                del self._sessions[session_id]
+                raise KeyError(session_id)
+            session[1] = time.monotonic() + self.ttl
+            self._sessions.move_to_end(session_id)
+            start = max(0, len(remaining) - n)
+            question_ids = remaining[start:].tolist()[::-1]
+            del remaining[start:]
+            return question_ids
+
+
+class SqliteSessionStore:
+    """
+    SqliteSessionStore
+        keeps the quiz sessions in a local SQLite file, so that they are
+        shared by all the worker processes and survive restarts. Each
+        session stores its question ids by position and a cursor on the
+        next one, so each step reads and updates a single row.
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        connection = self._connect()
+        try:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS quiz_sessions (
+                    id TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_quiz_sessions_expires
+                    ON quiz_sessions (expires);
+                CREATE TABLE IF NOT EXISTS quiz_session_questions (
+                    session_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    question_id INTEGER NOT NULL,
+                    PRIMARY KEY (session_id, position)) WITHOUT ROWID;
+            """)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def create(self, question_ids):
+        """Store a new session playing 'question_ids' in order, return id"""
+        session_id = secrets.token_urlsafe(16)
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            self._purge(connection)
+            connection.execute(
+                'INSERT INTO quiz_sessions VALUES (?, 0, ?, ?)',
+                (session_id, len(question_ids), time.time() + self.ttl))
+            connection.executemany(
+                'INSERT INTO quiz_session_questions VALUES (?, ?, ?)',
+                ((session_id, position, question_id)
+                 for position, question_id in enumerate(question_ids)))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        return session_id
+
+    def pop(self, session_id):
+        """
+        Return the next question id of the session, or None if all its
+        questions were played. Raise KeyError if the session is unknown
+        or has expired.
+        """
+        question_ids = self.pop_many(session_id, 1)
+        return question_ids[0] if question_ids else None
+
+    def pop_many(self, session_id, n):
+        """
+        Return the next 'n' question ids of the session (fewer, or none, at
+        its end). Raise KeyError if the session is unknown or has expired.
+        """
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                'SELECT position, size FROM quiz_sessions '
+                'WHERE id = ? AND expires >= ?',
+                (session_id, time.time())).fetchone()
+            if row is None:
+                connection.execute('ROLLBACK')
+                raise KeyError(session_id)
+            position, size = row
+            end = min(position + n, size)
+            question_ids = [question_id for question_id, in connection.execute(
+                'SELECT question_id FROM quiz_session_questions '
+                'WHERE session_id = ? AND position >= ? AND position < ? '
+                'ORDER BY position', (session_id, position, end))]
+            connection.execute(
+                'UPDATE quiz_sessions SET position = ?, expires = ? '
+                'WHERE id = ?', (end, time.time() + self.ttl, session_id))
+            connection.execute('COMMIT')
+            return question_ids
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _purge(connection):
+        now = time.time()
+        connection.execute(
+            'DELETE FROM quiz_session_questions WHERE session_id IN '
+            '(SELECT id FROM quiz_sessions WHERE expires < ?)', (now,))
+        connection.execute('DELETE FROM quiz_sessions WHERE expires < ?',
+                           (now,))
+
+
+def setup_quiz_sessions(app):
+    """
+    Return the quiz session store: a SQLite file store if the setting
+    'QUIZ_SESSION_FILE' (env 'TRIVIA_QUIZ_SESSION_FILE') is set, an
+    in-memory store otherwise. Sessions expire 'QUIZ_SESSION_TTL' seconds
+    after their last use.
+    """
+    ttl = float(app.config.get(
+        'QUIZ_SESSION_TTL', os.environ.get('TRIVIA_QUIZ_SESSION_TTL', 3600)))
+    path = app.config.get('QUIZ_SESSION_FILE',
+                          os.environ.get('TRIVIA_QUIZ_SESSION_FILE'))
+    if path:
+        return SqliteSessionStore(path, ttl=ttl)
+    return MemorySessionStore(ttl=ttl)
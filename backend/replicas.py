@@ -0,0 +1,144 @@
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.expression import Select, UpdateBase
+
+
+class Replica:
+    """A read replica: its engine, health and number of reads served"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        # checked before its first use
+        self.checked_at = float('-inf')
+        self.reads = 0
+
+
+class ReplicaRouter:
+    """
+    ReplicaRouter
+        spreads the reads of the sessions allowing it (see RoutingSession)
+        over the read replicas, round-robin, skipping the unhealthy ones;
+        reads go to the primary when no replica is healthy.
+
+        A replica is checked with a 'SELECT 1' at most every
+        'check_interval' seconds, when its turn comes, and marked unhealthy
+        as soon as connecting to it or one of its connections fails.
+
+        For 'pin_seconds' after any write of this process, all the reads go
+        to the primary, so that a client reading right after its write
+        does not miss it on a lagging replica.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.replicas = []
+        self.configure([])
+
+    def configure(self, engines, pin_seconds=1.0, check_interval=5.0):
+        """Route the reads to 'engines', forgetting the previous replicas"""
+        with self._lock:
+            for replica in self.replicas:
+                event.remove(replica.engine, 'handle_error', self._on_error)
+                replica.engine.dispose()
+            self.replicas = [Replica(engine) for engine in engines]
+            for replica in self.replicas:
+                event.listen(replica.engine, 'handle_error', self._on_error)
+            self.pin_seconds = pin_seconds
+            self.check_interval = check_interval
+            self._next = 0
+            self._last_write = float('-inf')
+            self.failovers = 0
+
+    def wrote(self):
+        """Pin the reads to the primary for 'pin_seconds'"""
+        self._last_write = time.monotonic()
+
+    def pinned(self):
+        return time.monotonic() - self._last_write < self.pin_seconds
+
+    def pick(self):
+        """Return the engine of the next healthy replica, None if none"""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+                now = time.monotonic()
+                due = now - replica.checked_at >= self.check_interval
+                if due:
+                    # only this thread checks it
+                    replica.checked_at = now
+            if due:
+                self.check(replica)
+            if replica.healthy:
+                replica.reads += 1
+                return replica.engine
+        if self.replicas:
+            self.failovers += 1
+        return None
+
+    @staticmethod
+    def check(replica):
+        """Run a 'SELECT 1' on 'replica', return and remember its health"""
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            replica.healthy = True
+        except DBAPIError:
+            replica.healthy = False
+        return replica.healthy
+
+    def _on_error(self, context):
+        if context.connection is not None and not context.is_disconnect:
+            # an error of the statement, not of the replica
+            return
+        for replica in self.replicas:
+            if replica.engine is context.engine:
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """
+    RoutingSession
+        sends the SELECT statements to a read replica (see ReplicaRouter)
+        when reads were allowed on the replicas (info['replica_reads'], see
+        models.use_replicas) and the session has not written anything yet
+        (read-your-writes); everything else goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.wrote()
+        elif (self.info.get('replica_reads') and
+                not self.info.get('wrote') and
+                isinstance(clause, Select) and
+                clause._for_update_arg is None and
+                not replica_router.pinned()):
+            engine = replica_router.pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def wrote(self):
+        self.info['wrote'] = True
+        replica_router.wrote()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def after_flush(session, flush_context):
+    session.wrote()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSession sessions"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,122 @@
+from collections import Counter
+
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Question, QuizResult, QuestionStats, PlayerScore
+from models import table_versions, notify_question_change
+from quiz_engine import MIN_DIFFICULTY, MAX_DIFFICULTY
+
+# answers recorded per request at most
+RESULTS_MAX = 100
+# longest leaderboard served
+LEADERBOARD_MAX = 100
+# questions whose difficulty is updated per transaction by calibrate()
+CALIBRATE_BATCH_SIZE = 1000
+
+
+def increment(model, key, **deltas):
+    """
+    Add 'deltas' to the columns of the row of 'model' whose primary key is
+    'key' (a dict), inserting the row if needed, without reading it
+    """
+    table = model.__table__
+    where = and_(*(table.c[name] == value for name, value in key.items()))
+    update = table.update().where(where).values(
+        {name: table.c[name] + delta for name, delta in deltas.items()})
+    if db.session.execute(update).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**key, **deltas))
+    except IntegrityError:
+        # inserted by a concurrent transaction in the meantime
+        db.session.execute(update)
+
+
+def record_results(player, category, results):
+    """
+    Append the 'results' ((question id, correct) pairs) of a quiz of
+    'category' (0 for all the categories) played by 'player' to the
+    results log, and add them to the question stats and to the player's
+    scores, in one transaction. Return the player's score in 'category'.
+
+    The aggregates are updated in place, one row per question answered
+    and per leaderboard: nothing is recomputed from the log.
+    """
+    answers = Counter()
+    correct = Counter()
+    for question_id, is_correct in results:
+        answers[question_id] += 1
+        correct[question_id] += int(is_correct)
+    db.session.bulk_insert_mappings(QuizResult, [
+        {'player': player, 'category': category,
+         'question_id': question_id, 'correct': is_correct}
+        for question_id, is_correct in results])
+    # always in the same order, so that concurrent quizzes can't deadlock
+    for question_id in sorted(answers):
+        increment(QuestionStats, {'question_id': question_id},
+                  answers=answers[question_id],
+                  correct=correct[question_id])
+    for scored_category in sorted({0, category}):
+        increment(PlayerScore,
+                  {'category': scored_category, 'player': player},
+                  score=sum(correct.values()), answers=len(results))
+    db.session.commit()
+    table_versions.bump('results')
+    return PlayerScore.query.get((category, player))
+
+
+def leaderboard(category, limit=10):
+    """
+    Return the 'limit' best scores of 'category' (0 for all the
+    categories), best first: a range scan of ix_player_scores_leaderboard
+    """
+    scores = (PlayerScore.query
+              .filter(PlayerScore.category == category)
+              .order_by(PlayerScore.score.desc(), PlayerScore.answers,
+                        PlayerScore.player)
+              .limit(min(limit, LEADERBOARD_MAX)))
+    return [dict(score.format(), rank=rank)
+            for rank, score in enumerate(scores, 1)]
+
+
+def difficulty_for_rate(correct_rate):
+    """
+    Return the difficulty matching the rate of correct answers of a
+    question: the easiest for 80% or more, the hardest below 20%
+    """
+    levels = MAX_DIFFICULTY - MIN_DIFFICULTY + 1
+    return MIN_DIFFICULTY + min(levels - 1, int((1 - correct_rate) * levels))
+
+
+def calibrate(min_answers=20, dry_run=False):
+    """
+    Set the difficulty of the questions answered at least 'min_answers'
+    times from their rate of correct answers (see difficulty_for_rate).
+    Meant to run periodically ('flask trivia calibrate'). Return a report
+    of the questions checked and changed.
+    """
+    rows = (db.session.query(Question.id, Question.difficulty,
+                             QuestionStats.answers, QuestionStats.correct)
+            .join(QuestionStats, QuestionStats.question_id == Question.id)
+            .filter(QuestionStats.answers >= max(1, min_answers))
+            .all())
+    changes = []
+    for question_id, difficulty, answers, correct in rows:
+        calibrated = difficulty_for_rate(correct / answers)
+        if calibrated != difficulty:
+            changes.append({'id': question_id, 'difficulty': calibrated})
+    if changes and not dry_run:
+        for start in range(0, len(changes), CALIBRATE_BATCH_SIZE):
+            db.session.bulk_update_mappings(
+                Question, changes[start:start + CALIBRATE_BATCH_SIZE])
+            db.session.commit()
+        notify_question_change('bulk', None)
+    return {
+        'checked': len(rows),
+        'changed': len(changes),
+        'by_difficulty': dict(sorted(Counter(
+            change['difficulty'] for change in changes).items())),
+        'dry_run': dry_run
+    }
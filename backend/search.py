@@ -0,0 +1,247 @@
+import os
+import re
+import threading
+from collections import Counter
+
+from sqlalchemy import DDL, func, literal_column
+
+from models import db, Question, QUESTIONS_PER_PAGE
+from models import fetch_page, on_question_change
+from models import question_rows_query, format_rows
+
+# text search configuration used by the PostgreSQL full-text index
+TEXT_SEARCH_CONFIG = 'english'
+
+
+def search_document():
+    """
+    Return the tsvector expression indexed by 'ix_questions_search'.
+    Queries must use this exact expression for PostgreSQL to use the index.
+    """
+    config = literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig")
+    return func.to_tsvector(
+        config,
+        func.coalesce(Question.question, literal_column("''"))
+        .op('||')(literal_column("' '"))
+        .op('||')(func.coalesce(Question.answer, literal_column("''"))))
+
+
+create_search_index = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_questions_search ON questions "
+    f"USING gin (to_tsvector('{TEXT_SEARCH_CONFIG}'::regconfig, "
+    "coalesce(question, '') || ' ' || coalesce(answer, '')))"
+).execute_if(dialect='postgresql')
+
+
+def paged_with_total(query, page, pagesize, after_id, with_total=True):
+    """
+    Return one page of the questions selected by 'query' (built on
+    question_rows_query()), formatted, and the total number of matches,
+    counted by a window function in the same query.
+    If 'with_total' is False, nothing is counted and the total is None.
+    """
+    if not with_total:
+        return format_rows(fetch_page(query, page, pagesize, after_id)), None
+    rows = fetch_page(query.add_columns(func.count().over()),
+                      page, pagesize, after_id)
+    if rows:
+        return format_rows(rows), rows[0][-1]
+    if page == 1 and after_id is None:
+        return [], 0
+    # past the last page: the window function had no row to report on
+    return [], query.count()
+
+
+class SubstringSearch:
+    """
+    SubstringSearch
+        compatibility mode: questions containing the search term,
+        case insensitive ('ILIKE %term%'), ordered by id.
+    """
+    ranked = False
+
+    @staticmethod
+    def normalize(term):
+        """Return the key under which the count of 'term' is remembered"""
+        return 'substring:' + term.lower()
+
+    def search(self, term, page=1, pagesize=QUESTIONS_PER_PAGE,
+               after_id=None, with_total=True):
+        """
+        Return a page of matching questions, formatted, and the number of
+        matches
+        """
+        query = question_rows_query().filter(
+            Question.question.ilike(f'%{term}%'))
+        return paged_with_total(query, page, pagesize, after_id, with_total)
+
+
+class FullTextSearch:
+    """
+    FullTextSearch
+        PostgreSQL full-text search on the question and answer texts,
+        backed by a GIN index on their tsvector. Matches are ranked by
+        'ts_rank', except in cursor mode where they are ordered by id.
+    """
+    ranked = True
+
+    @staticmethod
+    def normalize(term):
+        """Return the key under which the count of 'term' is remembered"""
+        return 'fulltext:' + ' '.join(sorted(set(MemorySearch.tokenize(term))))
+
+    def setup(self):
+        """
+        Create the GIN index if it does not exist yet (see
+        'flask trivia init-db')
+        """
+        create_search_index.execute(bind=db.engine, target=None)
+
+    def search(self, term, page=1, pagesize=QUESTIONS_PER_PAGE,
+               after_id=None, with_total=True):
+        """
+        Return a page of matching questions, formatted, and the number of
+        matches
+        """
+        document = search_document()
+        ts_query = func.plainto_tsquery(
+            literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig"), term)
+        query = question_rows_query().filter(document.op('@@')(ts_query))
+        if after_id is None:
+            query = query.order_by(func.ts_rank(document, ts_query).desc())
+        return paged_with_total(query, page, pagesize, after_id, with_total)
+
+
+class MemorySearch:
+    """
+    MemorySearch
+        in-process inverted index on the words of the question and answer
+        texts, for SQLite and the tests. It is built on the first search
+        and kept up to date by the question change listeners. A question
+        matches if it contains all the words of the search term; matches
+        are ranked by the number of occurrences of these words.
+    """
+    ranked = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+        on_question_change(self.on_question_change)
+
+    def reset(self):
+        """Forget the index: it is rebuilt on next search"""
+        with self._lock:
+            self._postings = None
+            self._documents = {}
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r'\w+', (text or '').lower())
+
+    @classmethod
+    def normalize(cls, term):
+        """Return the key under which the count of 'term' is remembered"""
+        return 'memory:' + ' '.join(sorted(set(cls.tokenize(term))))
+
+    def build(self):
+        """(Re)build the index from the questions table"""
+        postings = {}
+        documents = {}
+        rows = (db.session.query(Question.id, Question.question,
+                                 Question.answer)
+                .yield_per(1000))
+        for question_id, question, answer in rows:
+            words = Counter(self.tokenize(question) + self.tokenize(answer))
+            documents[question_id] = words
+            for word, count in words.items():
+                postings.setdefault(word, {})[question_id] = count
+        with self._lock:
+            self._postings = postings
+            self._documents = documents
+
+    def on_question_change(self, action, question):
+        with self._lock:
+            if self._postings is None:
+                return
+            if action == 'bulk':
+                # rebuilt on next search
+                self._postings = None
+                self._documents = {}
+                return
+            for word in self._documents.pop(question.id, ()):
+                self._postings[word].pop(question.id, None)
+            if action == 'delete':
+                return
+            words = Counter(self.tokenize(question.question) +
+                            self.tokenize(question.answer))
+            self._documents[question.id] = words
+            for word, count in words.items():
+                self._postings.setdefault(word, {})[question.id] = count
+
+    def match(self, term):
+        """Return the ids of the questions matching 'term', best first"""
+        if self._postings is None:
+            self.build()
+        words = set(self.tokenize(term))
+        if not words:
+            return []
+        with self._lock:
+            lists = [self._postings.get(word, {}) for word in words]
+            lists.sort(key=len)
+            scores = {question_id: count
+                      for question_id, count in lists[0].items()}
+            for postings in lists[1:]:
+                scores = {question_id: score + postings[question_id]
+                          for question_id, score in scores.items()
+                          if question_id in postings}
+        return sorted(scores, key=lambda question_id: (-scores[question_id],
+                                                       question_id))
+
+    def search(self, term, page=1, pagesize=QUESTIONS_PER_PAGE,
+               after_id=None, with_total=True):
+        """
+        Return a page of matching questions, formatted, and the number of
+        matches
+        """
+        ids = self.match(term)
+        if after_id is not None:
+            page_ids = sorted(question_id for question_id in ids
+                              if question_id > after_id)[:pagesize]
+        else:
+            start = pagesize * (page - 1)
+            page_ids = ids[start:start + pagesize]
+        if not page_ids:
+            return [], len(ids)
+        questions = {question['id']: question for question in format_rows(
+            question_rows_query().filter(Question.id.in_(page_ids)))}
+        return ([questions[question_id] for question_id in page_ids
+                 if question_id in questions], len(ids))
+
+
+SEARCH_BACKENDS = {
+    'substring': SubstringSearch,
+    'fulltext': FullTextSearch,
+    'memory': MemorySearch
+}
+
+_backends = {}
+
+
+def setup_search(app):
+    """
+    Return the search backend selected by the 'SEARCH_BACKEND' setting
+    (env 'TRIVIA_SEARCH_BACKEND'): 'substring' (default), 'fulltext' or
+    'memory'. Its database objects are created by its 'setup()' method, if
+    it has one, run by 'flask trivia init-db'.
+    """
+    name = app.config.get('SEARCH_BACKEND',
+                          os.environ.get('TRIVIA_SEARCH_BACKEND',
+                                         'substring'))
+    if name not in SEARCH_BACKENDS:
+        raise ValueError(f'Unknown search backend: {name}')
+    if name not in _backends:
+        _backends[name] = SEARCH_BACKENDS[name]()
+    backend = _backends[name]
+    if hasattr(backend, 'reset'):
+        backend.reset()
+    return backend
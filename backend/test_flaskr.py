@@ -1,12 +1,34 @@
+import asyncio
+import gzip
 import os
 import random
 import sys
+import tempfile
 import unittest
+from collections import Counter
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+import multiprocessing
+import threading
+import time
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flask import Flask
+from flaskr import create_app, count_pages
+from flaskr.asgi import WSGIBridge, MAX_BODY_IN_MEMORY
+from flaskr.admission import TokenBuckets, ConcurrencyLimiter
+from benchmark import SCENARIOS, run_benchmark
+from bulk import insert_batch
+from cache import SharedLRUCache
+from db_pool import engine_options
+from models import Question, Category
+from models import category_cache, category_fetch_all, db, table_versions
+from models import create_schema, use_replicas, question_fingerprint
+from models import question_fetch_random
+from models import QuizResult, QuestionStats, PlayerScore
+from replicas import replica_router
+from id_index import question_id_index
+from quiz_engine import AdaptiveQuiz
+from werkzeug.exceptions import ServiceUnavailable
 import logging
 
 QUESTIONS_PER_PAGE = 10
@@ -22,19 +44,12 @@ class TriviaTestCase(unittest.TestCase):
         host = 'localhost'
         port = 5432
         db_name = "trivia_test"
-        self.database_path = f"postgresql://" \
-                             f"{username}:{password}@{host}:{port}/{db_name}"
+        self.database_path = os.environ.get(
+            'TRIVIA_TEST_DATABASE_URL',
+            f"postgresql://{username}:{password}@{host}:{port}/{db_name}")
 
-        self.app = create_app()
+        self.app = create_app({'DATABASE_URL': self.database_path})
         self.client = self.app.test_client
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
@@ -52,6 +67,154 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue('categories' in data)
         self.assertGreater(len(data['categories']), 0)
 
+    def test_categories_cache(self):
+        category_fetch_all()
+        hits = category_cache.stats()['hits']
+        category_fetch_all()
+        self.assertEqual(category_cache.stats()['hits'], hits + 1)
+        category = Category(type='Cached category')
+        category.insert()
+        data = self.client().get('/categories').get_json()
+        self.assertEqual(data['categories'][str(category.id)],
+                         'Cached category')
+        category.delete()
+        data = self.client().get('/categories').get_json()
+        self.assertNotIn(str(category.id), data['categories'])
+
+    def test_conditional_get(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/categories',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        category = Category(type='Versioned category')
+        category.insert()
+        res = self.client().get('/categories',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        category.delete()
+
+    def test_compressed_response(self):
+        plain = self.client().get('/questions')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        res = self.client().get('/questions',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertLess(len(res.get_data()), len(plain.get_data()))
+        self.assertEqual(json.loads(gzip.decompress(res.get_data())),
+                         plain.get_json())
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        res = self.client().get('/questions',
+                                headers={'Accept-Encoding': 'gzip',
+                                         'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        # below the size threshold
+        res = self.client().get('/questions/jobs/unknown',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_get_questions_compact(self):
+        full = self.client().get('/questions?page=2').get_json()
+        data = self.client().get('/questions?page=2&compact=1').get_json()
+        self.assertEqual(data['categories'], full['categories'])
+        self.assertEqual(data['questions']['id'],
+                         [question['id'] for question in full['questions']])
+        self.assertEqual(data['questions']['answer'],
+                         [question['answer']
+                          for question in full['questions']])
+        version = data['categories_version']
+        data = self.client().get(
+            f'/questions?compact=1&categories_version={version}').get_json()
+        self.assertNotIn('categories', data)
+        self.assertEqual(data['categories_version'], version)
+        category = Category(type='Compact category')
+        category.insert()
+        data = self.client().get(
+            f'/questions?compact=1&categories_version={version}').get_json()
+        self.assertIn(str(category.id), data['categories'])
+        self.assertNotEqual(data['categories_version'], version)
+        category.delete()
+
+    def test_shared_lru_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache')
+            # one set of 8 slots
+            first = SharedLRUCache(path, size=8 * 1024, slot_size=1024)
+            second = SharedLRUCache(path, size=8 * 1024, slot_size=1024)
+            for key in range(8):
+                first.set(f'key {key}', f'value {key}'.encode())
+            self.assertEqual(second.get('key 0'), b'value 0')
+            second.set('key 8', b'value 8')
+            self.assertIsNone(first.get('key 1'))
+            self.assertEqual(first.get('key 0'), b'value 0')
+            self.assertEqual(first.get('key 8'), b'value 8')
+            self.assertEqual(second.stats()['evictions'], 1)
+            self.assertFalse(first.set('large', b'x' * 1024))
+            first.close()
+            second.close()
+            # laid out differently: starts empty
+            other = SharedLRUCache(path, size=8 * 2048, slot_size=2048)
+            self.assertIsNone(other.get('key 0'))
+            other.close()
+
+    def test_shared_response_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = {
+                'DATABASE_URL': self.database_path,
+                'TABLE_VERSIONS_FILE': os.path.join(directory, 'versions'),
+                'SHARED_CACHE_FILE': os.path.join(directory, 'cache')
+            }
+            # two worker processes
+            first = create_app(config).test_client()
+            second = create_app(config).test_client()
+            expected = first.get('/questions?page=2').get_json()
+            self.assertEqual(second.get('/questions?page=2').get_json(),
+                             expected)
+            metrics = second.get('/metrics').get_data(as_text=True)
+            self.assertIn('trivia_shared_cache_total{result="hit"} 1',
+                          metrics)
+            question = first.post('/questions', json={
+                'question': 'Shared?', 'answer': 'Yes', 'category': 1,
+                'difficulty': 1}).get_json()
+            data = second.get('/questions?page=2').get_json()
+            self.assertEqual(data['total_questions'],
+                             expected['total_questions'] + 1)
+            second.delete(f"/questions/{question['created']}")
+
+    def test_response_cache_ttl(self):
+        config = {'DATABASE_URL': self.database_path, 'HTTP_CACHE_TTL': 1,
+                  'COUNT_MAX_AGE': 0, 'ID_INDEX_MAX_AGE': 0}
+        client = create_app(config).test_client()
+        res = client.get('/questions?page=2')
+        etag = res.headers['ETag']
+        expected = res.get_json()['total_questions']
+
+        # another worker process, without a shared versions file
+        def insert(queue):
+            other = create_app(config).test_client()
+            queue.put(other.post('/questions', json={
+                'question': 'Elsewhere?', 'answer': 'Yes', 'category': 1,
+                'difficulty': 1}).get_json()['created'])
+        queue = multiprocessing.get_context('fork').Queue()
+        process = multiprocessing.get_context('fork').Process(
+            target=insert, args=(queue,))
+        process.start()
+        created = queue.get(timeout=30)
+        process.join()
+        time.sleep(1)
+        res = client.get('/questions?page=2',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['total_questions'], expected + 1)
+        client.delete(f'/questions/{created}')
+        # no expiry: no ETag
+        client = create_app(dict(config, HTTP_CACHE_TTL=0)).test_client()
+        self.assertNotIn('ETag', client.get('/questions').headers)
+
     def test_get_questions_page1(self):
         q_count = Question.query.count()
         c_count = Category.query.count()
@@ -79,6 +242,32 @@ class TriviaTestCase(unittest.TestCase):
             q_count_last if q_count_last > 0 else QUESTIONS_PER_PAGE
         )
 
+    def test_get_questions_last_page_exact_multiple(self):
+        category = Category.query.order_by(Category.id).first().id
+        question_ids = []
+        # make the total a multiple of the page size
+        for number in range(-Question.query.count() % QUESTIONS_PER_PAGE):
+            question = Question(question=f'Filler question {number}?',
+                                answer='Filler', category=category,
+                                difficulty=1)
+            question.insert()
+            question_ids.append(question.id)
+
+        def delete_questions():
+            with self.app.app_context():
+                Question.query.filter(Question.id.in_(question_ids)).delete(
+                    synchronize_session=False)
+                db.session.commit()
+        self.addCleanup(delete_questions)
+        page_num = Question.query.count() // QUESTIONS_PER_PAGE
+        data = self.client().get(f'/questions?page={page_num}').get_json()
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertIsNone(data['next_cursor'])
+        if page_num > 1:
+            data = self.client().get(
+                f'/questions?page={page_num - 1}').get_json()
+            self.assertIsNotNone(data['next_cursor'])
+
     def test_get_questions_inexistant_page(self):
         q_count = Question.query.count()
         page_num = q_count // QUESTIONS_PER_PAGE + 10
@@ -87,6 +276,179 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertFalse(data['success'])
 
+    def test_get_questions_with_cursor(self):
+        ids = [question.id for question in
+               Question.query.order_by(Question.id).all()]
+        fetched_ids = []
+        res = self.client().get('/questions?after_id=0')
+        while True:
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['total_questions'], len(ids))
+            fetched_ids += [question['id'] for question in data['questions']]
+            if data['next_cursor'] is None:
+                break
+            res = self.client().get(
+                f'/questions?cursor={data["next_cursor"]}')
+        self.assertEqual(fetched_ids, ids)
+
+    def test_get_questions_invalid_cursor(self):
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_counts_follow_inserts_and_deletes(self):
+        self.client().get('/questions')
+        question = Question.query.order_by(Question.id).first()
+        category = question.category
+        new_question = Question(question=question.question,
+                                answer=question.answer,
+                                category=category,
+                                difficulty=question.difficulty)
+        new_question.insert()
+        data = self.client().get('/questions').get_json()
+        self.assertEqual(data['total_questions'], Question.query.count())
+        data = self.client().get(
+            f'/categories/{category}/questions').get_json()
+        self.assertEqual(
+            data['total_questions'],
+            Question.query.filter(Question.category == category).count())
+        new_question.delete()
+        data = self.client().get('/questions').get_json()
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+    def test_id_index_follows_changes(self):
+        question = Question.query.order_by(Question.id).first()
+        category = question.category
+        count = question_id_index.count(category)
+        new_question = Question(question=question.question,
+                                answer=question.answer,
+                                category=category,
+                                difficulty=question.difficulty)
+        new_question.insert()
+        new_id = new_question.id
+        self.assertEqual(question_id_index.count(category), count + 1)
+        self.assertIn(new_id, question_id_index.ids(category))
+        rebuilds = question_id_index.rebuilds
+        new_question.delete()
+        self.assertEqual(question_id_index.count(category), count)
+        self.assertNotIn(new_id, question_id_index.ids())
+        self.assertEqual(question_id_index.rebuilds, rebuilds)
+
+    def test_id_index_difficulty_levels(self):
+        question = Question.query.order_by(Question.id).first()
+        others = [row.id for row in Question.query.filter(
+            Question.category == question.category,
+            Question.difficulty == question.difficulty)]
+        self.assertIn(question_id_index.pick(question.category, (),
+                                             question.difficulty), others)
+        others.remove(question.id)
+        self.assertEqual(question_id_index.pick(question.category, others,
+                                                question.difficulty),
+                         question.id)
+        difficulty = question.difficulty
+        question.difficulty = difficulty % 5 + 1
+        question.update()
+        self.assertIsNone(question_id_index.pick(question.category, others,
+                                                 difficulty))
+        self.assertIn(question.id,
+                      question_id_index.ids(question.category))
+        question.difficulty = difficulty
+        question.update()
+
+    def test_id_index_rebuilds(self):
+        category = Question.query.order_by(Question.id).first().category
+        count = question_id_index.count(category)
+        rebuilds = question_id_index.rebuilds
+        # another worker process wrote
+        question_id_index.rebuild_interval = 60
+        table_versions.bump('questions')
+        self.assertEqual(question_id_index.count(category), count)
+        self.assertEqual(question_id_index.rebuilds, rebuilds)
+        # the other threads do not wait for a rebuild
+        question_id_index.rebuild_interval = 0
+        with question_id_index._build_lock:
+            self.assertEqual(question_id_index.count(category), count)
+        self.assertEqual(question_id_index.rebuilds, rebuilds)
+        # a change made during a rebuild is not lost
+        build = question_id_index._build
+        question = Question(question='Inserted during a rebuild?',
+                            answer='Yes', category=category, difficulty=1)
+
+        def build_and_insert():
+            arrays = build()
+            question.insert()
+            return arrays
+        with mock.patch.object(question_id_index, '_build',
+                               build_and_insert):
+            self.assertEqual(question_id_index.count(category), count + 1)
+        self.assertEqual(question_id_index.rebuilds, rebuilds + 1)
+        self.assertEqual(question_id_index.count(category), count + 1)
+        self.assertIn(question.id, question_id_index.ids(category))
+        self.assertEqual(question_id_index.rebuilds, rebuilds + 1)
+        question.delete()
+
+    def test_id_index_stale_page(self):
+        question = Question.query.order_by(Question.id.desc()).first()
+        expected = [row.format() for row in
+                    Question.query.order_by(Question.id).limit(10)]
+        question_id_index.count()
+        # changed behind the index's back (e.g. by another process)
+        db.session.delete(question)
+        db.session.commit()
+        ids = question_id_index.ids()
+        self.assertIn(question.id, ids)
+        page_count = (len(ids) + 9) // 10
+        last_page = question_id_index.fetch_page(page=page_count)
+        self.assertNotIn(question.id, [row['id'] for row in last_page])
+        self.assertEqual(question_id_index.fetch_page(page=1), expected)
+        db.session.add(Question(id=question.id, question=question.question,
+                                answer=question.answer,
+                                category=question.category,
+                                difficulty=question.difficulty))
+        db.session.commit()
+
+    def wait_for_job(self, client, job_id):
+        deadline = time.monotonic() + 10
+        while True:
+            res = client.get(f'/questions/jobs/{job_id}')
+            job = res.get_json()['job']
+            if job['status'] != 'pending' or time.monotonic() > deadline:
+                return job
+            time.sleep(0.01)
+
+    def test_write_behind(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'WRITE_BEHIND': 'true',
+                          'WRITE_BATCH_LINGER_MS': 50})
+        client = app.test_client()
+        total = client.get('/questions').get_json()['total_questions']
+        question = Question.query.order_by(Question.id).first()
+        job_ids = []
+        for number in range(3):
+            res = client.post('/questions', json={
+                'question': f'Write-behind question {number}?',
+                'answer': question.answer,
+                'category': question.category,
+                'difficulty': question.difficulty})
+            self.assertEqual(res.status_code, 202)
+            job_ids.append(res.get_json()['job_id'])
+        jobs = [self.wait_for_job(client, job_id) for job_id in job_ids]
+        self.assertEqual([job['status'] for job in jobs], ['done'] * 3)
+        data = client.get('/questions').get_json()
+        self.assertEqual(data['total_questions'], total + 3)
+        for job in jobs:
+            res = client.delete(f"/questions/{job['question_id']}")
+            self.assertEqual(res.status_code, 202)
+            job = self.wait_for_job(client, res.get_json()['job_id'])
+            self.assertEqual(job['status'], 'done')
+            self.assertIsNone(Question.query.get(job['question_id']))
+        data = client.get('/questions').get_json()
+        self.assertEqual(data['total_questions'], total)
+        res = client.get('/questions/jobs/unknown')
+        self.assertEqual(res.status_code, 404)
+
     def test_delete_question(self):
         question = Question.query.order_by(Question.id).first()
         new_question = Question(question=question.question,
@@ -114,6 +476,7 @@ class TriviaTestCase(unittest.TestCase):
         question = Question.query.order_by(Question.id).first()
         new_question = question.format()
         del new_question['id']
+        new_question['question'] = 'Which question is brand new?'
         old_questions_count = Question.query.count()
         res = self.client().post('/questions', json=new_question)
         new_questions_count = Question.query.count()
@@ -125,6 +488,19 @@ class TriviaTestCase(unittest.TestCase):
         question = Question.query.get(data['created'])
         question.delete()
 
+    def test_insert_duplicate_question(self):
+        question = Question.query.order_by(Question.id).first()
+        new_question = question.format()
+        del new_question['id']
+        new_question['question'] = f"  {question.question.upper()}!! "
+        old_questions_count = Question.query.count()
+        res = self.client().post('/questions', json=new_question)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 409)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['duplicate_of'], question.id)
+        self.assertEqual(Question.query.count(), old_questions_count)
+
     def test_search_by_term(self):
         # Select random question
         question = random.choice(Question.query.all())
@@ -149,6 +525,127 @@ class TriviaTestCase(unittest.TestCase):
                 min(QUESTIONS_PER_PAGE, rc)
             )
 
+    def test_search_answers_with_memory_index(self):
+        app = create_app({'SEARCH_BACKEND': 'memory',
+                          'DATABASE_URL': self.database_path})
+        question = Question.query.order_by(Question.id).first()
+        res = app.test_client().post('/questions',
+                                     json={'searchTerm': question.answer})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertGreaterEqual(data['total_questions'], 1)
+        self.assertLessEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+
+    def test_import_and_export_questions(self):
+        category = Category.query.order_by(Category.id).first()
+        lines = [
+            json.dumps({'question': 'Imported question?', 'answer': 'Yes',
+                        'category': category.id, 'difficulty': 1}),
+            json.dumps({'question': 'No answer?', 'category': category.id,
+                        'difficulty': 1}),
+            'not json'
+        ]
+        old_questions_count = Question.query.count()
+        res = self.client().post('/questions/import',
+                                 data='\n'.join(lines))
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+        self.assertEqual(Question.query.count(), old_questions_count + 1)
+        res = self.client().get('/questions/export')
+        exported = [json.loads(line) for line in
+                    res.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(exported), old_questions_count + 1)
+        imported = [question for question in exported
+                    if question['question'] == 'Imported question?']
+        Question.query.get(imported[0]['id']).delete()
+
+    def test_import_invalid_utf8(self):
+        category = Category.query.order_by(Category.id).first().id
+        line = json.dumps({'question': 'Imported after a bad line?',
+                           'answer': 'Yes', 'category': category,
+                           'difficulty': 1})
+        res = self.client().post('/questions/import',
+                                 data=b'\xff\xfe{}\n' + line.encode())
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([error['line'] for error in data['errors']], [1])
+        self.assertIn('utf-8', data['errors'][0]['error'])
+        rows = (f'question,answer,category,difficulty\n'
+                f'Bad \xe9ncoding?,No,{category},1\n'
+                f'Imported from CSV?,Yes,{category},1\n')
+        res = self.client().post('/questions/import?format=csv',
+                                 data=rows.encode('latin-1'))
+        data = res.get_json()
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([error['line'] for error in data['errors']], [2])
+        for question in Question.query.filter(Question.question.in_([
+                'Imported after a bad line?', 'Imported from CSV?'])):
+            question.delete()
+
+    def test_import_duplicate_questions(self):
+        question = Question.query.order_by(Question.id).first()
+        question_id, category = question.id, question.category
+        lines = [json.dumps({'question': text, 'answer': 'Yes',
+                             'category': category, 'difficulty': 1})
+                 for text in [question.question, 'Imported once?',
+                              'imported, ONCE?']]
+        old_questions_count = Question.query.count()
+        res = self.client().post('/questions/import',
+                                 data='\n'.join(lines))
+        data = res.get_json()
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['duplicates'], 2)
+        self.assertEqual(data['errors'], [
+            {'line': 1, 'error': f'duplicate of question {question_id}'},
+            {'line': 3, 'error': 'duplicate of line 2'}])
+        self.assertEqual(Question.query.count(), old_questions_count + 1)
+        Question.query.filter_by(question='Imported once?').one().delete()
+
+    def test_insert_batch_fingerprints(self):
+        category = Category.query.order_by(Category.id).first().id
+        # like the synthetic questions of benchmark.seed
+        insert_batch([{'question': 'Seeded without fingerprint?',
+                       'answer': 'Yes', 'category': category,
+                       'difficulty': 1}])
+        question = Question.query.filter_by(
+            question='Seeded without fingerprint?').one()
+        self.assertEqual(question.fingerprint,
+                         question_fingerprint('Seeded without fingerprint?'))
+        question.delete()
+
+    def test_dedup(self):
+        category = Category.query.order_by(Category.id).first().id
+        question_ids = []
+        for text in ['Which river is the longest river in Africa?',
+                     'Which river is the longest river in Africa today?']:
+            question = Question(question=text, answer='The Nile',
+                                category=category, difficulty=2)
+            question.insert()
+            question_ids.append(question.id)
+
+        def delete_questions():
+            with self.app.app_context():
+                Question.query.filter(Question.id.in_(question_ids)).delete(
+                    synchronize_session=False)
+                db.session.commit()
+        self.addCleanup(delete_questions)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['trivia', 'dedup'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        pairs = [json.loads(line) for line in result.output.splitlines()]
+        self.assertIn(question_ids, [[pair['id'], pair['duplicate']]
+                                     for pair in pairs if 'id' in pair])
+        result = runner.invoke(args=['trivia', 'dedup', '--delete'])
+        self.assertEqual(json.loads(result.output.splitlines()[-1])['deleted'],
+                         1)
+        self.assertIsNotNone(Question.query.get(question_ids[0]))
+        self.assertIsNone(Question.query.get(question_ids[1]))
+
     def test_questions_by_category(self):
         # select categories_count <= 10 random categories
         categories_count = min(Category.query.count(), QUESTIONS_PER_PAGE)
@@ -224,6 +721,587 @@ class TriviaTestCase(unittest.TestCase):
             self.assertNotIn(data['question']['id'], previous_questions)
             previous_questions.append(data['question']['id'])
 
+    def test_fetch_random_uniform(self):
+        category = Category(type='Sparse category')
+        category.insert()
+        other = Category.query.order_by(Category.id).first().id
+        questions = []
+        # a gap of 8 ids in front of the second question of the category
+        for number, category_id in enumerate(
+                [category.id] + [other] * 8 + [category.id] * 3):
+            question = Question(question=f'Sparse {number}?', answer='Yes',
+                                category=category_id, difficulty=1)
+            question.insert()
+            questions.append(question)
+
+        def cleanup():
+            for question in questions:
+                question.delete()
+            category.delete()
+        self.addCleanup(cleanup)
+        ids = [question.id for question in questions
+               if question.category == category.id]
+        draws = Counter(question_fetch_random(category=category.id).id
+                        for _ in range(400))
+        self.assertEqual(set(draws), set(ids))
+        # 100 each expected
+        self.assertGreater(min(draws.values()), 50, draws)
+        first = question_fetch_random(category=category.id, exclude=ids[1:])
+        self.assertEqual(first.id, ids[0])
+        self.assertIsNone(question_fetch_random(category=category.id,
+                                                exclude=ids))
+
+    def test_play_quiz_batch(self):
+        category = random.choice(Category.query.all())
+        questions_count = (Question.query
+                           .filter(Question.category == category.id)
+                           .count())
+        previous_questions = []
+        while True:
+            res = self.client().post('/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': category.format(),
+                'n': 2
+            })
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            if not data['questions']:
+                break
+            self.assertLessEqual(len(data['questions']), 2)
+            for question in data['questions']:
+                self.assertEqual(question['category'], category.id)
+                self.assertNotIn(question['id'], previous_questions)
+                previous_questions.append(question['id'])
+        self.assertEqual(len(previous_questions), questions_count)
+        # all categories
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [], 'quiz_category': {'id': 0}, 'n': 5})
+        ids = [question['id'] for question in res.get_json()['questions']]
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_play_quiz_batch_invalid_size(self):
+        for n in (0, 'x', 1000):
+            res = self.client().post('/quizzes', json={
+                'previous_questions': [], 'quiz_category': {'id': 0},
+                'n': n})
+            self.assertEqual(res.status_code, 400)
+
+    def test_adaptive_quiz_target(self):
+        engine = AdaptiveQuiz(start=2, step_up=2, step_down=1)
+        self.assertEqual(engine.target([]), 2)
+        self.assertEqual(engine.target([True]), 2)
+        self.assertEqual(engine.target([True, True]), 3)
+        self.assertEqual(engine.target([True, True, True]), 3)
+        self.assertEqual(engine.target([True] * 4), 4)
+        self.assertEqual(engine.target([True] * 20), 5)
+        self.assertEqual(engine.target([True, True, False]), 2)
+        self.assertEqual(engine.target([False] * 5), 1)
+        self.assertEqual(engine.levels(4), [4, 3, 5, 2, 1])
+
+    def test_play_adaptive_quiz(self):
+        data = {'previous_questions': [], 'quiz_category': {'id': 0},
+                'answers': [True] * 4}
+        res = self.client().post('/quizzes', json=data)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['difficulty'], 4)
+        self.assertEqual(data['question']['difficulty'], 4)
+        # no question of the target difficulty left: the nearest level
+        excluded = [question.id for question in
+                    Question.query.filter(Question.difficulty == 4)]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': excluded, 'quiz_category': {'id': 0},
+            'answers': [True] * 4})
+        data = res.get_json()
+        self.assertEqual(data['difficulty'], 4)
+        self.assertEqual(data['question']['difficulty'], 3)
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [], 'quiz_category': {'id': 0},
+            'answers': ['yes']})
+        self.assertEqual(res.status_code, 400)
+
+    def test_play_quiz_session(self):
+        category = random.choice(Category.query.all())
+        questions_count = (Question.query
+                           .filter(Question.category == category.id)
+                           .count())
+        res = self.client().post('/quizzes/sessions',
+                                 json={'quiz_category': category.format()})
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], questions_count)
+        session_id = data['session_id']
+        played = []
+        while True:
+            res = self.client().post('/quizzes',
+                                     json={'session_id': session_id})
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            if data['question'] is None:
+                break
+            self.assertEqual(data['question']['category'], category.id)
+            self.assertNotIn(data['question']['id'], played)
+            played.append(data['question']['id'])
+        self.assertEqual(len(played), questions_count)
+
+    def test_play_quiz_session_batch(self):
+        questions_count = Question.query.count()
+        res = self.client().post('/quizzes/sessions',
+                                 json={'quiz_category': {'id': 0}})
+        session_id = res.get_json()['session_id']
+        played = []
+        while True:
+            res = self.client().post('/quizzes', json={
+                'session_id': session_id, 'n': 4})
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            if not data['questions']:
+                break
+            played.extend(question['id'] for question in data['questions'])
+        self.assertEqual(sorted(set(played)), sorted(played))
+        self.assertEqual(len(played), questions_count)
+
+    def test_play_quiz_unknown_session(self):
+        res = self.client().post('/quizzes', json={'session_id': 'unknown'})
+        self.assertEqual(res.status_code, 404)
+        for session_id in [['x'], {'id': 'x'}, 1]:
+            res = self.client().post('/quizzes',
+                                     json={'session_id': session_id})
+            self.assertEqual(res.status_code, 400, session_id)
+        for quiz_category in [3, {'id': 'all'}]:
+            res = self.client().post('/quizzes/sessions',
+                                     json={'quiz_category': quiz_category})
+            self.assertEqual(res.status_code, 400, quiz_category)
+
+    def delete_results(self):
+        with self.app.app_context():
+            for model in (QuizResult, QuestionStats, PlayerScore):
+                model.query.delete()
+            db.session.commit()
+
+    def test_quiz_results(self):
+        with self.app.app_context():
+            create_schema()
+        self.delete_results()
+        self.addCleanup(self.delete_results)
+        questions = [(question.id, question.category) for question in
+                     Question.query.order_by(Question.id).limit(2)]
+        category = questions[0][1]
+        for player, correct in (('alice', [True, True]),
+                                ('bob', [True, False]),
+                                ('carol', [False, True])):
+            res = self.client().post('/quizzes/results', json={
+                'player': player,
+                'quiz_category': {'id': category},
+                'results': [{'question_id': question_id, 'correct': answer}
+                            for (question_id, _), answer in zip(questions,
+                                                                correct)]})
+            data = res.get_json()
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(data['score'], sum(correct))
+            self.assertEqual(data['answers'], 2)
+        data = self.client().get(
+            f'/leaderboard?category={category}&limit=2').get_json()
+        self.assertEqual([(row['rank'], row['player'], row['score'])
+                          for row in data['leaderboard']],
+                         [(1, 'alice', 2), (2, 'bob', 1)])
+        # all the categories
+        data = self.client().get('/leaderboard').get_json()
+        self.assertEqual(len(data['leaderboard']), 3)
+        data = self.client().get(
+            f'/questions/{questions[0][0]}/stats').get_json()
+        self.assertEqual(data['stats']['answers'], 3)
+        self.assertEqual(data['stats']['correct'], 2)
+        self.assertEqual(QuizResult.query.count(), 6)
+
+    def test_quiz_results_invalid(self):
+        question = Question.query.order_by(Question.id).first()
+        res = self.client().post('/quizzes/results', json={
+            'player': 'alice', 'quiz_category': {'id': 0},
+            'results': [{'question_id': question.id, 'correct': 'yes'}]})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post('/quizzes/results', json={
+            'player': 'alice', 'quiz_category': {'id': 0},
+            'results': [{'question_id': 0, 'correct': True}]})
+        self.assertEqual(res.status_code, 422)
+        for quiz_category in [3, {'id': 'all'}, {'id': None}]:
+            res = self.client().post('/quizzes/results', json={
+                'player': 'alice', 'quiz_category': quiz_category,
+                'results': [{'question_id': question.id, 'correct': True}]})
+            self.assertEqual(res.status_code, 400, quiz_category)
+        res = self.client().get('/leaderboard?limit=1000')
+        self.assertEqual(res.status_code, 400)
+
+    def test_calibrate(self):
+        with self.app.app_context():
+            create_schema()
+        self.delete_results()
+        self.addCleanup(self.delete_results)
+        question = Question.query.order_by(Question.id).first()
+        question_id, difficulty = question.id, question.difficulty
+
+        def restore_difficulty():
+            with self.app.app_context():
+                Question.query.get(question_id).difficulty = difficulty
+                db.session.commit()
+        self.addCleanup(restore_difficulty)
+        hard = 5 if difficulty != 5 else 4
+        # answered correctly 10% or 30% of the time
+        correct = 1 if hard == 5 else 3
+        self.client().post('/quizzes/results', json={
+            'player': 'alice', 'quiz_category': {'id': 0},
+            'results': [{'question_id': question_id,
+                         'correct': answer < correct}
+                        for answer in range(10)]})
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['trivia', 'calibrate',
+                                     '--min-answers', '10', '--dry-run'])
+        self.assertEqual(json.loads(result.output)['changed'], 1)
+        result = runner.invoke(args=['trivia', 'calibrate',
+                                     '--min-answers', '10'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        data = self.client().get(f'/questions/{question_id}/stats').get_json()
+        self.assertEqual(data['stats']['difficulty'], hard)
+
+    def test_rate_limits(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'RATE_LIMITS': 'play_quiz=2/60, get_questions=5/1',
+                          'RATE_LIMIT_API_KEYS': 'bot-key'})
+        client = app.test_client()
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 0}}
+        statuses = [client.post('/quizzes', json=quiz).status_code
+                    for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        res = client.post('/quizzes', json=quiz)
+        self.assertFalse(res.get_json()['success'])
+        # one request every 30 seconds once the burst is spent
+        self.assertGreater(int(res.headers['Retry-After']), 25)
+        res = client.post('/quizzes', json=quiz,
+                          headers={'X-API-Key': 'bot-key'})
+        self.assertEqual(res.status_code, 200)
+        # unknown keys share the bucket of their address
+        res = client.post('/quizzes', json=quiz,
+                          headers={'X-API-Key': 'made-up'})
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(client.get('/questions').status_code, 200)
+        text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('trivia_rate_limited_total{endpoint="play_quiz"} 3',
+                      text)
+
+    def test_shared_token_buckets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits')
+            first = TokenBuckets(path, slots=4)
+            second = TokenBuckets(path, slots=4)
+            self.assertEqual(first.take('client', rate=1, burst=2), 0)
+            self.assertEqual(second.take('client', rate=1, burst=2), 0)
+            self.assertGreater(first.take('client', rate=1, burst=2), 0.9)
+            # a set of 4 slots: the 5th key evicts the least recent one
+            for key in range(4):
+                second.take(f'other {key}', rate=1, burst=2)
+            self.assertEqual(first.take('client', rate=1, burst=2), 0)
+            first.close()
+            second.close()
+
+    def test_token_buckets_clock(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits')
+            buckets = TokenBuckets(path, slots=4)
+            buckets.take('client', rate=1, burst=1)
+            # a slot updated 'in the future', e.g. before a reboot
+            digest, offsets = buckets._set('client')
+            for offset in offsets:
+                slot_digest, tokens, updated = TokenBuckets.SLOT.unpack_from(
+                    buckets._map, offset)
+                if slot_digest == digest:
+                    TokenBuckets.SLOT.pack_into(
+                        buckets._map, offset, digest, tokens,
+                        time.monotonic_ns() + 3600 * 10 ** 9)
+            self.assertLessEqual(buckets.take('client', rate=1, burst=1), 1)
+            buckets.close()
+            # the file of another boot starts empty
+            with open(path, 'r+b') as file:
+                file.seek(TokenBuckets.HEADER.size - 16)
+                file.write(b'\xff' * 16)
+            buckets = TokenBuckets(path, slots=4)
+            self.assertEqual(buckets.take('client', rate=1, burst=1), 0)
+            buckets.close()
+
+    def test_concurrency_limit(self):
+        limiter = ConcurrencyLimiter(1, timeout=0)
+        with self.app.test_request_context('/questions'):
+            limiter.before_request()
+            # another request, with its own 'g'
+            with self.app.app_context(), \
+                    self.app.test_request_context('/questions'):
+                with self.assertRaises(ServiceUnavailable):
+                    limiter.before_request()
+                limiter.teardown_request(None)
+            self.assertEqual(limiter.in_flight, 1)
+            limiter.teardown_request(None)
+        self.assertEqual((limiter.in_flight, limiter.shed), (0, 1))
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'MAX_CONCURRENT_REQUESTS': 2})
+        self.assertEqual(app.test_client().get('/questions').status_code,
+                         200)
+
+    def test_publish(self):
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+
+            def publish():
+                result = runner.invoke(args=['trivia', 'publish', directory])
+                self.assertEqual(result.exit_code, 0, result.output)
+                with open(os.path.join(directory, 'index.json')) as file:
+                    return json.loads(result.output), json.load(file)
+
+            def shard(name):
+                with open(os.path.join(directory, name)) as file:
+                    return json.load(file)
+            report, index = publish()
+            data = self.client().get('/questions').get_json()
+            listing = index['questions']
+            self.assertEqual(listing['total_questions'],
+                             data['total_questions'])
+            pages = shard(listing['pages'])['pages']
+            self.assertEqual(len(pages), count_pages(data['total_questions']))
+            self.assertEqual(shard(pages[0])['questions'], data['questions'])
+            self.assertEqual(shard(index['categories'])['categories'],
+                             data['categories'])
+            category = Category.query.order_by(Category.id).first().id
+            listing = index['by_category'][str(category)]
+            data = self.client().get(
+                f'/categories/{category}/questions').get_json()
+            self.assertEqual(listing['total_questions'],
+                             data['total_questions'])
+            pages = shard(listing['pages'])['pages']
+            self.assertEqual(shard(pages[0])['questions'], data['questions'])
+            manifest = shard(index['manifest'])
+            self.assertEqual(len(manifest['ids']),
+                             index['questions']['total_questions'])
+            self.assertEqual(report['written'], report['shards'])
+            # nothing changed: nothing written
+            report, index = publish()
+            self.assertEqual((report['version'], report['written']), (1, 0))
+            question = Question(question='Which shard am I in?',
+                                answer='The last one', category=category,
+                                difficulty=1)
+            question.insert()
+            question_id = question.id
+
+            def delete_question():
+                with self.app.app_context():
+                    Question.query.filter_by(id=question_id).delete()
+                    db.session.commit()
+            self.addCleanup(delete_question)
+            # the last page and page list of the two listings, the manifest
+            report, index = publish()
+            self.assertEqual((report['version'], report['written']), (2, 5))
+            listing = index['by_category'][str(category)]
+            last_page = shard(shard(listing['pages'])['pages'][-1])
+            self.assertEqual(last_page['questions'][-1]['question'],
+                             'Which shard am I in?')
+
+    def test_publish_uncategorised_question(self):
+        question = Question(question='Which category am I in?',
+                            answer='None', category=None, difficulty=1)
+        question.insert()
+        question_id = question.id
+
+        def delete_question():
+            with self.app.app_context():
+                Question.query.filter_by(id=question_id).delete()
+                db.session.commit()
+        self.addCleanup(delete_question)
+        with tempfile.TemporaryDirectory() as directory:
+            result = self.app.test_cli_runner().invoke(
+                args=['trivia', 'publish', directory])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(os.path.join(directory, 'index.json')) as file:
+                index = json.load(file)
+            with open(os.path.join(directory, index['manifest'])) as file:
+                manifest = json.load(file)
+            self.assertEqual(manifest['ids'][-1], question_id)
+            self.assertIsNone(manifest['categories'][-1])
+            self.assertEqual(index['questions']['total_questions'],
+                             len(manifest['ids']))
+            self.assertEqual(
+                sum(listing['total_questions']
+                    for listing in index['by_category'].values()),
+                len(manifest['ids']) - 1)
+
+    def test_pool_metrics(self):
+        res = self.client().get('/metrics/pool')
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn('class', data['pool'])
+
+    def test_pool_statement_timeout(self):
+        url = 'postgresql://trivia@localhost/trivia'
+        app = Flask(__name__)
+        app.config['DB_STATEMENT_TIMEOUT'] = 5000
+        self.assertEqual(engine_options(app, url)['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+        # behind PgBouncer: not applied, but not silently either
+        app.config['DB_POOLING'] = 'null'
+        with self.assertLogs(app.logger, 'WARNING'):
+            self.assertNotIn('connect_args', engine_options(app, url))
+
+    def test_prometheus_metrics(self):
+        self.client().get('/questions')
+        res = self.client().get('/metrics')
+        text = res.get_data(as_text=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count'
+                      '{route="/questions",method="GET"} 1', text)
+        self.assertIn('trivia_request_sql_statements_bucket', text)
+
+    def test_in_memory_database(self):
+        app = create_app({'DATABASE_URL': 'sqlite://'})
+        result = app.test_cli_runner().invoke(args=['trivia', 'init-db'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with app.app_context():
+            category = Category(type='Science')
+            category.insert()
+            Question(question='Which planet is the largest?',
+                     answer='Jupiter', category=category.id,
+                     difficulty=1).insert()
+        responses = []
+        # other threads share the same in-memory database
+        thread = threading.Thread(target=lambda: responses.append(
+            app.test_client().get('/questions').get_json()))
+        thread.start()
+        thread.join()
+        self.assertEqual(responses[0]['total_questions'], 1)
+        self.assertEqual(responses[0]['questions'][0]['answer'], 'Jupiter')
+
+    def test_read_replicas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = [f'sqlite:///{directory}/{name}.db'
+                    for name in ('primary', 'replica')]
+            broken = f'sqlite:///{directory}/missing/replica.db'
+            app = create_app({'DATABASE_URL': urls[0],
+                              'REPLICA_URLS': [urls[1], broken],
+                              'REPLICA_PIN_SECONDS': 60,
+                              'HTTP_CACHE_SIZE': 0})
+            # the same schema, different content
+            db.metadata.create_all(replica_router.replicas[0].engine)
+            with app.app_context():
+                create_schema()
+                Category(type='Primary').insert()
+            with replica_router.replicas[0].engine.begin() as connection:
+                connection.execute(Category.__table__.insert(),
+                                   {'id': 1, 'type': 'Replica'})
+            replica_router.pin_seconds = 0
+            client = app.test_client()
+            for _ in range(3):
+                category_cache.reset()
+                data = client.get('/categories').get_json()
+                self.assertEqual(data['categories'], {'1': 'Replica'})
+            # the broken replica is skipped
+            self.assertFalse(replica_router.replicas[1].healthy)
+            self.assertEqual(replica_router.replicas[0].reads, 3)
+
+            def category_type():
+                return db.session.query(Category.type).filter(
+                    Category.id == 1).scalar()
+
+            with app.test_request_context():
+                use_replicas()
+                self.assertEqual(category_type(), 'Replica')
+                Question(question='Where?', answer='Primary', category=1,
+                         difficulty=1).insert()
+                # read-your-writes
+                self.assertEqual(category_type(), 'Primary')
+                self.assertEqual(Question.query.count(), 1)
+            replica_router.pin_seconds = 60
+            replica_router.wrote()
+            with app.test_request_context():
+                use_replicas()
+                self.assertEqual(category_type(), 'Primary')
+            replica_router.configure([])
+
+    def test_asgi_bridge(self):
+        bridge = WSGIBridge(self.app, max_workers=2)
+        request_body = json.dumps({'searchTerm': 'what'}).encode()
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': request_body,
+                    'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': '/questions', 'root_path': '',
+            'query_string': b'', 'server': ('localhost', 80),
+            'client': ('127.0.0.1', 5000),
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(request_body)).encode())]
+        }
+        asyncio.run(bridge(scope, receive, send))
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        self.assertEqual(messages[0]['status'], 200)
+        data = json.loads(b''.join(message.get('body', b'')
+                                   for message in messages[1:]))
+        self.assertTrue(data['success'])
+        self.assertGreater(data['total_questions'], 0)
+
+    def test_asgi_bridge_disconnect(self):
+        bridge = WSGIBridge(self.app, max_workers=1)
+        bodies = []
+
+        class Body(tempfile.SpooledTemporaryFile):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                bodies.append(self)
+        messages = iter([
+            {'type': 'http.request', 'body': b'x' * (MAX_BODY_IN_MEMORY + 1),
+             'more_body': True},
+            {'type': 'http.disconnect'}])
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            self.fail('nothing to send to a client which left')
+        scope = {'type': 'http', 'method': 'POST', 'path': '/questions/import',
+                 'query_string': b'', 'headers': []}
+        with mock.patch('tempfile.SpooledTemporaryFile', Body):
+            asyncio.run(bridge(scope, receive, send))
+        self.assertTrue(bodies[0].closed)
+
+    def test_asgi_environ_cookies(self):
+        environ = WSGIBridge.environ({
+            'method': 'GET', 'path': '/', 'query_string': b'',
+            'http_version': '1.1',
+            'headers': [(b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                        (b'accept', b'text/html'),
+                        (b'accept', b'application/json')]}, None)
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,application/json')
+
+    def test_benchmark_read_routes(self):
+        with self.app.app_context():
+            create_schema()
+        scenarios = [scenario for scenario in SCENARIOS
+                     if not scenario.writes]
+        results = run_benchmark(self.app, ['client'], 3, 2,
+                                random.Random(0), scenarios,
+                                log=lambda line: None)
+        self.assertEqual([result['scenario'] for result in results],
+                         [scenario.name for scenario in scenarios])
+        for result in results:
+            self.assertEqual(result['errors'], 0, result['scenario'])
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertIsNotNone(result['sql_per_request'])
+        sql = {result['scenario']: result['sql_per_request']
+               for result in results}
+        self.assertGreaterEqual(sql['questions_page'], 1)
+
     def test_play_quiz_missing_request(self):
         # querying with missing data
         data = {}
@@ -243,7 +1321,7 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_play_quiz_invalid_category(self):
         # calculating an invalid category_id
-        category = Category.query.order_by(self.db.desc(Category.id)).first()
+        category = Category.query.order_by(Category.id.desc()).first()
         category_id = category.id + 1
         data = {
             'previous_questions': [],
@@ -0,0 +1,233 @@
+import atexit
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, Question, notify_question_change
+
+
+class WriteQueue:
+    """
+    WriteQueue
+        write-behind for question inserts and deletes: requests enqueue
+        their write and return at once with a job id, and a background
+        thread commits the queued writes in groups of up to 'batch_size',
+        waiting at most 'linger' seconds for a group to fill, so that a
+        burst of writes costs one transaction instead of one per request.
+
+        The change listeners (caches, counters, indexes) are notified only
+        once a group is committed, so they never show uncommitted writes.
+        When a group fails, its writes are retried one per transaction so
+        that a bad write only fails its own job.
+
+        The status of the last 'max_jobs' jobs is kept in memory, in this
+        process only.
+    """
+
+    def __init__(self, app, max_size=1000, batch_size=100, linger=0.02,
+                 max_jobs=100000):
+        self.app = app
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=max_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.committed = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='trivia-write-queue')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit_insert(self, fields):
+        """
+        Queue the insert of a question with 'fields', return the job id.
+        Raise queue.Full if the queue is full.
+        """
+        return self._submit('insert', fields)
+
+    def submit_delete(self, question_id):
+        """
+        Queue the delete of the question 'question_id', return the job id.
+        Raise queue.Full if the queue is full.
+        """
+        return self._submit('delete', question_id)
+
+    def _submit(self, action, argument):
+        job_id = secrets.token_urlsafe(12)
+        job = {'id': job_id, 'action': action, 'status': 'pending',
+               'question_id': argument if action == 'delete' else None,
+               'error': None}
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        try:
+            self._queue.put_nowait((job, argument))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            raise
+        return job_id
+
+    def status(self, job_id):
+        """Return the status of the job 'job_id', or None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def pending(self):
+        """Return the number of writes waiting in the queue"""
+        return self._queue.qsize()
+
+    def flush(self):
+        """Wait until all the queued writes are committed or failed"""
+        self._queue.join()
+
+    def close(self):
+        """Commit the queued writes and stop the worker thread"""
+        if self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+
+    def _run(self):
+        with self.app.app_context():
+            # the objects stay loaded after commit: the listeners read them
+            session = db.create_scoped_session(
+                {'expire_on_commit': False})
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch is None:
+                        return
+                    try:
+                        self._commit(session, batch)
+                    except Exception:
+                        self.app.logger.exception('Write queue: batch lost')
+            finally:
+                session.remove()
+
+    def _next_batch(self):
+        """
+        Wait for a write, then gather the following ones for up to
+        'linger' seconds; return None when the queue is closed
+        """
+        job, argument = self._queue.get()
+        if job is None:
+            self._queue.task_done()
+            return None
+        batch = [(job, argument)]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                job, argument = (self._queue.get(timeout=timeout)
+                                 if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if job is None:
+                # stop once this batch is committed
+                self._queue.put((None, None))
+                self._queue.task_done()
+                break
+            batch.append((job, argument))
+        return batch
+
+    def _commit(self, session, batch):
+        try:
+            try:
+                changes, outcomes = self._apply(session, batch)
+                session.commit()
+            except Exception:
+                session.rollback()
+                changes, outcomes = [], []
+                for write in batch:
+                    try:
+                        write_changes, write_outcomes = self._apply(session,
+                                                                    [write])
+                        session.commit()
+                    except Exception as error:
+                        session.rollback()
+                        outcomes.append((write[0], 'failed', None,
+                                         str(error)))
+                    else:
+                        changes.extend(write_changes)
+                        outcomes.extend(write_outcomes)
+            self.batches += 1
+            for job, action, question in changes:
+                notify_question_change(action, question)
+                self._finish(job, 'done', question_id=question.id)
+            for job, status, question_id, error in outcomes:
+                self._finish(job, status, question_id, error)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _apply(self, session, batch):
+        """
+        Stage the writes of 'batch' in 'session'. Return the changes made,
+        as (job, action, question), and the outcome of the other jobs, as
+        (job, status, question id, error), both to report once committed.
+        """
+        changes = []
+        outcomes = []
+        deleted = set()
+        for job, argument in batch:
+            if job['action'] == 'insert':
+                question = Question(**argument)
+                session.add(question)
+                changes.append((job, 'insert', question))
+            elif argument in deleted:
+                # the same question deleted twice in this group
+                outcomes.append((job, 'done', argument, None))
+            else:
+                question = session.query(Question).get(argument)
+                if question is None:
+                    outcomes.append((job, 'failed', None, 'Not Found'))
+                    continue
+                session.delete(question)
+                deleted.add(argument)
+                changes.append((job, 'delete', question))
+        session.flush()
+        return changes, outcomes
+
+    def _finish(self, job, status, question_id=None, error=None):
+        with self._lock:
+            job['status'] = status
+            if question_id is not None:
+                job['question_id'] = question_id
+            job['error'] = error
+            if status == 'done':
+                self.committed += 1
+            else:
+                self.failed += 1
+
+
+def setup_write_queue(app):
+    """
+    Return a write queue for the question inserts and deletes if the setting
+    'WRITE_BEHIND' (env 'TRIVIA_WRITE_BEHIND') is true, None otherwise.
+    'WRITE_QUEUE_SIZE' writes can wait in the queue, and they are committed
+    in groups of up to 'WRITE_BATCH_SIZE', gathered for up to
+    'WRITE_BATCH_LINGER_MS' milliseconds.
+    """
+    enabled = str(app.config.get(
+        'WRITE_BEHIND', os.environ.get('TRIVIA_WRITE_BEHIND', 'false')))
+    if enabled.lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return WriteQueue(
+        app,
+        max_size=int(app.config.get(
+            'WRITE_QUEUE_SIZE',
+            os.environ.get('TRIVIA_WRITE_QUEUE_SIZE', 1000))),
+        batch_size=int(app.config.get(
+            'WRITE_BATCH_SIZE',
+            os.environ.get('TRIVIA_WRITE_BATCH_SIZE', 100))),
+        linger=float(app.config.get(
+            'WRITE_BATCH_LINGER_MS',
+            os.environ.get('TRIVIA_WRITE_BATCH_LINGER_MS', 20))) / 1000)